@@ -3,35 +3,83 @@
 Single-writer apply pipeline for Xray config.
 
 Responsibilities:
-- Validate candidate config structure.
+- Validate candidate config structure, cross-references and per-protocol
+  required fields (all errors are reported at once).
 - Serialize writes via an exclusive file lock.
 - Atomically replace target config (os.replace on same filesystem).
 - Preserve current config on any failure (fail-closed update behavior).
+- Keep a digest manifest (sha256/size/mtime/inode) next to the committed
+  config so the no-op check and xray_watch.sh avoid re-hashing it.
+- Skip reading and validating a candidate whose digest sidecar (written by
+  xray_json.write_config_stream) already matches the committed config.
+- Fragment mode: commit a directory of -confdir fragments as one generation
+  (symlink swap), rewriting only the fragments that changed.
 """
 
 from __future__ import annotations
 
+import bisect
 import hashlib
 import json
 import os
+import re
 import sys
 import tempfile
+import time
 from pathlib import Path
 
+import xray_json
+
 try:
     import fcntl
 except ImportError:  # pragma: no cover - Windows host tests
     fcntl = None
 
+try:
+    import xray_metrics
+except ImportError:  # pragma: no cover - metrics module not deployed
+    xray_metrics = None
+
 
 REQUIRED_TOP_LEVEL_KEYS = ("inbounds", "outbounds", "routing")
-IGNORED_PROXY_PROTOCOLS = {"freedom", "blackhole", "dns"}
+HASH_CHUNK_SIZE = 1024 * 1024
+IGNORED_PROXY_PROTOCOLS = {"freedom", "blackhole", "dns", "loopback"}
+PROXY_SERVER_KEYS = {
+    "vless": "vnext",
+    "vmess": "vnext",
+    "trojan": "servers",
+    "shadowsocks": "servers",
+}
+SHADOWSOCKS_METHODS = {
+    "aes-128-gcm",
+    "aes-256-gcm",
+    "chacha20-poly1305",
+    "chacha20-ietf-poly1305",
+    "xchacha20-poly1305",
+    "xchacha20-ietf-poly1305",
+    "2022-blake3-aes-128-gcm",
+    "2022-blake3-aes-256-gcm",
+    "2022-blake3-chacha20-poly1305",
+    "none",
+    "plain",
+}
+UUID_RE = re.compile(
+    r"^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$"
+)
 
 
 def _sha256_bytes(data: bytes) -> str:
     return hashlib.sha256(data).hexdigest()
 
 
+def _sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        for chunk in iter(lambda: handle.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def _read_json_file(path: Path) -> tuple[bytes, dict]:
     raw = path.read_bytes()
     try:
@@ -46,114 +94,266 @@ def _read_json_file(path: Path) -> tuple[bytes, dict]:
     return raw, payload
 
 
-def validate_candidate_config(config: dict) -> None:
+def _is_valid_port(value) -> bool:
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    return isinstance(value, int) and 0 < value < 65536
+
+
+def _is_valid_user_id(value) -> bool:
+    # Xray accepts a UUID or any 1-30 byte string (mapped to UUIDv5).
+    if not isinstance(value, str) or not value:
+        return False
+    if len(value.encode("utf-8")) <= 30:
+        return True
+    return bool(UUID_RE.match(value))
+
+
+def _outbound_servers(settings: dict, key: str) -> list:
+    # Classic layout ("vnext"/"servers" lists) or the flat single-server layout.
+    servers = settings.get(key)
+    if servers is None and "address" in settings:
+        return [settings]
+    return servers
+
+
+def _check_server(where: str, server, errors: list[str]) -> None:
+    if not isinstance(server.get("address"), str) or not server.get("address"):
+        errors.append(f"{where} is missing non-empty 'address'")
+    if not _is_valid_port(server.get("port")):
+        errors.append(f"{where} has invalid port: {server.get('port')!r}")
+
+
+def _check_wireguard(where: str, settings: dict, errors: list[str]) -> None:
+    if not isinstance(settings.get("secretKey"), str) or not settings.get("secretKey"):
+        errors.append(f"{where} is missing non-empty 'secretKey'")
+    peers = settings.get("peers")
+    if not isinstance(peers, list) or not peers:
+        errors.append(f"{where} has no peers configured")
+        return
+    for p_idx, peer in enumerate(peers):
+        peer_where = f"{where} peer[{p_idx}]"
+        if not isinstance(peer, dict):
+            errors.append(f"{peer_where} must be an object")
+            continue
+        if not isinstance(peer.get("publicKey"), str) or not peer.get("publicKey"):
+            errors.append(f"{peer_where} is missing non-empty 'publicKey'")
+        endpoint = peer.get("endpoint")
+        port = endpoint.rsplit(":", 1)[-1] if isinstance(endpoint, str) else None
+        if not isinstance(endpoint, str) or ":" not in endpoint or not _is_valid_port(port):
+            errors.append(f"{peer_where} has invalid endpoint: {endpoint!r}")
+
+
+def _check_proxy_settings(idx: int, outbound: dict, errors: list[str]) -> None:
+    proto = outbound.get("protocol")
+    settings = outbound.get("settings")
+    if proto not in PROXY_SERVER_KEYS and proto != "wireguard":
+        return
+    where = f"outbounds[{idx}] ({outbound.get('tag') or proto})"
+    if not isinstance(settings, dict):
+        errors.append(f"{where} has invalid 'settings'")
+        return
+    if proto == "wireguard":
+        _check_wireguard(where, settings, errors)
+        return
+
+    servers = _outbound_servers(settings, PROXY_SERVER_KEYS[proto])
+    if not isinstance(servers, list) or not servers:
+        errors.append(f"{where} has no servers configured")
+        return
+
+    for s_idx, server in enumerate(servers):
+        server_where = f"{where} server[{s_idx}]"
+        if not isinstance(server, dict):
+            errors.append(f"{server_where} must be an object")
+            continue
+        _check_server(server_where, server, errors)
+
+        if proto in ("vless", "vmess"):
+            users = server.get("users")
+            if users is None and "id" in server:
+                users = [server]
+            if not isinstance(users, list):
+                errors.append(f"{server_where} has invalid 'users'")
+                continue
+            for user in users:
+                if not isinstance(user, dict) or not _is_valid_user_id(user.get("id")):
+                    user_id = user.get("id") if isinstance(user, dict) else user
+                    errors.append(f"{server_where} has invalid user id: {user_id!r}")
+        elif proto == "trojan":
+            if not isinstance(server.get("password"), str) or not server.get("password"):
+                errors.append(f"{server_where} is missing non-empty 'password'")
+        elif proto == "shadowsocks":
+            method = server.get("method")
+            if method not in SHADOWSOCKS_METHODS:
+                errors.append(f"{server_where} has unsupported shadowsocks method: {method!r}")
+            if not isinstance(server.get("password"), str):
+                errors.append(f"{server_where} is missing 'password'")
+
+
+def _matches_any_prefix(prefix: str, sorted_tags: list[str]) -> bool:
+    # Balancer and observatory selectors match outbound tags by prefix.
+    pos = bisect.bisect_left(sorted_tags, prefix)
+    return pos < len(sorted_tags) and sorted_tags[pos].startswith(prefix)
+
+
+def _check_selector(where: str, selector, sorted_tags: list[str], errors: list[str]) -> None:
+    if selector is None:
+        return
+    if not isinstance(selector, list):
+        errors.append(f"{where} must be a list")
+        return
+    for entry in selector:
+        if not isinstance(entry, str) or not entry:
+            errors.append(f"{where} has invalid entry: {entry!r}")
+        elif not _matches_any_prefix(entry, sorted_tags):
+            errors.append(f"{where} matches no outbound tag: {entry}")
+
+
+def collect_config_errors(config: dict) -> list[str]:
+    """Return every validation error of a candidate config (empty when valid)."""
     missing = [key for key in REQUIRED_TOP_LEVEL_KEYS if key not in config]
     if missing:
         joined = ", ".join(missing)
-        raise ValueError(f"Candidate config missing required keys: {joined}")
+        return [f"Candidate config missing required keys: {joined}"]
 
     inbounds = config.get("inbounds")
     outbounds = config.get("outbounds")
     routing = config.get("routing")
 
+    errors = []
     if not isinstance(inbounds, list) or not inbounds:
-        raise ValueError("Candidate config has empty or invalid 'inbounds'")
+        errors.append("Candidate config has empty or invalid 'inbounds'")
     if not isinstance(outbounds, list) or not outbounds:
-        raise ValueError("Candidate config has empty or invalid 'outbounds'")
+        errors.append("Candidate config has empty or invalid 'outbounds'")
+        outbounds = []
     if not isinstance(routing, dict):
-        raise ValueError("Candidate config has invalid 'routing' section")
+        errors.append("Candidate config has invalid 'routing' section")
+        routing = {}
 
     rules = routing.get("rules")
     if not isinstance(rules, list) or not rules:
-        raise ValueError("Candidate config has empty or invalid 'routing.rules'")
+        errors.append("Candidate config has empty or invalid 'routing.rules'")
+        rules = []
 
-    outbound_tags = []
-    for outbound in outbounds:
+    # Single pass over outbounds: tag index, fail-closed/proxy presence and
+    # per-protocol required fields.
+    outbound_tags: dict[str, int] = {}
+    duplicate_outbound_tags = set()
+    has_block = False
+    has_proxy_outbound = False
+    for idx, outbound in enumerate(outbounds):
         if not isinstance(outbound, dict):
             continue
         tag = outbound.get("tag")
+        proto = outbound.get("protocol")
         if isinstance(tag, str) and tag:
-            outbound_tags.append(tag)
+            if tag in outbound_tags:
+                duplicate_outbound_tags.add(tag)
+            else:
+                outbound_tags[tag] = idx
+        if tag == "block" or proto == "blackhole":
+            has_block = True
+        if tag and tag not in {"direct", "block"} and proto not in IGNORED_PROXY_PROTOCOLS:
+            has_proxy_outbound = True
+        _check_proxy_settings(idx, outbound, errors)
 
-    seen_outbound_tags = set()
-    duplicate_outbound_tags = set()
-    for tag in outbound_tags:
-        if tag in seen_outbound_tags:
-            duplicate_outbound_tags.add(tag)
-        seen_outbound_tags.add(tag)
     if duplicate_outbound_tags:
         joined = ", ".join(sorted(duplicate_outbound_tags))
-        raise ValueError(f"Candidate config has duplicate outbound tags: {joined}")
+        errors.append(f"Candidate config has duplicate outbound tags: {joined}")
+    sorted_tags = sorted(outbound_tags)
+    # Rules may also target tags Xray registers itself (metrics/api behind an inbound).
+    rule_targets = set(outbound_tags)
+    for section in ("metrics", "api"):
+        internal = config.get(section)
+        if isinstance(internal, dict) and isinstance(internal.get("tag"), str) and internal["tag"]:
+            rule_targets.add(internal["tag"])
 
     balancers = routing.get("balancers", [])
     if balancers is None:
         balancers = []
     if not isinstance(balancers, list):
-        raise ValueError("Candidate config has invalid 'routing.balancers' section")
+        errors.append("Candidate config has invalid 'routing.balancers' section")
+        balancers = []
 
     balancer_tags = set()
-    for balancer in balancers:
+    for b_idx, balancer in enumerate(balancers):
         if not isinstance(balancer, dict):
-            raise ValueError("Candidate config has invalid balancer entry")
+            errors.append("Candidate config has invalid balancer entry")
+            continue
         tag = balancer.get("tag")
         if not isinstance(tag, str) or not tag:
-            raise ValueError("Candidate config balancer is missing non-empty 'tag'")
-        balancer_tags.add(tag)
+            errors.append("Candidate config balancer is missing non-empty 'tag'")
+        elif tag in balancer_tags:
+            errors.append(f"Candidate config has duplicate balancer tag: {tag}")
+        else:
+            balancer_tags.add(tag)
+        where = f"routing.balancers[{b_idx}]"
+        _check_selector(f"{where}.selector", balancer.get("selector"), sorted_tags, errors)
+        fallback_tag = balancer.get("fallbackTag")
+        if fallback_tag and fallback_tag not in outbound_tags:
+            errors.append(f"{where} references unknown fallbackTag: {fallback_tag}")
+
+    for section in ("observatory", "burstObservatory"):
+        observatory = config.get(section)
+        if observatory is None:
+            continue
+        if not isinstance(observatory, dict):
+            errors.append(f"Candidate config has invalid '{section}' section")
+            continue
+        _check_selector(
+            f"{section}.subjectSelector",
+            observatory.get("subjectSelector"),
+            sorted_tags,
+            errors,
+        )
 
     for idx, rule in enumerate(rules):
         if not isinstance(rule, dict):
-            raise ValueError(f"routing.rules[{idx}] must be an object")
+            errors.append(f"routing.rules[{idx}] must be an object")
+            continue
 
         outbound_tag = rule.get("outboundTag")
         balancer_tag = rule.get("balancerTag")
 
         if outbound_tag and balancer_tag:
-            raise ValueError(
+            errors.append(
                 f"routing.rules[{idx}] cannot define both outboundTag and balancerTag"
             )
-
-        if outbound_tag:
-            if outbound_tag not in outbound_tags:
-                raise ValueError(
+        elif outbound_tag:
+            if outbound_tag not in rule_targets:
+                errors.append(
                     "routing.rules"
                     f"[{idx}] references unknown outboundTag: {outbound_tag}"
                 )
         elif balancer_tag:
             if balancer_tag not in balancer_tags:
-                raise ValueError(
+                errors.append(
                     "routing.rules"
                     f"[{idx}] references unknown balancerTag: {balancer_tag}"
                 )
         else:
-            raise ValueError(
+            errors.append(
                 f"routing.rules[{idx}] must define outboundTag or balancerTag"
             )
 
-    has_block = any(
-        isinstance(ob, dict)
-        and (ob.get("tag") == "block" or ob.get("protocol") == "blackhole")
-        for ob in outbounds
-    )
-    if not has_block:
-        raise ValueError("Candidate config must include fail-closed 'block' outbound")
+    if outbounds and not has_block:
+        errors.append("Candidate config must include fail-closed 'block' outbound")
+    if outbounds and not has_proxy_outbound:
+        errors.append("Candidate config has no proxy outbounds")
+    return errors
 
-    has_proxy_outbound = False
-    for outbound in outbounds:
-        if not isinstance(outbound, dict):
-            continue
-        tag = outbound.get("tag")
-        proto = outbound.get("protocol")
-        if not tag:
-            continue
-        if tag in {"direct", "block"}:
-            continue
-        if proto in IGNORED_PROXY_PROTOCOLS:
-            continue
-        has_proxy_outbound = True
-        break
 
-    if not has_proxy_outbound:
-        raise ValueError("Candidate config has no proxy outbounds")
+def validate_candidate_config(config: dict) -> None:
+    errors = collect_config_errors(config)
+    if len(errors) == 1:
+        raise ValueError(errors[0])
+    if errors:
+        raise ValueError(
+            f"Candidate config has {len(errors)} errors: " + "; ".join(errors)
+        )
 
 
 def _fsync_directory(path: Path) -> None:
@@ -166,19 +366,104 @@ def _fsync_directory(path: Path) -> None:
         os.close(fd)
 
 
-def apply_candidate(candidate_path: Path, target_path: Path) -> bool:
-    raw_candidate, parsed_candidate = _read_json_file(candidate_path)
-    validate_candidate_config(parsed_candidate)
+def manifest_path_for(target_path: Path) -> Path:
+    return target_path.parent / f".{target_path.name}.manifest"
+
+
+def _stat_fields(st: os.stat_result) -> dict:
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "mtime": int(st.st_mtime),
+        "inode": st.st_ino,
+    }
+
+
+def read_manifest(manifest_path: Path) -> dict | None:
+    try:
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict):
+        return None
+    return manifest
+
+
+def _write_manifest_payload(manifest_path: Path, manifest: dict) -> None:
+    # One key per line keeps the manifest greppable from xray_watch.sh (no jq there).
+    payload = json.dumps(manifest, indent=2, sort_keys=True) + "\n"
+    fd, tmp_name = tempfile.mkstemp(
+        prefix=f"{manifest_path.name}.",
+        suffix=".tmp",
+        dir=str(manifest_path.parent),
+    )
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_handle:
+            tmp_handle.write(payload)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, manifest_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def write_manifest(manifest_path: Path, target_path: Path, sha256: str) -> None:
+    _write_manifest_payload(
+        manifest_path, {"sha256": sha256, **_stat_fields(target_path.stat())}
+    )
+
+
+def _stat_matches(entry, st: os.stat_result) -> bool:
+    if not isinstance(entry, dict) or not isinstance(entry.get("sha256"), str):
+        return False
+    fields = _stat_fields(st)
+    return all(entry.get(key) == fields[key] for key in ("size", "mtime_ns", "inode"))
+
+
+def current_digest(target_path: Path, manifest_path: Path) -> str | None:
+    """Digest of the committed config; trusts the manifest while stat data matches."""
+    try:
+        st = target_path.stat()
+    except FileNotFoundError:
+        return None
+    if st.st_size == 0:
+        return None
+
+    manifest = read_manifest(manifest_path)
+    if _stat_matches(manifest, st):
+        return manifest["sha256"]
 
+    # Manifest missing or stale (manual edit, crash before manifest write): rehash once.
+    sha256 = _sha256_file(target_path)
+    write_manifest(manifest_path, target_path, sha256)
+    return sha256
+
+
+def apply_candidate(candidate_path: Path, target_path: Path) -> bool:
     target_path.parent.mkdir(parents=True, exist_ok=True)
     lock_path = target_path.parent / f".{target_path.name}.lock"
+    manifest_path = manifest_path_for(target_path)
+
+    # Streamed candidates carry their sha256: an unchanged config is detected
+    # without reading or parsing it (the committed copy was validated on apply).
+    streamed_sha256 = xray_json.read_digest(candidate_path)
+    if streamed_sha256 is not None:
+        with lock_path.open("a+", encoding="utf-8") as lock_handle:
+            if fcntl is not None:
+                fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+            if current_digest(target_path, manifest_path) == streamed_sha256:
+                return False
+
+    raw_candidate, parsed_candidate = _read_json_file(candidate_path)
+    validate_candidate_config(parsed_candidate)
+    candidate_sha256 = _sha256_bytes(raw_candidate)
 
     with lock_path.open("a+", encoding="utf-8") as lock_handle:
         if fcntl is not None:
             fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
 
-        current_raw = target_path.read_bytes() if target_path.exists() else b""
-        if current_raw and _sha256_bytes(current_raw) == _sha256_bytes(raw_candidate):
+        if current_digest(target_path, manifest_path) == candidate_sha256:
             return False
 
         fd, tmp_name = tempfile.mkstemp(
@@ -196,16 +481,149 @@ def apply_candidate(candidate_path: Path, target_path: Path) -> bool:
 
             os.replace(tmp_path, target_path)
             _fsync_directory(target_path.parent)
-            return True
         finally:
             if tmp_path.exists():
                 tmp_path.unlink()
 
+        # Written after the commit: a crash in between leaves a stale manifest,
+        # which current_digest() detects by stat mismatch and repairs.
+        write_manifest(manifest_path, target_path, candidate_sha256)
+        return True
+
+
+def _read_fragment_dir(candidate_dir: Path) -> tuple[dict[str, bytes], dict]:
+    raw_fragments = {}
+    merged: dict = {}
+    for path in sorted(candidate_dir.glob("*.json")):
+        raw, payload = _read_json_file(path)
+        overlap = sorted(set(payload) & set(merged))
+        if overlap:
+            joined = ", ".join(overlap)
+            raise ValueError(f"Fragment {path.name} redefines top-level keys: {joined}")
+        merged.update(payload)
+        raw_fragments[path.name] = raw
+    if not raw_fragments:
+        raise ValueError(f"Candidate fragment directory has no *.json files: {candidate_dir}")
+    return raw_fragments, merged
+
+
+def _current_fragment_digests(current_dir: Path | None, manifest: dict | None) -> dict[str, str]:
+    if current_dir is None or not current_dir.is_dir():
+        return {}
+    files = manifest.get("files") if isinstance(manifest, dict) else None
+    if not isinstance(files, dict):
+        files = {}
+    digests = {}
+    for path in current_dir.glob("*.json"):
+        entry = files.get(path.name)
+        if _stat_matches(entry, path.stat()):
+            digests[path.name] = entry["sha256"]
+        else:
+            digests[path.name] = _sha256_file(path)
+    return digests
+
+
+def _remove_generation(path: Path) -> None:
+    for child in path.iterdir():
+        child.unlink()
+    path.rmdir()
+
+
+def apply_fragments(candidate_dir: Path, target_dir: Path) -> list[str]:
+    """
+    Apply a directory of config fragments to an Xray -confdir.
+
+    target_dir is a symlink to an immutable generation directory. A new
+    generation is assembled next to it (unchanged fragments are hard-linked,
+    only changed ones are written and fsynced) and committed with an atomic
+    symlink swap, so Xray never sees a partially updated set. Returns the
+    sorted names of changed/removed fragments (empty when nothing changed).
+    """
+    raw_fragments, merged = _read_fragment_dir(candidate_dir)
+    validate_candidate_config(merged)
+    candidate_digests = {name: _sha256_bytes(raw) for name, raw in raw_fragments.items()}
+
+    parent = target_dir.parent
+    parent.mkdir(parents=True, exist_ok=True)
+    lock_path = parent / f".{target_dir.name}.lock"
+    manifest_path = manifest_path_for(target_dir)
+
+    with lock_path.open("a+", encoding="utf-8") as lock_handle:
+        if fcntl is not None:
+            fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+
+        if target_dir.exists() and not target_dir.is_symlink():
+            raise ValueError(
+                f"Fragment target must be a symlink managed by the apply pipeline: {target_dir}"
+            )
+        current_dir = parent / os.readlink(target_dir) if target_dir.is_symlink() else None
+        current_digests = _current_fragment_digests(current_dir, read_manifest(manifest_path))
+
+        changed = sorted(
+            name
+            for name, digest in candidate_digests.items()
+            if current_digests.get(name) != digest
+        )
+        changed += sorted(set(current_digests) - set(candidate_digests))
+        if not changed:
+            return []
+
+        generation = f".{target_dir.name}.{time.time_ns()}"
+        new_dir = parent / generation
+        new_dir.mkdir()
+        tmp_link = parent / f".{target_dir.name}.{os.getpid()}.link"
+        try:
+            for name, raw in raw_fragments.items():
+                if name not in changed and current_dir is not None:
+                    try:
+                        os.link(current_dir / name, new_dir / name)
+                        continue
+                    except OSError:
+                        pass
+                with (new_dir / name).open("wb") as handle:
+                    handle.write(raw)
+                    handle.flush()
+                    os.fsync(handle.fileno())
+            _fsync_directory(new_dir)
+
+            os.symlink(generation, tmp_link)
+            os.replace(tmp_link, target_dir)
+            _fsync_directory(parent)
+        except BaseException:
+            if tmp_link.is_symlink():
+                tmp_link.unlink()
+            _remove_generation(new_dir)
+            raise
+
+        files = {}
+        for name, digest in candidate_digests.items():
+            files[name] = {"sha256": digest, **_stat_fields((new_dir / name).stat())}
+        _write_manifest_payload(
+            manifest_path,
+            {"generation": generation, "files": files, "changed": changed},
+        )
+
+        # Keep the previous generation for manual rollback; drop older ones.
+        keep = {generation, current_dir.name if current_dir is not None else ""}
+        for old in parent.glob(f".{target_dir.name}.*"):
+            if old.is_dir() and not old.is_symlink() and old.name not in keep:
+                _remove_generation(old)
+        return changed
+
+
+def _record_apply_metric(result: str) -> None:
+    if xray_metrics is None:
+        return
+    try:
+        xray_metrics.record_apply(result)
+    except Exception as exc:
+        print(f"WARNING Failed to record apply metrics: {exc}", file=sys.stderr)
+
 
 def main() -> int:
     if len(sys.argv) != 3:
         print(
-            "Usage: apply_xray_config.py <candidate_json> <target_json>",
+            "Usage: apply_xray_config.py <candidate_json|candidate_dir> <target_json|target_confdir>",
             file=sys.stderr,
         )
         return 2
@@ -214,14 +632,26 @@ def main() -> int:
     target_path = Path(sys.argv[2])
 
     try:
+        if candidate_path.is_dir():
+            changed_fragments = apply_fragments(candidate_path, target_path)
+            if changed_fragments:
+                joined = ", ".join(changed_fragments)
+                print(f"INFO Config fragments applied atomically: {target_path} ({joined})")
+            else:
+                print("INFO Config unchanged; no replace")
+            _record_apply_metric("changed" if changed_fragments else "unchanged")
+            return 0
+
         changed = apply_candidate(candidate_path, target_path)
         if changed:
             print(f"INFO Config applied atomically: {target_path}")
         else:
             print("INFO Config unchanged; no replace")
+        _record_apply_metric("changed" if changed else "unchanged")
         return 0
     except Exception as exc:
         print(f"apply_xray_config.py error: {exc}", file=sys.stderr)
+        _record_apply_metric("failed")
         return 1
 
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Benchmark config serialization: time, file size and (optionally) Xray start time.
+
+Usage: bench_config_json.py [node_count] [repeats]
+
+Builds a synthetic composed config with <node_count> VLESS/REALITY outbounds
+and compares compact vs pretty output for every available JSON backend. When
+an `xray` binary is on PATH (or XRAY_BIN is set), also times
+`xray run -test -c <file>` as a proxy for config parse cost at start.
+"""
+
+from __future__ import annotations
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import xray_json
+
+
+def synthetic_config(node_count: int) -> dict:
+    outbounds = []
+    for i in range(1, node_count + 1):
+        outbounds.append(
+            {
+                "tag": f"node{i}",
+                "protocol": "vless",
+                "settings": {
+                    "vnext": [
+                        {
+                            "address": f"node{i}.example.com",
+                            "port": 443,
+                            "users": [
+                                {
+                                    "id": "11111111-1111-1111-1111-111111111111",
+                                    "encryption": "none",
+                                    "flow": "xtls-rprx-vision",
+                                }
+                            ],
+                        }
+                    ]
+                },
+                "streamSettings": {
+                    "network": "tcp",
+                    "security": "reality",
+                    "realitySettings": {
+                        "serverName": "www.example.com",
+                        "fingerprint": "chrome",
+                        "publicKey": "Z84J2IelR9ch3k8VtlVhhs5ycBUlXA7wHBWcBrjqnAw",
+                        "shortId": "6ba85179e30d4fc2",
+                    },
+                },
+            }
+        )
+    outbounds.append({"tag": "direct", "protocol": "freedom", "settings": {}})
+    outbounds.append({"tag": "block", "protocol": "blackhole", "settings": {}})
+    tags = [f"node{i}" for i in range(1, node_count + 1)]
+    return {
+        "log": {"loglevel": "warning"},
+        "inbounds": [
+            {"port": 1080, "protocol": "socks", "settings": {"auth": "noauth", "udp": True}}
+        ],
+        "outbounds": outbounds,
+        "routing": {
+            "domainStrategy": "IPOnDemand",
+            "rules": [{"type": "field", "network": "tcp,udp", "balancerTag": "proxy-auto"}],
+            "balancers": [{"tag": "proxy-auto", "selector": tags, "fallbackTag": "block"}],
+        },
+        "observatory": {"subjectSelector": tags},
+    }
+
+
+def _time_xray_test(xray_bin: str, path: Path) -> float | None:
+    started = time.perf_counter()
+    result = subprocess.run(
+        [xray_bin, "run", "-test", "-c", str(path)],
+        capture_output=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        return None
+    return time.perf_counter() - started
+
+
+def main() -> int:
+    node_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    config = synthetic_config(node_count)
+    backends = ["json"] + (["orjson"] if xray_json.orjson is not None else [])
+    xray_bin = os.getenv("XRAY_BIN") or shutil.which("xray")
+
+    print(f"nodes={node_count} repeats={repeats} xray={xray_bin or '<not found>'}")
+    print(f"{'backend':8} {'mode':8} {'dump_ms':>9} {'load_ms':>9} {'bytes':>10} {'xray_test_ms':>13}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in backends:
+            for pretty in (True, False):
+                best_dump = float("inf")
+                for _ in range(repeats):
+                    started = time.perf_counter()
+                    payload = xray_json.dumps_config(config, pretty=pretty, backend=backend)
+                    best_dump = min(best_dump, time.perf_counter() - started)
+                best_load = float("inf")
+                for _ in range(repeats):
+                    started = time.perf_counter()
+                    xray_json.loads_config(payload, backend=backend)
+                    best_load = min(best_load, time.perf_counter() - started)
+
+                xray_ms = "-"
+                if xray_bin:
+                    path = Path(tmp_dir) / f"{backend}-{int(pretty)}.json"
+                    path.write_bytes(payload)
+                    timings = [_time_xray_test(xray_bin, path) for _ in range(repeats)]
+                    valid = [t for t in timings if t is not None]
+                    xray_ms = f"{min(valid) * 1000:.1f}" if valid else "failed"
+
+                mode = "pretty" if pretty else "compact"
+                print(
+                    f"{backend:8} {mode:8} {best_dump * 1000:9.1f} {best_load * 1000:9.1f} "
+                    f"{len(payload):10d} {xray_ms:>13}"
+                )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Benchmark connection-setup latency through Xray with and without mux.
+
+Usage: bench_mux.py [connections] [delay_ms]
+
+Starts a local HTTP target, a local VLESS server and a client Xray (socks
+inbound -> VLESS outbound), then opens <connections> sequential proxied
+connections and measures time to the first response byte. The client
+outbound is built with compose_xray_config.apply_mux, i.e. with the same mux
+block compose generates for XRAY_MUX=1. <delay_ms> adds a delay to each new
+server-side connection, emulating the handshake RTT to a remote node.
+
+Needs an `xray` binary on PATH (or XRAY_BIN).
+"""
+
+from __future__ import annotations
+
+import http.server
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import compose_xray_config
+import dest_latency
+
+
+USER_ID = "11111111-1111-1111-1111-111111111111"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_listening(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listening on 127.0.0.1:{port}")
+
+
+class _DelayingForwarder(threading.Thread):
+    """TCP forwarder that delays every new connection (stands in for network RTT)."""
+
+    def __init__(self, listen_port: int, target_port: int, delay_sec: float):
+        super().__init__(daemon=True)
+        self.listen_port = listen_port
+        self.target_port = target_port
+        self.delay_sec = delay_sec
+
+    def _pipe(self, src: socket.socket, dst: socket.socket) -> None:
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            dst.close()
+
+    def _handle(self, client: socket.socket) -> None:
+        time.sleep(self.delay_sec)
+        upstream = socket.create_connection(("127.0.0.1", self.target_port))
+        threading.Thread(target=self._pipe, args=(client, upstream), daemon=True).start()
+        self._pipe(upstream, client)
+
+    def run(self) -> None:
+        with socket.create_server(("127.0.0.1", self.listen_port)) as server:
+            while True:
+                client, _ = server.accept()
+                threading.Thread(target=self._handle, args=(client,), daemon=True).start()
+
+
+def server_config(port: int) -> dict:
+    return {
+        "log": {"loglevel": "error"},
+        "inbounds": [
+            {
+                "listen": "127.0.0.1",
+                "port": port,
+                "protocol": "vless",
+                "settings": {"clients": [{"id": USER_ID}], "decryption": "none"},
+            }
+        ],
+        "outbounds": [{"protocol": "freedom"}],
+    }
+
+
+def client_config(socks_port: int, server_port: int, mux: bool) -> dict:
+    outbound = {
+        "tag": "node1",
+        "protocol": "vless",
+        "settings": {
+            "vnext": [
+                {
+                    "address": "127.0.0.1",
+                    "port": server_port,
+                    "users": [{"id": USER_ID, "encryption": "none"}],
+                }
+            ]
+        },
+        "streamSettings": {"network": "tcp"},
+    }
+    if mux:
+        outbound = compose_xray_config.apply_mux([outbound], ["node1"])[0]
+    return {
+        "log": {"loglevel": "error"},
+        "inbounds": [
+            {
+                "listen": "127.0.0.1",
+                "port": socks_port,
+                "protocol": "socks",
+                "settings": {"auth": "noauth"},
+            }
+        ],
+        "outbounds": [outbound],
+    }
+
+
+def _run_xray(xray_bin: str, config: dict, path: Path) -> subprocess.Popen:
+    path.write_text(json.dumps(config), encoding="utf-8")
+    return subprocess.Popen(
+        [xray_bin, "run", "-c", str(path)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def measure(socks_port: int, target_port: int, connections: int) -> list[float]:
+    url = f"http://127.0.0.1:{target_port}/"
+    # Warm-up: lets mux open its underlying connection before timing starts.
+    dest_latency.measure_ttfb(socks_port, url)
+    return [dest_latency.measure_ttfb(socks_port, url) for _ in range(connections)]
+
+
+def main() -> int:
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    delay_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 30.0
+    xray_bin = os.getenv("XRAY_BIN") or shutil.which("xray")
+    if not xray_bin:
+        print("bench_mux.py error: xray binary not found (set XRAY_BIN)", file=sys.stderr)
+        return 1
+
+    http.server.SimpleHTTPRequestHandler.log_message = lambda *args: None
+    target = http.server.ThreadingHTTPServer(("127.0.0.1", 0), http.server.SimpleHTTPRequestHandler)
+    threading.Thread(target=target.serve_forever, daemon=True).start()
+    target_port = target.server_address[1]
+
+    server_port = _free_port()
+    delayed_port = _free_port()
+    _DelayingForwarder(delayed_port, server_port, delay_ms / 1000.0).start()
+
+    print(f"connections={connections} delay_ms={delay_ms} xray={xray_bin}")
+    print(f"{'mode':8} {'median_ms':>10} {'p90_ms':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server = _run_xray(xray_bin, server_config(server_port), Path(tmp_dir) / "server.json")
+        try:
+            _wait_listening(server_port)
+            for mux in (False, True):
+                socks_port = _free_port()
+                client = _run_xray(
+                    xray_bin,
+                    client_config(socks_port, delayed_port, mux),
+                    Path(tmp_dir) / f"client-{int(mux)}.json",
+                )
+                try:
+                    _wait_listening(socks_port)
+                    timings = sorted(measure(socks_port, target_port, connections))
+                finally:
+                    client.terminate()
+                    client.wait()
+                p90 = timings[min(len(timings) - 1, int(len(timings) * 0.9))]
+                mode = "mux" if mux else "no-mux"
+                print(f"{mode:8} {statistics.median(timings):10.1f} {p90:10.1f}")
+        finally:
+            server.terminate()
+            server.wait()
+            target.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
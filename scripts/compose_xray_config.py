@@ -1,10 +1,137 @@
 #!/usr/bin/env python3
+import fnmatch
 import ipaddress
-import json
+import math
 import os
+import re
 import sys
 import urllib.parse
+from pathlib import Path
 
+import dest_latency
+import node_health
+import node_regions
+import xray_json
+
+
+# Fixed file prefix per top-level key for Xray -confdir fragments (loaded in
+# filename order); stable names keep unchanged fragments byte-identical.
+FRAGMENT_ORDER = (
+    "log",
+    "api",
+    "dns",
+    "policy",
+    "stats",
+    "inbounds",
+    "outbounds",
+    "routing",
+    "observatory",
+    "burstObservatory",
+    "metrics",
+)
+
+# Chronically failing nodes are retagged so balancer selectors (prefix match on
+# "node...") skip them while observatory keeps probing them for recovery.
+QUARANTINE_TAG_PREFIX = "quarantine-"
+STANDBY_TAG_PREFIX = "standby-"
+INACTIVE_TAG_PREFIXES = (QUARANTINE_TAG_PREFIX, STANDBY_TAG_PREFIX)
+NON_PROXY_PROTOCOLS = ("freedom", "blackhole", "dns", "loopback")
+TIER_TAG_RE = re.compile(r"^t\d+\.")
+TAG_NUMBER_RE = re.compile(r"^(.*?)(\d+)$")
+TIER_CLASSES = ("reality", "tls", "cdn", "other")
+CDN_NETWORKS = ("ws", "httpupgrade", "xhttp", "splithttp", "grpc", "h2", "http")
+NATIVE_UDP_PROTOCOLS = ("shadowsocks", "wireguard", "hysteria")
+NATIVE_UDP_NETWORKS = ("kcp", "mkcp", "quic")
+QUIC_POLICIES = ("auto", "block", "allow")
+# Named streamSettings.sockopt profiles; inbounds get the subset that applies to listeners.
+SOCKOPT_PROFILES = {
+    "latency": {
+        "tcpFastOpen": True,
+        "tcpCongestion": "bbr",
+        "tcpKeepAliveIdle": 30,
+        "tcpKeepAliveInterval": 10,
+        "tcpUserTimeout": 10000,
+    },
+    "throughput": {
+        "tcpFastOpen": True,
+        "tcpCongestion": "bbr",
+        "tcpKeepAliveIdle": 300,
+        "tcpKeepAliveInterval": 60,
+    },
+    "mobile": {
+        "tcpFastOpen": True,
+        "tcpCongestion": "bbr",
+        "tcpKeepAliveIdle": 15,
+        "tcpKeepAliveInterval": 5,
+        "tcpUserTimeout": 15000,
+        "tcpMptcp": True,
+    },
+}
+INBOUND_SOCKOPT_KEYS = ("tcpFastOpen", "tcpCongestion", "tcpKeepAliveIdle", "tcpKeepAliveInterval")
+# Named traffic presets: sniffing scope, log verbosity and policy.levels timeouts (seconds).
+# metadataOnly applies to the HTTP/SOCKS inbounds only: their clients already send domain
+# names, while the gateway inbound sees bare IPs and needs content sniffing for routing.
+TRAFFIC_PROFILES = {
+    "max-throughput": {
+        "sniffing": ["http", "tls"],
+        "metadataOnly": True,
+        "loglevel": "warning",
+        "access": "none",
+        "handshake": 4,
+        "connIdle": 120,
+        "uplinkOnly": 1,
+        "downlinkOnly": 1,
+    },
+    "balanced": {
+        "sniffing": ["http", "tls", "quic"],
+        "metadataOnly": False,
+        "loglevel": "warning",
+        "access": "none",
+        "handshake": 4,
+        "connIdle": 300,
+        "uplinkOnly": 2,
+        "downlinkOnly": 5,
+    },
+    "debug": {
+        "sniffing": ["http", "tls", "quic"],
+        "metadataOnly": False,
+        "loglevel": "debug",
+        "dnsLog": True,
+        "handshake": 8,
+        "connIdle": 600,
+        "uplinkOnly": 5,
+        "downlinkOnly": 10,
+    },
+}
+SNIFFING_PROTOCOLS = ("http", "tls", "quic", "fakedns")
+LOG_LEVELS = ("debug", "info", "warning", "error", "none")
+POLICY_TIMEOUT_ENV = {
+    "handshake": "XRAY_POLICY_HANDSHAKE",
+    "connIdle": "XRAY_POLICY_CONN_IDLE",
+    "uplinkOnly": "XRAY_POLICY_UPLINK_ONLY",
+    "downlinkOnly": "XRAY_POLICY_DOWNLINK_ONLY",
+}
+# Xray's own policy defaults (seconds; bufferSize in kB per direction on 64-bit targets).
+XRAY_DEFAULT_POLICY = {"handshake": 4, "connIdle": 300, "uplinkOnly": 2, "downlinkOnly": 5}
+XRAY_DEFAULT_BUFFER_KB = 512
+# Below this Xray copies in tiny chunks (and 0 turns buffering off entirely).
+XRAY_MIN_BUFFER_KB = 4
+# cgroup v1 reports "no limit" as a page-aligned value close to 2**63.
+CGROUP_UNLIMITED = 1 << 60
+# SO_REUSEPORT (SOL_SOCKET=1, SO_REUSEPORT=15 on Linux) for XRAY_HANDOVER=1: the next Xray
+# process binds the same ports while the previous one is still serving (xray_watch.sh).
+REUSEPORT_SOCKOPT = {"system": "linux", "type": "int", "level": "1", "opt": "15", "value": "1"}
+# Serves XRAY_STATS_LISTEN as a handover-able inbound under XRAY_HANDOVER=1.
+METRICS_INBOUND_TAG = "metrics-in"
+MUX_PROTOCOLS = ("vless", "vmess", "trojan", "shadowsocks")
+# Transports that already multiplex streams (or where mux.cool adds head-of-line blocking).
+MUX_EXCLUDED_NETWORKS = ("xhttp", "splithttp", "grpc", "h2", "http", "quic")
+
+# Provider traffic multiplier in node names: "x1.5", "×2", "1.5x".
+MULTIPLIER_HINT_RE = re.compile(
+    r"(?:^|[^0-9a-z.])(?:[x×]\s?(\d+(?:\.\d+)?)|(\d+(?:\.\d+)?)\s?[x×])(?![0-9a-z])",
+    re.IGNORECASE,
+)
 
 LOCAL_IP_RANGES = [
     "10.0.0.0/8",
@@ -143,6 +270,59 @@ def ensure_direct_block(outbounds: list[dict]) -> list[dict]:
     return result
 
 
+def make_tags_prefix_free(
+    outbounds: list[dict], remarks: dict[str, str]
+) -> tuple[list[dict], dict[str, str]]:
+    """Zero-pad numbered proxy tags (node1 -> node01) when one tag prefixes another.
+
+    Balancer and observatory selectors match by prefix, so "node1" would also
+    select "node10"; padded tags can be listed in selectors individually.
+    Only needed when a balancer selects a subset of nodes by tag (see
+    subset_selectors_enabled); the full pool is unaffected by the overlap.
+    """
+    tags = sorted(o["tag"] for o in outbounds if is_proxy_outbound(o))
+    if not any(b.startswith(a) for a, b in zip(tags, tags[1:])):
+        return outbounds, remarks
+    widths: dict[str, int] = {}
+    for tag in tags:
+        match = TAG_NUMBER_RE.match(tag)
+        if match:
+            stem, digits = match.groups()
+            widths[stem] = max(widths.get(stem, 0), len(digits))
+    renamed = {}
+    for tag in tags:
+        match = TAG_NUMBER_RE.match(tag)
+        if match:
+            stem, digits = match.groups()
+            padded = f"{stem}{digits.zfill(widths[stem])}"
+            if padded != tag:
+                renamed[tag] = padded
+    if len(set(tags) - set(renamed) | set(renamed.values())) != len(tags):
+        raise ValueError("Zero-padding proxy tags would create duplicate tags")
+    result = []
+    for outbound in outbounds:
+        if outbound.get("tag") in renamed:
+            outbound = dict(outbound)
+            outbound["tag"] = renamed[outbound["tag"]]
+        result.append(outbound)
+    return result, {renamed.get(tag, tag): name for tag, name in remarks.items()}
+
+
+def subset_selectors_enabled() -> bool:
+    """UDP and destination balancers list individual node tags out of the pool.
+
+    Other selectors cover the whole active pool or use tier/region prefixes,
+    and inactive nodes are renamed with their own prefix, so overlapping tags
+    (node1/node10) only matter for these two.
+    """
+    if parse_bool_env("XRAY_UDP_ROUTING", False):
+        return True
+    return bool(
+        os.getenv("XRAY_DEST_LATENCY_DB", "").strip()
+        and dest_latency.parse_dest_groups(os.getenv("XRAY_DEST_GROUPS", ""))
+    )
+
+
 def reorder_outbounds(outbounds: list[dict]) -> list[dict]:
     proxy = []
     direct = []
@@ -155,7 +335,7 @@ def reorder_outbounds(outbounds: list[dict]) -> list[dict]:
             direct.append(o)
         elif tag == "block" or proto == "blackhole":
             block.append(o)
-        elif proto == "dns":
+        elif proto in NON_PROXY_PROTOCOLS:
             other.append(o)
         else:
             proxy.append(o)
@@ -165,32 +345,188 @@ def reorder_outbounds(outbounds: list[dict]) -> list[dict]:
     return proxy + other + direct + block
 
 
-def build_inbounds() -> list[dict]:
+def traffic_profile() -> dict:
+    """XRAY_TRAFFIC_PROFILE preset with the per-setting env overrides applied."""
+    name = os.getenv("XRAY_TRAFFIC_PROFILE", "none").strip().lower()
+    if name in ("", "none"):
+        profile = {}
+    elif name in TRAFFIC_PROFILES:
+        profile = dict(TRAFFIC_PROFILES[name])
+    else:
+        raise ValueError(
+            f"Unknown traffic profile '{name}' (expected none, {', '.join(TRAFFIC_PROFILES)})"
+        )
+
+    if os.getenv("XRAY_SNIFFING") is not None:
+        sniffing = parse_csv_env("XRAY_SNIFFING")
+        if sniffing == ["none"]:
+            sniffing = []
+        unknown = [p for p in sniffing if p not in SNIFFING_PROTOCOLS]
+        if unknown:
+            raise ValueError(
+                f"XRAY_SNIFFING: unknown protocol(s) {', '.join(unknown)}"
+                f" (expected none or {', '.join(SNIFFING_PROTOCOLS)})"
+            )
+        profile["sniffing"] = sniffing
+    if os.getenv("XRAY_SNIFFING_METADATA_ONLY") is not None:
+        profile["metadataOnly"] = parse_bool_env("XRAY_SNIFFING_METADATA_ONLY", False)
+    loglevel = os.getenv("XRAY_LOG_LEVEL", "").strip().lower()
+    if loglevel:
+        if loglevel not in LOG_LEVELS:
+            raise ValueError(f"XRAY_LOG_LEVEL must be one of: {', '.join(LOG_LEVELS)}")
+        profile["loglevel"] = loglevel
+    access = os.getenv("XRAY_ACCESS_LOG", "").strip()
+    if access:
+        profile["access"] = access
+    for key, env in POLICY_TIMEOUT_ENV.items():
+        raw = os.getenv(env, "").strip()
+        if raw:
+            value = int(raw)
+            if value < 0:
+                raise ValueError(f"{env} must be >= 0")
+            profile[key] = value
+    return profile
+
+
+def build_sniffing(profile: dict, gateway: bool = False) -> dict:
+    protocols = profile.get("sniffing", ["http", "tls", "quic"])
+    if not protocols:
+        return {"enabled": False}
+    sniffing = {"enabled": True, "destOverride": list(protocols), "routeOnly": True}
+    if profile.get("metadataOnly") and not gateway:
+        sniffing["metadataOnly"] = True
+    return sniffing
+
+
+def build_log(src_log, profile: dict) -> dict:
+    log = dict(src_log) if isinstance(src_log, dict) else {"loglevel": "info"}
+    for key in ("loglevel", "access", "dnsLog"):
+        if key in profile:
+            log[key] = profile[key]
+    return log
+
+
+def read_cgroup_memory_limit(root: str = "/sys/fs/cgroup") -> tuple[int, str] | None:
+    """(limit bytes, "v2"|"v1") of the cgroup mounted at root, or None when unlimited."""
+    candidates = (
+        ("v2", Path(root) / "memory.max"),
+        ("v1", Path(root) / "memory" / "memory.limit_in_bytes"),
+        ("v1", Path(root) / "memory.limit_in_bytes"),
+    )
+    for version, path in candidates:
+        try:
+            raw = path.read_text(encoding="utf-8").strip()
+        except OSError:
+            continue
+        if raw == "max":
+            return None
+        limit = int(raw)
+        return (limit, version) if 0 < limit < CGROUP_UNLIMITED else None
+    return None
+
+
+def memory_sizing() -> dict | None:
+    """bufferSize and idle timeout caps for XRAY_EXPECTED_CONNECTIONS within the memory limit.
+
+    Every connection holds an uplink and a downlink buffer, so bufferSize is
+    XRAY_BUFFER_MEMORY_SHARE of the limit split over 2 x connections (the rest
+    is left to the Go runtime, routing data and GC headroom). When buffers have
+    to shrink below Xray's default, idle timeouts are shortened in proportion
+    so idle connections give their memory back sooner.
+
+    compose runs in the updater container, whose own cgroup says nothing about
+    xray's limit: the limit comes from XRAY_MEMORY_LIMIT_MB, or from a cgroup
+    only when XRAY_CGROUP_ROOT explicitly points at xray's (mounted) cgroup.
+    """
+    raw = os.getenv("XRAY_EXPECTED_CONNECTIONS", "").strip()
+    if not raw:
+        return None
+    connections = int(raw)
+    if connections < 1:
+        raise ValueError("XRAY_EXPECTED_CONNECTIONS must be >= 1")
+    share = float(os.getenv("XRAY_BUFFER_MEMORY_SHARE", "0.5"))
+    if not 0 < share <= 1:
+        raise ValueError("XRAY_BUFFER_MEMORY_SHARE must be in (0, 1]")
+
+    explicit = os.getenv("XRAY_MEMORY_LIMIT_MB", "").strip()
+    if explicit:
+        limit, source = int(explicit) * 1024 * 1024, "XRAY_MEMORY_LIMIT_MB"
+    else:
+        cgroup_root = os.getenv("XRAY_CGROUP_ROOT", "").strip()
+        if not cgroup_root:
+            print(
+                "INFO memory sizing skipped: set XRAY_MEMORY_LIMIT_MB to the xray container's memory limit",
+                file=sys.stderr,
+            )
+            return None
+        found = read_cgroup_memory_limit(cgroup_root)
+        if found is None:
+            print(f"INFO memory sizing skipped: no memory limit under {cgroup_root}", file=sys.stderr)
+            return None
+        limit, source = found[0], f"cgroup {found[1]}"
+
+    per_connection_kb = limit * share / 1024 / (2 * connections)
+    buffer_kb = min(XRAY_DEFAULT_BUFFER_KB, int(per_connection_kb) // 4 * 4)
+    if buffer_kb < XRAY_MIN_BUFFER_KB:
+        print(
+            f"WARNING memory sizing: {per_connection_kb:.1f}kB per buffer for {connections} connections;"
+            f" bufferSize clamped to {XRAY_MIN_BUFFER_KB}kB, the limit is likely to be exceeded at peak",
+            file=sys.stderr,
+        )
+        buffer_kb = XRAY_MIN_BUFFER_KB
+    sizing = {"bufferSize": buffer_kb, "limit": limit, "source": source, "connections": connections}
+    if buffer_kb < XRAY_DEFAULT_BUFFER_KB:
+        ratio = buffer_kb / XRAY_DEFAULT_BUFFER_KB
+        sizing["caps"] = {
+            "connIdle": max(60, int(XRAY_DEFAULT_POLICY["connIdle"] * ratio)),
+            "uplinkOnly": 1,
+            "downlinkOnly": 2,
+        }
+    return sizing
+
+
+def build_policy(profile: dict) -> dict | None:
+    level = {key: profile[key] for key in POLICY_TIMEOUT_ENV if key in profile}
+    buffer_kb = os.getenv("XRAY_BUFFER_SIZE_KB", "").strip()
+    if buffer_kb:
+        level["bufferSize"] = int(buffer_kb)
+    sizing = memory_sizing()
+    if sizing is not None:
+        level.setdefault("bufferSize", sizing["bufferSize"])
+        for key, cap in (sizing.get("caps") or {}).items():
+            # An explicit XRAY_POLICY_* value is kept as is.
+            if not os.getenv(POLICY_TIMEOUT_ENV[key], "").strip():
+                level[key] = min(level.get(key, XRAY_DEFAULT_POLICY[key]), cap)
+        timeouts = " ".join(f"{key}={level[key]}s" for key in POLICY_TIMEOUT_ENV if key in level)
+        print(
+            f"INFO memory sizing: limit={sizing['limit'] // (1024 * 1024)}MiB ({sizing['source']})"
+            f" connections={sizing['connections']} bufferSize={level['bufferSize']}kB {timeouts}".rstrip(),
+            file=sys.stderr,
+        )
+    if not level:
+        return None
+    return {"levels": {"0": level}}
+
+
+def build_inbounds(profile: dict | None = None) -> list[dict]:
     http_port = int(os.getenv("HTTP_PROXY_PORT", "3128"))
     socks_port = int(os.getenv("SOCKS_PROXY_PORT", "1080"))
     gateway_mode = os.getenv("GATEWAY_MODE", "0") == "1"
     tproxy_port = int(os.getenv("GATEWAY_TPROXY_PORT", "12345"))
+    profile = profile or {}
 
     inbounds = [
         {
             "port": http_port,
             "protocol": "http",
             "settings": {"users": []},
-            "sniffing": {
-                "enabled": True,
-                "destOverride": ["http", "tls", "quic"],
-                "routeOnly": True,
-            },
+            "sniffing": build_sniffing(profile),
         },
         {
             "port": socks_port,
             "protocol": "socks",
             "settings": {"auth": "noauth", "udp": True},
-            "sniffing": {
-                "enabled": True,
-                "destOverride": ["http", "tls", "quic"],
-                "routeOnly": True,
-            },
+            "sniffing": build_sniffing(profile),
         },
     ]
 
@@ -204,11 +540,7 @@ def build_inbounds() -> list[dict]:
                     "network": "tcp,udp",
                     "followRedirect": True,
                 },
-                "sniffing": {
-                    "enabled": True,
-                    "destOverride": ["http", "tls", "quic"],
-                    "routeOnly": True,
-                },
+                "sniffing": build_sniffing(profile, gateway=True),
                 "streamSettings": {"sockopt": {"tproxy": "tproxy"}},
             }
         )
@@ -224,7 +556,7 @@ def extract_proxy_tags(outbounds: list[dict]) -> list[str]:
             continue
         if tag in ("direct", "block"):
             continue
-        if proto in ("freedom", "blackhole", "dns"):
+        if proto in NON_PROXY_PROTOCOLS:
             continue
         tags.append(tag)
     if not tags:
@@ -232,7 +564,7 @@ def extract_proxy_tags(outbounds: list[dict]) -> list[str]:
     return tags
 
 
-def build_routing(proxy_tags: list[str]) -> dict:
+def build_routing(proxy_tags: list[str], extra_rules: list[dict] | None = None) -> dict:
     exact_domains = parse_csv_env("BYPASS_DOMAINS")
     zone_domains = parse_csv_env("BYPASS_DOMAIN_ZONES")
     bypass_ips = parse_ip_ranges()
@@ -267,6 +599,9 @@ def build_routing(proxy_tags: list[str]) -> dict:
             }
         )
 
+    # Region / destination-group rules, ahead of the default route.
+    rules.extend(extra_rules or [])
+
     # Default route for all other traffic through proxy path:
     # - single proxy tag -> direct outboundTag to that node
     # - multi-proxy -> use balancer for automatic failover/load spread
@@ -290,23 +625,109 @@ def build_routing(proxy_tags: list[str]) -> dict:
     return {"domainStrategy": "IPOnDemand", "rules": rules}
 
 
-def build_balancer(proxy_tags: list[str]) -> dict:
+def parse_multiplier_hint(name: str) -> float | None:
+    match = MULTIPLIER_HINT_RE.search(name or "")
+    if not match:
+        return None
+    value = float(match.group(1) or match.group(2))
+    if not 0.1 <= value <= 10:
+        return None
+    return value
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def _duration_ms(value: float, step: int) -> str:
+    return f"{int(math.ceil(value / step) * step)}ms"
+
+
+def autotune_least_load(
+    proxy_tags: list[str],
+    outbounds: list[dict],
+    history,
+    remarks: dict[str, str],
+) -> dict:
+    """Derive leastLoad baselines/expected/maxRTT/costs from measurements and name hints."""
+    by_tag = {o.get("tag"): o for o in outbounds}
+    medians = []
+    median_by_tag = {}
+    costs = []
+    for tag in proxy_tags:
+        fail_ratio = 0.0
+        if history is not None and tag in by_tag:
+            stats = node_health.summarize(history.samples(node_health.node_identity(by_tag[tag])))
+            if stats["median_rtt"] is not None:
+                medians.append(stats["median_rtt"])
+                median_by_tag[tag] = stats["median_rtt"]
+            fail_ratio = stats["fail_ratio"]
+        multiplier = parse_multiplier_hint(remarks.get(tag) or tag) or 1.0
+        value = round(multiplier * (1 + 2 * fail_ratio), 2)
+        if value != 1.0:
+            # Non-regexp cost matches are substring matches ("node1" would hit "node10").
+            costs.append({"regexp": True, "match": f"^{re.escape(tag)}$", "value": value})
+
+    settings = {}
+    if medians:
+        baselines = []
+        for pct in (0.25, 0.5, 0.75):
+            baseline = _duration_ms(_percentile(medians, pct), 10)
+            if baseline not in baselines:
+                baselines.append(baseline)
+        settings["baselines"] = baselines
+        settings["expected"] = expected_nodes(medians, len(proxy_tags))
+        settings["maxRTT"] = _duration_ms(_percentile(medians, 0.9) * 1.5, 100)
+        # Not an Xray key: build_balancer sizes "expected" per balancer from it.
+        settings["_medians"] = median_by_tag
+    if costs:
+        settings["costs"] = costs
+    return settings
+
+
+def expected_nodes(medians: list, node_count: int) -> int:
+    """leastLoad "expected": nodes at or below the median RTT, 2..5, never above node_count."""
+    fast = sum(1 for m in medians if m <= _percentile(medians, 0.5))
+    return max(min(2, node_count), min(fast, 5, node_count))
+
+
+def build_balancer(
+    proxy_tags: list[str],
+    autotuned: dict | None = None,
+    tag: str = "proxy-auto",
+    fallback_tag: str | None = None,
+    members: list[str] | None = None,
+) -> dict:
+    """members: node tags behind the selector (defaults to the selector itself)."""
     strategy = os.getenv("XRAY_BALANCER_STRATEGY", "random").strip()
     if strategy not in ("random", "roundRobin", "leastPing", "leastLoad"):
         raise ValueError(
             "XRAY_BALANCER_STRATEGY must be one of: random, roundRobin, leastPing, leastLoad"
         )
 
+    if fallback_tag is None:
+        # Fail-closed by default: if all proxy nodes are down, do not leak traffic directly.
+        fallback_tag = os.getenv("XRAY_BALANCER_FALLBACK_TAG", "block").strip() or "block"
     balancer = {
-        "tag": "proxy-auto",
+        "tag": tag,
         "selector": proxy_tags,
-        # Fail-closed by default: if all proxy nodes are down, do not leak traffic directly.
-        "fallbackTag": os.getenv("XRAY_BALANCER_FALLBACK_TAG", "block").strip() or "block",
+        "fallbackTag": fallback_tag,
         "strategy": {"type": strategy},
     }
 
     if strategy == "leastLoad":
-        settings = {}
+        # Auto-tuned values first; explicit env settings still win per key.
+        settings = dict(autotuned or {})
+        medians = settings.pop("_medians", None)
+        if "expected" in settings:
+            # The pool-wide value would overshoot a tier/region/dest balancer with few nodes.
+            members = proxy_tags if members is None else members
+            own = [medians[m] for m in members if m in medians] if medians else []
+            if own:
+                settings["expected"] = expected_nodes(own, len(members))
+            else:
+                settings["expected"] = min(settings["expected"], max(1, len(members)))
         expected = os.getenv("XRAY_BALANCER_EXPECTED")
         max_rtt = os.getenv("XRAY_BALANCER_MAX_RTT")
         tolerance = os.getenv("XRAY_BALANCER_TOLERANCE")
@@ -327,51 +748,821 @@ def build_balancer(proxy_tags: list[str]) -> dict:
     return balancer
 
 
-def build_observatory(proxy_tags: list[str]) -> dict:
-    return {
+def classify_transport(outbound: dict) -> str:
+    """Tier class of a proxy outbound: reality, tls, cdn or other."""
+    stream = outbound.get("streamSettings") or {}
+    security = stream.get("security")
+    settings = outbound.get("settings") or {}
+    flows = [
+        user.get("flow") or ""
+        for server in settings.get("vnext") or []
+        for user in server.get("users") or []
+        if isinstance(user, dict)
+    ]
+    if security == "reality" or any(f.startswith("xtls-rprx-vision") for f in flows):
+        return "reality"
+    if security == "tls":
+        return "cdn" if stream.get("network") in CDN_NETWORKS else "tls"
+    return "other"
+
+
+def parse_tiers() -> list[list[str]]:
+    """XRAY_BALANCER_TIERS="reality;tls,cdn;other" -> [["reality"], ["tls", "cdn"], ["other"]]."""
+    tiers = []
+    for part in os.getenv("XRAY_BALANCER_TIERS", "").split(";"):
+        classes = [c.strip().lower() for c in part.split(",") if c.strip()]
+        unknown = [c for c in classes if c not in TIER_CLASSES]
+        if unknown:
+            raise ValueError(
+                f"XRAY_BALANCER_TIERS has unknown classes: {', '.join(unknown)} "
+                f"(expected {', '.join(TIER_CLASSES)})"
+            )
+        if classes:
+            tiers.append(classes)
+    return tiers
+
+
+def assign_tiers(
+    outbounds: list[dict],
+    active_tags: list[str],
+    history,
+    remarks: dict[str, str],
+    tiers: list[list[str]],
+) -> tuple[list[dict], dict[str, str], list[str]]:
+    """Retag active nodes as `t<N>.<tag>`; returns (outbounds, remarks, used tier prefixes)."""
+    demote_ratio = float(os.getenv("XRAY_BALANCER_TIER_DEMOTE_FAIL_RATIO", "0.3"))
+    min_samples = int(os.getenv("XRAY_HEALTH_MIN_SAMPLES", "5"))
+    tier_of_class = {cls: idx for idx, classes in enumerate(tiers) for cls in classes}
+    last = len(tiers) - 1
+
+    renamed = {}
+    used = set()
+    for outbound in outbounds:
+        tag = outbound.get("tag")
+        if tag not in active_tags:
+            continue
+        # Classes missing from XRAY_BALANCER_TIERS fall into the last tier.
+        tier = tier_of_class.get(classify_transport(outbound), last)
+        if history is not None:
+            stats = node_health.summarize(history.samples(node_health.node_identity(outbound)))
+            if stats["samples"] >= min_samples and stats["fail_ratio"] >= demote_ratio:
+                tier = min(last, tier + 1)
+        renamed[tag] = f"t{tier + 1}.{tag}"
+        used.add(tier)
+
+    result = []
+    for outbound in outbounds:
+        tag = outbound.get("tag")
+        if tag in renamed:
+            outbound = dict(outbound)
+            outbound["tag"] = renamed[tag]
+        result.append(outbound)
+    remarks = {renamed.get(tag, tag): name for tag, name in remarks.items()}
+    return result, remarks, [f"t{tier + 1}." for tier in sorted(used)]
+
+
+def loopback_tag(balancer_tag: str) -> str:
+    return f"to-{balancer_tag}"
+
+
+def build_loopbacks(balancers: list[dict]) -> tuple[list[dict], list[dict]]:
+    """Loopback outbounds + rules for balancers referenced from a fallbackTag.
+
+    Balancer fallbackTag may only name an outbound; a loopback outbound re-enters
+    routing under its own inboundTag, which a rule then sends to the target balancer.
+    """
+    targets = {b["tag"] for b in balancers}
+    outbounds = []
+    rules = []
+    for balancer in balancers:
+        fallback = balancer.get("fallbackTag") or ""
+        target = fallback[len("to-"):]
+        if not fallback.startswith("to-") or target not in targets:
+            continue
+        if any(o["tag"] == fallback for o in outbounds):
+            continue
+        inbound_tag = f"via-{target}"
+        outbounds.append(
+            {"tag": fallback, "protocol": "loopback", "settings": {"inboundTag": inbound_tag}}
+        )
+        rules.append({"type": "field", "inboundTag": [inbound_tag], "balancerTag": target})
+    return outbounds, rules
+
+
+def build_tier_balancers(
+    tier_prefixes: list[str], autotuned: dict | None, active_tags: list[str]
+) -> list[dict]:
+    """proxy-auto serves the first tier and falls through proxy-tier2.. to the fallback tag."""
+    names = ["proxy-auto"] + [f"proxy-tier{prefix[1:-1]}" for prefix in tier_prefixes[1:]]
+    balancers = []
+    for idx, prefix in enumerate(tier_prefixes):
+        fallback = loopback_tag(names[idx + 1]) if idx + 1 < len(names) else None
+        members = [t for t in active_tags if t.startswith(prefix)]
+        balancers.append(
+            build_balancer([prefix], autotuned, tag=names[idx], fallback_tag=fallback, members=members)
+        )
+    return balancers
+
+
+def classify_udp(outbound: dict) -> str:
+    """UDP capability of a proxy outbound: native, tunnel (UDP inside one TCP stream) or poor."""
+    network = (outbound.get("streamSettings") or {}).get("network") or "tcp"
+    if network in NATIVE_UDP_NETWORKS:
+        return "native"
+    if outbound.get("protocol") in NATIVE_UDP_PROTOCOLS and network in ("tcp", "raw"):
+        return "native"
+    # ws/grpc/xhttp/... add CDN hops and head-of-line blocking on top of TCP.
+    if network in CDN_NETWORKS:
+        return "poor"
+    if outbound.get("protocol") in ("vless", "vmess", "trojan", "shadowsocks"):
+        return "tunnel"
+    return "poor"
+
+
+def quic_blocked(outbounds: list[dict], active_tags: list[str]) -> bool:
+    """XRAY_QUIC_POLICY decision shared by the UDP routes and XUDP mux settings."""
+    policy = os.getenv("XRAY_QUIC_POLICY", "auto").strip() or "auto"
+    if policy not in QUIC_POLICIES:
+        raise ValueError(f"XRAY_QUIC_POLICY must be one of: {', '.join(QUIC_POLICIES)}")
+    if policy != "auto":
+        return policy == "block"
+    # Without a native UDP node, QUIC is better off falling back to TCP.
+    return not any(
+        o.get("tag") in active_tags and classify_udp(o) == "native" for o in outbounds
+    )
+
+
+def build_udp_routes(
+    outbounds: list[dict],
+    active_tags: list[str],
+    autotuned: dict | None,
+) -> tuple[list[dict], list[dict], list[dict]]:
+    """UDP balancer, QUIC policy rule and XUDP/UoT settings; returns (outbounds, rules, balancers)."""
+    block_quic = quic_blocked(outbounds, active_tags)
+    classes = {o["tag"]: classify_udp(o) for o in outbounds if o.get("tag") in active_tags}
+    native = [tag for tag in active_tags if classes.get(tag) == "native"]
+    tunnel = [tag for tag in active_tags if classes.get(tag) == "tunnel"]
+    udp_tags = native or tunnel
+
+    rules = []
+    if block_quic:
+        rules.append({"type": "field", "network": "udp", "port": "443", "outboundTag": "block"})
+    balancers = []
+    if udp_tags:
+        rules.append({"type": "field", "network": "udp", "balancerTag": "proxy-udp"})
+        balancers.append(
+            build_balancer(
+                udp_tags, autotuned, tag="proxy-udp", fallback_tag=loopback_tag("proxy-auto")
+            )
+        )
+
+    xudp_concurrency = int(os.getenv("XRAY_XUDP_CONCURRENCY", "16"))
+    ss_uot = parse_bool_env("XRAY_SS_UOT", False)
+    result = []
+    for outbound in outbounds:
+        tag = outbound.get("tag")
+        if tag in udp_tags and outbound.get("protocol") == "vless":
+            # concurrency -1 muxes only UDP (XUDP); also allowed with XTLS vision.
+            # A TCP mux set up by XRAY_MUX keeps its concurrency.
+            outbound = dict(outbound)
+            mux = dict(outbound.get("mux") or {"enabled": True, "concurrency": -1})
+            mux["xudpConcurrency"] = xudp_concurrency
+            mux["xudpProxyUDP443"] = "reject" if block_quic else "allow"
+            outbound["mux"] = mux
+        elif ss_uot and tag in active_tags and outbound.get("protocol") == "shadowsocks":
+            outbound = dict(outbound)
+            settings = dict(outbound.get("settings") or {})
+            settings["servers"] = [
+                dict(server, uot=True, UoTVersion=2) for server in settings.get("servers") or []
+            ]
+            outbound["settings"] = settings
+        result.append(outbound)
+
+    counts = f"native={len(native)} tunnel={len(tunnel)}"
+    print(f"INFO UDP nodes: {counts}; QUIC {'blocked' if block_quic else 'allowed'}", file=sys.stderr)
+    return result, rules, balancers
+
+
+def sockopt_profile(name: str) -> dict:
+    name = name.strip().lower()
+    if name in ("", "none"):
+        return {}
+    if name not in SOCKOPT_PROFILES:
+        raise ValueError(
+            f"Unknown sockopt profile '{name}' (expected none, {', '.join(SOCKOPT_PROFILES)})"
+        )
+    return dict(SOCKOPT_PROFILES[name])
+
+
+def _sockopt_value(raw: str):
+    lowered = raw.strip().lower()
+    if lowered in ("true", "false"):
+        return lowered == "true"
+    try:
+        return int(lowered)
+    except ValueError:
+        return raw.strip()
+
+
+def parse_sockopt_overrides() -> list[tuple[str, dict]]:
+    """XRAY_SOCKOPT_NODE_OVERRIDES="hk=mobile;DE-2=tcpMptcp:true,tcpCongestion:cubic"."""
+    overrides = []
+    for part in os.getenv("XRAY_SOCKOPT_NODE_OVERRIDES", "").split(";"):
+        pattern, sep, value = part.partition("=")
+        pattern = pattern.strip().lower()
+        if not sep or not pattern:
+            continue
+        if ":" in value:
+            settings = {}
+            for item in value.split(","):
+                key, _, raw = item.partition(":")
+                if key.strip():
+                    settings[key.strip()] = _sockopt_value(raw)
+        else:
+            settings = sockopt_profile(value)
+        overrides.append((pattern, settings))
+    return overrides
+
+
+def node_pattern_matches(pattern: str, remark: str, tag: str) -> bool:
+    """Glob ("*de*", "hk-?") against the whole name or tag, else whole words.
+
+    A plain pattern must match complete words in order, so "de" hits "DE-2
+    Frankfurt" but not "Moscow nodes"; "mobile hk" hits "Mobile HK 1".
+    """
+    remark, tag = remark.lower(), tag.lower()
+    if any(ch in pattern for ch in "*?["):
+        return fnmatch.fnmatchcase(remark, pattern) or fnmatch.fnmatchcase(tag, pattern)
+    words = re.findall(r"\w+", pattern)
+    if not words:
+        return False
+    size = len(words)
+    for text in (remark, tag):
+        tokens = re.findall(r"\w+", text)
+        if any(tokens[i : i + size] == words for i in range(len(tokens) - size + 1)):
+            return True
+    return False
+
+
+def apply_sockopt(outbounds: list[dict], remarks: dict[str, str]) -> list[dict]:
+    """Merge the sockopt profile into proxy outbounds (subscription values win)."""
+    base = sockopt_profile(os.getenv("XRAY_SOCKOPT_PROFILE", "none"))
+    overrides = parse_sockopt_overrides()
+    if not base and not overrides:
+        return outbounds
+    result = []
+    for outbound in outbounds:
+        if is_proxy_outbound(outbound):
+            sockopt = dict(base)
+            # Patterns should target node names: tags are renumbered on refresh.
+            remark = remarks.get(outbound["tag"], "")
+            for pattern, settings in overrides:
+                if node_pattern_matches(pattern, remark, outbound["tag"]):
+                    sockopt.update(settings)
+            stream = dict(outbound.get("streamSettings") or {})
+            sockopt.update(stream.get("sockopt") or {})
+            if sockopt:
+                stream["sockopt"] = sockopt
+                outbound = dict(outbound, streamSettings=stream)
+        result.append(outbound)
+    return result
+
+
+def apply_inbound_sockopt(inbounds: list[dict]) -> list[dict]:
+    base = sockopt_profile(os.getenv("XRAY_SOCKOPT_PROFILE", "none"))
+    listener = {key: value for key, value in base.items() if key in INBOUND_SOCKOPT_KEYS}
+    if not listener:
+        return inbounds
+    result = []
+    for inbound in inbounds:
+        stream = dict(inbound.get("streamSettings") or {})
+        # Existing keys (tproxy on the gateway inbound) are kept as they are.
+        stream["sockopt"] = {**listener, **(stream.get("sockopt") or {})}
+        result.append(dict(inbound, streamSettings=stream))
+    return result
+
+
+def apply_handover_sockopt(inbounds: list[dict]) -> list[dict]:
+    """SO_REUSEPORT on every inbound, and a tag on each so xray_watch.sh can remove them.
+
+    During a handover the supervisor removes the old process's inbounds by tag
+    (HandlerService) once the new process listens, so only the new one accepts.
+    """
+    if not parse_bool_env("XRAY_HANDOVER", False):
+        return inbounds
+    result = []
+    for inbound in inbounds:
+        inbound = dict(inbound, tag=inbound.get("tag") or f"{inbound['protocol']}-in")
+        stream = dict(inbound.get("streamSettings") or {})
+        sockopt = dict(stream.get("sockopt") or {})
+        custom = list(sockopt.get("customSockopt") or [])
+        if REUSEPORT_SOCKOPT not in custom:
+            custom.append(dict(REUSEPORT_SOCKOPT))
+        sockopt["customSockopt"] = custom
+        stream["sockopt"] = sockopt
+        result.append(dict(inbound, streamSettings=stream))
+    return result
+
+
+def mux_eligible(outbound: dict) -> bool:
+    if outbound.get("protocol") not in MUX_PROTOCOLS:
+        return False
+    network = (outbound.get("streamSettings") or {}).get("network") or "tcp"
+    if network in MUX_EXCLUDED_NETWORKS:
+        return False
+    # XTLS vision (incl. REALITY + vision) splices the inner TLS and rejects TCP mux.
+    settings = outbound.get("settings") or {}
+    for server in settings.get("vnext") or []:
+        for user in server.get("users") or []:
+            if isinstance(user, dict) and user.get("flow"):
+                return False
+    return True
+
+
+def apply_mux(outbounds: list[dict], active_tags: list[str]) -> list[dict]:
+    concurrency = int(os.getenv("XRAY_MUX_CONCURRENCY", "8"))
+    if not 1 <= concurrency <= 1024:
+        raise ValueError("XRAY_MUX_CONCURRENCY must be in 1..1024")
+    xudp_concurrency = int(os.getenv("XRAY_XUDP_CONCURRENCY", "16"))
+    udp443 = "reject" if quic_blocked(outbounds, active_tags) else "allow"
+    result = []
+    enabled = 0
+    for outbound in outbounds:
+        if outbound.get("tag") in active_tags and mux_eligible(outbound):
+            outbound = dict(outbound)
+            outbound["mux"] = {
+                "enabled": True,
+                "concurrency": concurrency,
+                "xudpConcurrency": xudp_concurrency,
+                "xudpProxyUDP443": udp443,
+            }
+            enabled += 1
+        result.append(outbound)
+    print(f"INFO mux enabled on {enabled} of {len(active_tags)} nodes", file=sys.stderr)
+    return result
+
+
+def probe_interval(subject_count: int) -> str:
+    """Fixed XRAY_PROBE_INTERVAL, or derived from a probes-per-minute budget."""
+    budget = os.getenv("XRAY_PROBE_BUDGET_PER_MIN", "").strip()
+    if not budget:
+        return os.getenv("XRAY_PROBE_INTERVAL", "20s").strip()
+    min_interval = int(os.getenv("XRAY_PROBE_MIN_INTERVAL_SEC", "5"))
+    # Every subject is probed once per interval, so effort scales with the observed set.
+    seconds = math.ceil(60 * max(1, subject_count) / max(1.0, float(budget)))
+    return f"{max(min_interval, seconds)}s"
+
+
+def build_observatory(proxy_tags: list[str]) -> tuple[str, dict]:
+    probe_url = os.getenv("XRAY_PROBE_URL", "https://www.google.com/generate_204").strip()
+    interval = probe_interval(len(proxy_tags))
+    mode = os.getenv("XRAY_OBSERVATORY_MODE", "observatory").strip() or "observatory"
+    if mode == "burst":
+        ping = {
+            "destination": probe_url,
+            "interval": interval,
+            "sampling": int(os.getenv("XRAY_PROBE_SAMPLING", "3")),
+            "timeout": os.getenv("XRAY_PROBE_TIMEOUT", "5s").strip(),
+        }
+        connectivity = os.getenv("XRAY_PROBE_CONNECTIVITY_URL", "").strip()
+        if connectivity:
+            ping["connectivity"] = connectivity
+        return "burstObservatory", {"subjectSelector": proxy_tags, "pingConfig": ping}
+    if mode != "observatory":
+        raise ValueError("XRAY_OBSERVATORY_MODE must be one of: observatory, burst")
+    return "observatory", {
         "subjectSelector": proxy_tags,
-        "probeUrl": os.getenv(
-            "XRAY_PROBE_URL",
-            "https://www.google.com/generate_204",
-        ).strip(),
-        "probeInterval": os.getenv("XRAY_PROBE_INTERVAL", "20s").strip(),
+        "probeUrl": probe_url,
+        "probeInterval": interval,
         "enableConcurrency": parse_bool_env("XRAY_PROBE_CONCURRENCY", True),
     }
 
 
+def split_standby(outbounds: list[dict], active_tags: list[str]) -> list[dict]:
+    """Keep the first XRAY_BALANCER_ACTIVE_MAX active nodes; retag the rest as standby."""
+    raw = os.getenv("XRAY_BALANCER_ACTIVE_MAX", "").strip()
+    if not raw:
+        return outbounds
+    limit = int(raw)
+    if limit < 1:
+        raise ValueError("XRAY_BALANCER_ACTIVE_MAX must be at least 1")
+    standby = set(active_tags[limit:])
+    if not standby:
+        return outbounds
+    result = []
+    for outbound in outbounds:
+        if outbound.get("tag") in standby:
+            outbound = dict(outbound)
+            outbound["tag"] = STANDBY_TAG_PREFIX + outbound["tag"]
+        result.append(outbound)
+    print(
+        f"INFO active pool: {limit} nodes, {len(standby)} on standby",
+        file=sys.stderr,
+    )
+    return result
+
+
+def is_proxy_outbound(outbound: dict) -> bool:
+    tag = outbound.get("tag")
+    if not tag or tag in ("direct", "block"):
+        return False
+    return outbound.get("protocol") not in NON_PROXY_PROTOCOLS
+
+
+def load_health_history():
+    raw = os.getenv("XRAY_HEALTH_DB", "").strip()
+    if not raw or not os.path.exists(raw):
+        return None
+    return node_health.load_history(Path(raw))
+
+
+def rank_by_health(outbounds: list[dict], history) -> list[dict]:
+    min_samples = int(os.getenv("XRAY_HEALTH_MIN_SAMPLES", "5"))
+    max_fail_ratio = float(os.getenv("XRAY_HEALTH_QUARANTINE_FAIL_RATIO", "0.8"))
+    max_recent_failures = int(os.getenv("XRAY_HEALTH_QUARANTINE_RECENT_FAILURES", "10"))
+
+    proxies = []
+    rest = []
+    for outbound in outbounds:
+        if is_proxy_outbound(outbound):
+            proxies.append(outbound)
+        else:
+            rest.append(outbound)
+
+    scored = []
+    for pos, outbound in enumerate(proxies):
+        stats = node_health.summarize(history.samples(node_health.node_identity(outbound)))
+        known = stats["samples"] >= min_samples
+        chronic = known and (
+            stats["fail_ratio"] >= max_fail_ratio
+            or stats["recent_failures"] >= max_recent_failures
+        )
+        # Unknown (new) nodes rank after reliable nodes but ahead of flaky ones.
+        fail_ratio = stats["fail_ratio"] if known else 0.2
+        rtt = stats["median_rtt"] if known and stats["median_rtt"] is not None else float("inf")
+        scored.append((chronic, round(fail_ratio, 1), rtt, pos, outbound))
+
+    if scored and all(item[0] for item in scored):
+        print(
+            "WARNING all proxy nodes are chronically failing; quarantine skipped",
+            file=sys.stderr,
+        )
+        scored = [(False,) + item[1:] for item in scored]
+
+    ranked = []
+    quarantined = []
+    for chronic, _ratio, _rtt, _pos, outbound in sorted(scored, key=lambda item: item[:4]):
+        if chronic:
+            outbound = dict(outbound)
+            outbound["tag"] = QUARANTINE_TAG_PREFIX + outbound["tag"]
+            quarantined.append(outbound["tag"])
+        ranked.append(outbound)
+    if quarantined:
+        print(f"INFO quarantined nodes: {', '.join(quarantined)}", file=sys.stderr)
+    return ranked + rest
+
+
+def group_by_region(
+    outbounds: list[dict],
+    active_tags: list[str],
+    history,
+    remarks: dict[str, str],
+) -> tuple[list[dict], dict[str, str], dict[str, list[str]]]:
+    """Retag grouped nodes as `[t<N>.]<region>.<tag>`; returns (outbounds, remarks, groups)."""
+    by_tag = {o.get("tag"): o for o in outbounds}
+    medians = None
+    if history is not None:
+        medians = {
+            tag: node_health.summarize(
+                history.samples(node_health.node_identity(by_tag[tag]))
+            )["median_rtt"]
+            for tag in active_tags
+        }
+    regions = node_regions.detect_regions(active_tags, by_tag, remarks, medians)
+
+    groups: dict[str, list[str]] = {}
+    renamed = {}
+    for tag in active_tags:
+        region = regions.get(tag)
+        if region:
+            # Region labels are [a-z0-9] only, so "<region>." never prefixes another region.
+            tier = TIER_TAG_RE.match(tag)
+            tier_prefix = tier.group(0) if tier else ""
+            renamed[tag] = f"{tier_prefix}{region}.{tag[len(tier_prefix):]}"
+            groups.setdefault(region, []).append(renamed[tag])
+
+    result = []
+    for outbound in outbounds:
+        tag = outbound.get("tag")
+        if tag in renamed:
+            outbound = dict(outbound)
+            outbound["tag"] = renamed[tag]
+        result.append(outbound)
+    remarks = {renamed.get(tag, tag): name for tag, name in remarks.items()}
+    if groups:
+        summary = ", ".join(f"{region}={len(tags)}" for region, tags in sorted(groups.items()))
+        print(f"INFO region groups: {summary}", file=sys.stderr)
+    return result, remarks, groups
+
+
+def parse_region_routes() -> dict[str, dict[str, list[str]]]:
+    """XRAY_REGION_ROUTES="eu=geosite:google,geoip:de;us=domain:netflix.com,1.2.3.0/24"."""
+    routes: dict[str, dict[str, list[str]]] = {}
+    raw = os.getenv("XRAY_REGION_ROUTES", "")
+    for part in raw.split(";"):
+        region, sep, items = part.partition("=")
+        region = node_regions.sanitize_region(region)
+        if not sep or not region:
+            continue
+        entry = routes.setdefault(region, {"domain": [], "ip": []})
+        for item in items.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            if item.startswith("geoip:"):
+                entry["ip"].append(item)
+                continue
+            try:
+                ipaddress.ip_network(item, strict=False)
+                entry["ip"].append(item)
+            except ValueError:
+                entry["domain"].append(item)
+    return routes
+
+
+def build_region_rules(groups: dict[str, list[str]]) -> list[dict]:
+    rules = []
+    for region, entry in parse_region_routes().items():
+        if region not in groups:
+            print(
+                f"WARNING XRAY_REGION_ROUTES: no nodes in region '{region}'; "
+                "its traffic stays on the global pool",
+                file=sys.stderr,
+            )
+            continue
+        for key in ("domain", "ip"):
+            if entry[key]:
+                rules.append({"type": "field", key: entry[key], "balancerTag": f"proxy-{region}"})
+    return rules
+
+
+def selector_prefix(tag: str, region: str | None = None) -> str:
+    """Shortest selector prefix covering a retagged node (tier and/or region)."""
+    tier = TIER_TAG_RE.match(tag)
+    tier_prefix = tier.group(0) if tier else ""
+    if region:
+        return f"{tier_prefix}{region}."
+    return tier_prefix or tag
+
+
+def build_region_balancers(groups: dict[str, list[str]], autotuned: dict | None) -> list[dict]:
+    balancers = []
+    for region in sorted(groups):
+        selector = sorted({selector_prefix(tag, region) for tag in groups[region]})
+        balancers.append(
+            build_balancer(
+                selector,
+                autotuned,
+                tag=f"proxy-{region}",
+                # When the whole region is down, continue on the global pool.
+                fallback_tag=loopback_tag("proxy-auto"),
+                members=groups[region],
+            )
+        )
+    return balancers
+
+
+def build_probe_inbounds(active_tags: list[str]) -> tuple[list[dict], list[dict]]:
+    """Loopback SOCKS inbounds pinned to single nodes, for dest_latency.py."""
+    raw = os.getenv("XRAY_DEST_PROBE_PORT_BASE", "").strip()
+    if not raw:
+        return [], []
+    base = int(raw)
+    max_nodes = int(os.getenv("XRAY_DEST_PROBE_MAX_NODES", "20"))
+    inbounds = []
+    rules = []
+    for offset, tag in enumerate(active_tags[:max_nodes]):
+        probe_tag = dest_latency.PROBE_TAG_PREFIX + tag
+        inbounds.append(
+            {
+                "tag": probe_tag,
+                "listen": "127.0.0.1",
+                "port": base + offset,
+                "protocol": "socks",
+                "settings": {"auth": "noauth", "udp": False},
+            }
+        )
+        rules.append({"type": "field", "inboundTag": [probe_tag], "outboundTag": tag})
+    return inbounds, rules
+
+
+def build_dest_routes(
+    outbounds: list[dict],
+    active_tags: list[str],
+    autotuned: dict | None,
+) -> tuple[list[dict], list[dict]]:
+    """Rules + balancers for XRAY_DEST_GROUPS from dest_latency.py assignments."""
+    groups = dest_latency.parse_dest_groups(os.getenv("XRAY_DEST_GROUPS", ""))
+    db_path = os.getenv("XRAY_DEST_LATENCY_DB", "").strip()
+    if not groups or not db_path:
+        return [], []
+    assignments = dest_latency.load_db(Path(db_path))["groups"]
+    by_identity = {}
+    for outbound in outbounds:
+        if outbound.get("tag") in active_tags:
+            by_identity.setdefault(node_health.node_identity(outbound).hex(), outbound["tag"])
+
+    rules = []
+    balancers = []
+    for name, targets in groups.items():
+        state = assignments.get(name) or {}
+        chosen = [by_identity[i] for i in state.get("assigned") or [] if i in by_identity]
+        if not chosen:
+            continue
+        items: dict[str, list[str]] = {"domain": [], "ip": []}
+        for target in targets:
+            key, value = dest_latency.route_items(target)
+            if value not in items[key]:
+                items[key].append(value)
+        for key in ("domain", "ip"):
+            if items[key]:
+                rules.append({"type": "field", key: items[key], "balancerTag": f"dest-{name}"})
+        balancers.append(
+            build_balancer(
+                chosen,
+                autotuned,
+                tag=f"dest-{name}",
+                fallback_tag=loopback_tag("proxy-auto"),
+            )
+        )
+    return rules, balancers
+
+
+def build_metrics() -> tuple[dict | None, list[dict], list[dict]]:
+    """metrics block for XRAY_STATS_LISTEN, plus the inbound + rule serving it under XRAY_HANDOVER=1.
+
+    metrics.listen is not an inbound and gets no SO_REUSEPORT, so the next Xray
+    process could not bind it during a handover. A dokodemo-door inbound routed
+    to the metrics tag serves the same endpoint and is handed over like the
+    proxy inbounds.
+    """
+    listen = os.getenv("XRAY_STATS_LISTEN", "").strip()
+    if not listen:
+        return None, [], []
+    if not parse_bool_env("XRAY_HANDOVER", False):
+        return {"tag": "metrics", "listen": listen}, [], []
+    host, _, port = listen.rpartition(":")
+    host = host.strip("[]") or "127.0.0.1"
+    inbound = {
+        "tag": METRICS_INBOUND_TAG,
+        "listen": host,
+        "port": int(port),
+        "protocol": "dokodemo-door",
+        "settings": {"address": host},
+    }
+    rule = {"type": "field", "inboundTag": [METRICS_INBOUND_TAG], "outboundTag": "metrics"}
+    return {"tag": "metrics"}, [inbound], [rule]
+
+
 def compose_config(src: dict) -> dict:
     outbounds = src.get("outbounds")
     if not isinstance(outbounds, list) or not outbounds:
         raise ValueError("Source config has no outbounds")
 
+    profile = traffic_profile()
     prepared_outbounds = reorder_outbounds(ensure_direct_block(outbounds))
+    remarks = src.get("remarks") if isinstance(src.get("remarks"), dict) else {}
+    if subset_selectors_enabled():
+        prepared_outbounds, remarks = make_tags_prefix_free(prepared_outbounds, remarks)
+    history = load_health_history()
+    if history is not None:
+        prepared_outbounds = rank_by_health(prepared_outbounds, history)
+    proxy_tags = extract_proxy_tags(prepared_outbounds)
+    active_tags = [t for t in proxy_tags if not t.startswith(QUARANTINE_TAG_PREFIX)]
+    prepared_outbounds = split_standby(prepared_outbounds, active_tags)
     proxy_tags = extract_proxy_tags(prepared_outbounds)
+    active_tags = [t for t in proxy_tags if not t.startswith(INACTIVE_TAG_PREFIXES)]
+    tier_prefixes: list[str] = []
+    tiers = parse_tiers()
+    if len(active_tags) > 1 and tiers:
+        prepared_outbounds, remarks, tier_prefixes = assign_tiers(
+            prepared_outbounds, active_tags, history, remarks, tiers
+        )
+        proxy_tags = extract_proxy_tags(prepared_outbounds)
+        active_tags = [t for t in proxy_tags if not t.startswith(INACTIVE_TAG_PREFIXES)]
+    groups: dict[str, list[str]] = {}
+    if len(active_tags) > 1 and parse_bool_env("XRAY_REGION_MODE", False):
+        prepared_outbounds, remarks, groups = group_by_region(
+            prepared_outbounds, active_tags, history, remarks
+        )
+        proxy_tags = extract_proxy_tags(prepared_outbounds)
+        active_tags = [t for t in proxy_tags if not t.startswith(INACTIVE_TAG_PREFIXES)]
+    prepared_outbounds = apply_sockopt(prepared_outbounds, remarks)
+    if parse_bool_env("XRAY_MUX", False):
+        prepared_outbounds = apply_mux(prepared_outbounds, active_tags)
+    autotuned = None
+    extra_rules: list[dict] = []
+    balancers: list[dict] = []
+    if len(active_tags) > 1:
+        if parse_bool_env("XRAY_BALANCER_AUTOTUNE", False):
+            autotuned = autotune_least_load(active_tags, prepared_outbounds, history, remarks)
+        if tier_prefixes:
+            balancers += build_tier_balancers(tier_prefixes, autotuned, active_tags)
+        else:
+            balancers.append(build_balancer(active_tags, autotuned))
+        if parse_bool_env("XRAY_UDP_ROUTING", False):
+            # UDP/QUIC rules come first so UDP never lands on a TCP-only transport.
+            prepared_outbounds, udp_rules, udp_balancers = build_udp_routes(
+                prepared_outbounds, active_tags, autotuned
+            )
+            extra_rules += udp_rules
+            balancers += udp_balancers
+        # Destination groups are more specific than regions, so their rules come first.
+        dest_rules, dest_balancers = build_dest_routes(prepared_outbounds, active_tags, autotuned)
+        extra_rules += dest_rules
+        balancers += dest_balancers
+        if groups:
+            extra_rules += build_region_rules(groups)
+            balancers += build_region_balancers(groups, autotuned)
+
+    probe_inbounds, probe_rules = build_probe_inbounds(active_tags)
+    metrics, metrics_inbounds, metrics_rules = build_metrics()
+    loopback_outbounds, loopback_rules = build_loopbacks(balancers)
+    prepared_outbounds = reorder_outbounds(prepared_outbounds + loopback_outbounds)
+    routing = build_routing(active_tags, extra_rules)
+    # Probe and loopback inbounds must win over every other rule: re-injected traffic
+    # would otherwise match its original domain/IP rule again and loop.
+    routing["rules"][:0] = probe_rules + loopback_rules + metrics_rules
+    if balancers:
+        routing["balancers"] = balancers
     config = {
-        "log": src.get("log", {"loglevel": "info"}),
-        "inbounds": build_inbounds(),
+        "log": build_log(src.get("log"), profile),
+        "inbounds": apply_handover_sockopt(
+            apply_inbound_sockopt(build_inbounds(profile)) + probe_inbounds + metrics_inbounds
+        ),
         "outbounds": prepared_outbounds,
-        "routing": build_routing(proxy_tags),
+        "routing": routing,
     }
+    policy = build_policy(profile)
+    if policy is not None:
+        config["policy"] = policy
     if len(proxy_tags) > 1:
-        config["routing"]["balancers"] = [build_balancer(proxy_tags)]
-        config["observatory"] = build_observatory(proxy_tags)
+        # Quarantined nodes stay observed so their history can recover; standby nodes
+        # are not probed, so probe effort follows the active pool, not the subscription.
+        region_of = {tag: region for region, tags in groups.items() for tag in tags}
+        subjects = []
+        for tag in proxy_tags:
+            if tag.startswith(STANDBY_TAG_PREFIX):
+                continue
+            subject = selector_prefix(tag, region_of.get(tag))
+            if subject not in subjects:
+                subjects.append(subject)
+        key, observatory = build_observatory(subjects)
+        config[key] = observatory
+    if metrics is not None:
+        config["metrics"] = metrics
     return config
 
 
+def fragment_name(key: str) -> str:
+    if key in FRAGMENT_ORDER:
+        return f"{FRAGMENT_ORDER.index(key):02d}_{key}.json"
+    return f"99_{key}.json"
+
+
+def split_config_fragments(config: dict) -> dict[str, dict]:
+    return {fragment_name(key): {key: value} for key, value in config.items()}
+
+
+def write_config_fragments(config: dict, out_dir: Path) -> list[str]:
+    fragments = split_config_fragments(config)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for stale in out_dir.glob("*.json"):
+        if stale.name not in fragments:
+            stale.unlink()
+    for name, fragment in fragments.items():
+        xray_json.write_config(fragment, str(out_dir / name))
+    return sorted(fragments)
+
+
 def main() -> int:
     if len(sys.argv) != 3:
-        print("Usage: compose_xray_config.py <source_json> <output_json>", file=sys.stderr)
+        print(
+            "Usage: compose_xray_config.py <source_json> <output_json|output_dir>",
+            file=sys.stderr,
+        )
         return 2
 
     src_path = sys.argv[1]
     out_path = sys.argv[2]
     try:
-        with open(src_path, "r", encoding="utf-8") as f:
-            src = json.load(f)
+        with open(src_path, "rb") as f:
+            src = xray_json.loads_config(f.read())
         out = compose_config(src)
-        with open(out_path, "w", encoding="utf-8") as f:
-            json.dump(out, f, ensure_ascii=False, indent=2)
-            f.write("\n")
+        if parse_bool_env("XRAY_CONFIG_FRAGMENTS", False):
+            write_config_fragments(out, Path(out_path))
+        else:
+            xray_json.write_config_stream(out, out_path)
         return 0
     except Exception as exc:
         print(f"compose_xray_config.py error: {exc}", file=sys.stderr)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Small JSON checks for update_subscription.sh (replaces jq in the updater image).
+
+Usage:
+  config_tool.py is-xray <file>                 exit 0 for a full Xray JSON config
+  config_tool.py normalize-ports <in> <out>     http/socks inbounds -> HTTP_PROXY_PORT/SOCKS_PROXY_PORT
+  config_tool.py require <file|dir> <key>...    exit 0 when every top-level key is present (not null/false)
+                                                (a directory of -confdir fragments is merged first)
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+from pathlib import Path
+
+import xray_json
+
+
+def _load(path: Path):
+    with path.open("r", encoding="utf-8") as handle:
+        head = handle.read(1)
+        while head.isspace():
+            head = handle.read(1)
+        if head not in ("{", "["):
+            # Link lists / YAML: skip the full JSON parse.
+            raise ValueError(f"{path} is not JSON")
+        return json.loads(head + handle.read())
+
+
+def _present(data: dict, key: str) -> bool:
+    # jq truthiness: only a missing key, null and false count as absent.
+    return data.get(key) not in (None, False)
+
+
+def is_xray_config(data) -> bool:
+    # sing-box configs also have inbounds/outbounds, but their outbounds use "type".
+    if not isinstance(data, dict) or not _present(data, "inbounds"):
+        return False
+    outbounds = data.get("outbounds")
+    if not isinstance(outbounds, list):
+        return False
+    return any(isinstance(o, dict) and "protocol" in o for o in outbounds)
+
+
+def normalize_ports(data: dict) -> dict:
+    http_port = int(os.getenv("HTTP_PROXY_PORT", "3128"))
+    socks_port = int(os.getenv("SOCKS_PROXY_PORT", "1080"))
+    for inbound in data.get("inbounds") or []:
+        if not isinstance(inbound, dict):
+            continue
+        if inbound.get("protocol") == "http":
+            inbound["port"] = http_port
+        elif inbound.get("protocol") == "socks":
+            inbound["port"] = socks_port
+    return data
+
+
+def merged(path: Path) -> dict:
+    if not path.is_dir():
+        data = _load(path)
+        return data if isinstance(data, dict) else {}
+    result: dict = {}
+    for fragment in sorted(path.glob("*.json")):
+        data = _load(fragment)
+        if isinstance(data, dict):
+            result.update(data)
+    return result
+
+
+def main() -> int:
+    usage = __doc__.split("Usage:", 1)[1].rstrip()
+    if len(sys.argv) < 3 or sys.argv[1] not in ("is-xray", "normalize-ports", "require"):
+        print(f"Usage:{usage}", file=sys.stderr)
+        return 2
+    command, path = sys.argv[1], Path(sys.argv[2])
+    try:
+        if command == "is-xray":
+            try:
+                return 0 if is_xray_config(_load(path)) else 1
+            except ValueError:
+                return 1
+        if command == "normalize-ports":
+            if len(sys.argv) != 4:
+                print(f"Usage:{usage}", file=sys.stderr)
+                return 2
+            xray_json.write_config(normalize_ports(_load(path)), sys.argv[3])
+            return 0
+        data = merged(path)
+        missing = [key for key in sys.argv[3:] if not _present(data, key)]
+        if missing:
+            print(f"config_tool.py: {path} is missing {', '.join(missing)}", file=sys.stderr)
+            return 1
+        return 0
+    except (OSError, ValueError) as exc:
+        print(f"config_tool.py error: {exc}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
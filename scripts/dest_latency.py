@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Per-destination latency measurement for destination-aware routing.
+
+Responsibilities:
+- Measure time-to-first-byte to important destinations (XRAY_DEST_GROUPS)
+  through each candidate node, using the loopback SOCKS probe inbounds that
+  compose_xray_config.py emits when XRAY_DEST_PROBE_PORT_BASE is set.
+- Smooth results (EWMA) per node identity, so renumbered tags keep history.
+- Keep per-group node assignments with hysteresis: a challenger replaces an
+  assigned node only when it is clearly faster (XRAY_DEST_HYSTERESIS) or the
+  assigned node fails.
+- Store assignments in XRAY_DEST_LATENCY_DB for compose to turn into rules.
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import json
+import os
+import socket
+import ssl
+import struct
+import sys
+import tempfile
+import time
+import urllib.parse
+from pathlib import Path
+
+import node_health
+
+
+DEFAULT_DB_PATH = "/var/log/xray/dest-latency.json"
+DEFAULT_CONFIG_PATH = "/etc/xray/config.json"
+PROBE_TAG_PREFIX = "probe-"
+DB_VERSION = 1
+EWMA_ALPHA = 0.3
+
+
+def parse_dest_groups(raw: str) -> dict[str, list[str]]:
+    """'saas=api.example.com,https://x.example.com/health;video=www.youtube.com'."""
+    groups: dict[str, list[str]] = {}
+    for part in raw.split(";"):
+        name, sep, items = part.partition("=")
+        name = "".join(ch for ch in name.strip().lower() if ch.isalnum())
+        if not sep or not name:
+            continue
+        targets = [item.strip() for item in items.split(",") if item.strip()]
+        if targets:
+            groups[name] = targets
+    return groups
+
+
+def probe_url(target: str) -> str:
+    return target if "://" in target else f"https://{target}/"
+
+
+def route_items(target: str) -> tuple[str, str]:
+    """Routing rule field and value for a destination target."""
+    host = urllib.parse.urlsplit(probe_url(target)).hostname or target
+    try:
+        ipaddress.ip_address(host)
+        return "ip", host
+    except ValueError:
+        return "domain", f"domain:{host}"
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise OSError("SOCKS proxy closed the connection")
+        data += chunk
+    return data
+
+
+def socks5_connect(proxy_port: int, host: str, port: int, timeout: float) -> socket.socket:
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=timeout)
+    try:
+        sock.sendall(b"\x05\x01\x00")
+        if _recv_exact(sock, 2) != b"\x05\x00":
+            raise OSError("SOCKS proxy rejected no-auth handshake")
+        encoded = host.encode("idna")
+        sock.sendall(b"\x05\x01\x00\x03" + bytes([len(encoded)]) + encoded + struct.pack(">H", port))
+        reply = _recv_exact(sock, 4)
+        if reply[1] != 0:
+            raise OSError(f"SOCKS connect failed with code {reply[1]}")
+        skip = {1: 4, 4: 16}.get(reply[3])
+        if skip is None:
+            skip = _recv_exact(sock, 1)[0]
+        _recv_exact(sock, skip + 2)
+        return sock
+    except Exception:
+        sock.close()
+        raise
+
+
+def measure_ttfb(proxy_port: int, url: str, timeout: float = 10.0) -> float:
+    """Milliseconds from connect start to the first response byte."""
+    parts = urllib.parse.urlsplit(url)
+    host = parts.hostname or ""
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    started = time.perf_counter()
+    sock = socks5_connect(proxy_port, host, port, timeout)
+    try:
+        if parts.scheme == "https":
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request = f"HEAD {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: xray-dest-probe\r\nConnection: close\r\n\r\n"
+        sock.sendall(request.encode("ascii"))
+        if not sock.recv(1):
+            raise OSError("Empty response")
+        return (time.perf_counter() - started) * 1000.0
+    finally:
+        sock.close()
+
+
+def probe_ports(config: dict) -> dict[str, int]:
+    """{outbound tag: loopback probe port} from the live config."""
+    ports = {}
+    for inbound in config.get("inbounds") or []:
+        tag = inbound.get("tag") or ""
+        if tag.startswith(PROBE_TAG_PREFIX) and isinstance(inbound.get("port"), int):
+            ports[tag[len(PROBE_TAG_PREFIX):]] = inbound["port"]
+    return ports
+
+
+def load_db(path: Path) -> dict:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {"version": DB_VERSION, "groups": {}}
+    except ValueError as exc:
+        print(f"WARNING ignoring unreadable destination latency db {path}: {exc}", file=sys.stderr)
+        return {"version": DB_VERSION, "groups": {}}
+    if not isinstance(data, dict) or data.get("version") != DB_VERSION:
+        return {"version": DB_VERSION, "groups": {}}
+    data.setdefault("groups", {})
+    return data
+
+
+def save_db(path: Path, data: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            json.dump(data, handle, sort_keys=True)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def update_group(
+    state: dict,
+    measurements: dict[str, float | None],
+    top_n: int,
+    hysteresis: float,
+    now: int,
+) -> dict:
+    """Fold one measurement round ({identity hex: ms or None}) into a group state."""
+    previous_scores = state.get("scores") or {}
+    scores: dict[str, float | None] = {}
+    for identity, value in measurements.items():
+        previous = previous_scores.get(identity)
+        if value is None:
+            scores[identity] = None
+        elif previous is None:
+            scores[identity] = round(value, 1)
+        else:
+            scores[identity] = round(previous + EWMA_ALPHA * (value - previous), 1)
+
+    alive = sorted((score, identity) for identity, score in scores.items() if score is not None)
+    ranked = [identity for _, identity in alive]
+    assigned = [i for i in state.get("assigned") or [] if scores.get(i) is not None]
+    for challenger in ranked:
+        if challenger in assigned:
+            continue
+        if len(assigned) < top_n:
+            assigned.append(challenger)
+            continue
+        worst = max(assigned, key=lambda i: scores[i])
+        # Hysteresis: only swap for a clearly faster node, so assignments do not flap.
+        if scores[challenger] < scores[worst] * (1.0 - hysteresis):
+            assigned[assigned.index(worst)] = challenger
+    assigned.sort(key=lambda i: scores[i])
+    return {"assigned": assigned[:top_n], "scores": scores, "updated": now}
+
+
+def measure_round(
+    db: dict,
+    groups: dict[str, list[str]],
+    ports: dict[str, int],
+    identities: dict[str, bytes],
+    measure=measure_ttfb,
+    now: int | None = None,
+) -> int:
+    now = int(time.time()) if now is None else now
+    top_n = int(os.getenv("XRAY_DEST_TOP_N", "2"))
+    hysteresis = float(os.getenv("XRAY_DEST_HYSTERESIS", "0.2"))
+    timeout = float(os.getenv("XRAY_DEST_PROBE_TIMEOUT_SEC", "10"))
+    probes = 0
+    for name, targets in groups.items():
+        measurements: dict[str, float | None] = {}
+        for tag, port in ports.items():
+            identity = identities.get(tag)
+            if identity is None:
+                continue
+            samples = []
+            for target in targets:
+                probes += 1
+                try:
+                    samples.append(measure(port, probe_url(target), timeout))
+                except (OSError, ssl.SSLError, ValueError):
+                    samples = []
+                    break
+            measurements[identity.hex()] = sum(samples) / len(samples) if samples else None
+        db["groups"][name] = update_group(
+            db["groups"].get(name) or {}, measurements, top_n, hysteresis, now
+        )
+    return probes
+
+
+def main() -> int:
+    usage = "Usage: dest_latency.py measure [--once] | show"
+    if len(sys.argv) < 2 or sys.argv[1] not in ("measure", "show"):
+        print(usage, file=sys.stderr)
+        return 2
+
+    db_path = Path(os.getenv("XRAY_DEST_LATENCY_DB", DEFAULT_DB_PATH))
+    config_path = Path(os.getenv("XRAY_HEALTH_CONFIG", DEFAULT_CONFIG_PATH))
+    interval = float(os.getenv("XRAY_DEST_PROBE_INTERVAL_SEC", "300"))
+
+    try:
+        if sys.argv[1] == "show":
+            for name, state in sorted(load_db(db_path)["groups"].items()):
+                scores = state.get("scores") or {}
+                assigned = ", ".join(f"{i}={scores.get(i)}ms" for i in state.get("assigned") or [])
+                print(f"{name:12} {assigned or '-'}")
+            return 0
+
+        groups = parse_dest_groups(os.getenv("XRAY_DEST_GROUPS", ""))
+        if not groups:
+            raise ValueError("XRAY_DEST_GROUPS is empty")
+        once = "--once" in sys.argv[2:]
+        while True:
+            try:
+                config = node_health.load_live_config(config_path)
+                ports = probe_ports(config)
+                if not ports:
+                    raise ValueError("No probe inbounds in config (is XRAY_DEST_PROBE_PORT_BASE set?)")
+                db = load_db(db_path)
+                probes = measure_round(db, groups, ports, node_health.proxy_identities(config))
+                save_db(db_path, db)
+                if once:
+                    print(f"INFO ran {probes} destination probes into {db_path}")
+                    return 0
+            except Exception as exc:
+                if once:
+                    raise
+                print(f"WARNING destination probing failed: {exc}", file=sys.stderr)
+            time.sleep(interval)
+    except Exception as exc:
+        print(f"dest_latency.py error: {exc}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
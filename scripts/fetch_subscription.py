@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+"""
+Subscription downloader (replaces curl in update_subscription.sh).
+
+Usage: fetch_subscription.py <url> <output_file> [<headers_file>]
+
+Responsibilities:
+- Stream the response body to disk (temp file + atomic rename), never
+  holding the whole payload in memory.
+- Negotiate gzip/deflate, plus br and zstd when a bounded decoder is available
+  (brotli >= 1.2 / zstandard packages, or compression.zstd on Python 3.14+).
+- Enforce budgets: XRAY_FETCH_MAX_BYTES (decoded size), XRAY_FETCH_TIMEOUT_SEC
+  (whole transfer, including redirects), XRAY_FETCH_CONNECT_TIMEOUT_SEC.
+- Reuse keep-alive connections per origin across requests of one Fetcher
+  (redirect chains, mirrors). The pool lives only as long as the process:
+  update_subscription.sh starts a new one per refresh, so nothing is reused
+  across refreshes.
+- Optional HTTP(S) proxy (XRAY_FETCH_PROXY, CONNECT for https) and mTLS
+  (XRAY_FETCH_CLIENT_CERT / XRAY_FETCH_CLIENT_KEY, XRAY_FETCH_CA_FILE).
+- Write a curl -D style header dump for updater_daemon.py's provider hints.
+- Mirrors (XRAY_SUBSCRIPTION_MIRRORS): start with the historically fastest
+  mirror, hedge to the next one after a latency threshold, keep the first
+  valid body and cancel the rest; per-mirror latency EWMA is kept in
+  XRAY_FETCH_MIRROR_STATS.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import http.client
+import json
+import os
+import queue
+import re
+import shutil
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+try:
+    from compression import zstd
+except ImportError:  # pragma: no cover - Python < 3.14
+    zstd = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_USER_AGENT = "xray-updater/1.0"
+READ_CHUNK = 64 * 1024
+MAX_REDIRECTS = 5
+# Redirect bodies above this are not drained: the connection is closed instead.
+MAX_REDIRECT_BODY = 64 * 1024
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+DEFAULT_STATS_PATH = "/var/log/xray/mirror-stats.json"
+STATS_VERSION = 1
+EWMA_ALPHA = 0.3
+DEFAULT_HEDGE_DELAY_SEC = 2.0
+MIN_HEDGE_DELAY_SEC = 0.25
+MAX_HEDGE_DELAY_SEC = 10.0
+
+
+class FetchError(Exception):
+    pass
+
+
+def _basic_auth(parts: urllib.parse.SplitResult) -> str:
+    creds = f"{urllib.parse.unquote(parts.username or '')}:{urllib.parse.unquote(parts.password or '')}"
+    return "Basic " + base64.b64encode(creds.encode("utf-8")).decode("ascii")
+
+
+def _brotli_bounded() -> bool:
+    # output_buffer_limit / can_accept_more_data appeared in brotli 1.2.
+    return brotli is not None and hasattr(brotli.Decompressor, "can_accept_more_data")
+
+
+def supported_encodings() -> list[str]:
+    encodings = ["gzip", "deflate"]
+    if _brotli_bounded():
+        encodings.append("br")
+    if zstd is not None or zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+class _LimitReached(Exception):
+    pass
+
+
+class _Sink:
+    """Write target for zstandard's stream_writer that stops it past the limit."""
+
+    def __init__(self):
+        self.pieces: list[bytes] = []
+        self.size = 0
+        self.limit = 0
+
+    def write(self, data) -> int:
+        keep = bytes(data[: self.limit + 1 - self.size])
+        self.pieces.append(keep)
+        self.size += len(keep)
+        if self.size > self.limit:
+            raise _LimitReached()
+        return len(data)
+
+    def drain(self) -> bytes:
+        out = b"".join(self.pieces)
+        self.pieces = []
+        self.size = 0
+        return out
+
+
+class _Decoder:
+    """Incremental Content-Encoding decoder with a bounded output per step."""
+
+    def __init__(self, encoding: str):
+        encoding = encoding.strip().lower()
+        self.encoding = encoding or "identity"
+        self._zlib = None
+        self._brotli = None
+        self._zstd = None
+        self._zstandard = None
+        if encoding in ("", "identity"):
+            return
+        if encoding in ("gzip", "x-gzip"):
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self._zlib = zlib.decompressobj()
+        elif encoding == "br" and _brotli_bounded():
+            self._brotli = brotli.Decompressor()
+        elif encoding == "zstd" and zstd is not None:
+            self._zstd = zstd.ZstdDecompressor()
+        elif encoding == "zstd" and zstandard is not None:
+            self._sink = _Sink()
+            self._zstandard = zstandard.ZstdDecompressor().stream_writer(
+                self._sink, write_size=READ_CHUNK, closefd=False
+            )
+        else:
+            raise FetchError(f"unsupported Content-Encoding: {encoding}")
+
+    def decode(self, data: bytes, limit: int):
+        """Yield decoded pieces of data, never expanding past limit + 1 bytes at once."""
+        if self._zlib is not None:
+            while data:
+                out = self._zlib.decompress(data, limit + 1)
+                data = self._zlib.unconsumed_tail
+                yield out
+                if len(out) > limit:
+                    return
+        elif self._brotli is not None:
+            # Output that did not fit stays inside the decompressor until drained.
+            out = self._brotli.process(data, output_buffer_limit=limit + 1)
+            yield out
+            while out and len(out) <= limit and not self._brotli.can_accept_more_data():
+                out = self._brotli.process(b"", output_buffer_limit=limit + 1)
+                yield out
+        elif self._zstd is not None:
+            out = self._zstd.decompress(data, limit + 1)
+            yield out
+            while out and len(out) <= limit and not self._zstd.needs_input and not self._zstd.eof:
+                out = self._zstd.decompress(b"", limit + 1)
+                yield out
+        elif self._zstandard is not None:
+            # stream_writer emits READ_CHUNK-sized pieces; the sink aborts the
+            # write as soon as they add up to more than the limit.
+            self._sink.limit = limit
+            try:
+                self._zstandard.write(data)
+            except _LimitReached:
+                pass
+            yield self._sink.drain()
+        else:
+            yield data
+
+
+@dataclass
+class FetchResult:
+    url: str
+    status: int
+    size: int
+    encoding: str
+    elapsed: float
+
+
+class Fetcher:
+    def __init__(
+        self,
+        timeout: float = 60.0,
+        connect_timeout: float = 10.0,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        proxy: str = "",
+        ca_file: str = "",
+        client_cert: str = "",
+        client_key: str = "",
+        user_agent: str = DEFAULT_USER_AGENT,
+    ):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_bytes = max_bytes
+        self.proxy = urllib.parse.urlsplit(proxy) if proxy else None
+        self.proxy_headers = {}
+        if self.proxy is not None and self.proxy.username:
+            self.proxy_headers["Proxy-Authorization"] = _basic_auth(self.proxy)
+        self.user_agent = user_agent
+        self.context = ssl.create_default_context(cafile=ca_file or None)
+        if client_cert:
+            self.context.load_cert_chain(client_cert, client_key or None)
+        self._pool: dict[tuple[str, str, int], list[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+
+    @classmethod
+    def from_env(cls) -> "Fetcher":
+        return cls(
+            timeout=float(os.getenv("XRAY_FETCH_TIMEOUT_SEC", "60")),
+            connect_timeout=float(os.getenv("XRAY_FETCH_CONNECT_TIMEOUT_SEC", "10")),
+            max_bytes=int(os.getenv("XRAY_FETCH_MAX_BYTES", str(DEFAULT_MAX_BYTES))),
+            proxy=os.getenv("XRAY_FETCH_PROXY", "").strip(),
+            ca_file=os.getenv("XRAY_FETCH_CA_FILE", "").strip(),
+            client_cert=os.getenv("XRAY_FETCH_CLIENT_CERT", "").strip(),
+            client_key=os.getenv("XRAY_FETCH_CLIENT_KEY", "").strip(),
+            user_agent=os.getenv("XRAY_FETCH_USER_AGENT", "").strip() or DEFAULT_USER_AGENT,
+        )
+
+    def _connect(self, scheme: str, host: str, port: int) -> http.client.HTTPConnection:
+        self.connections_opened += 1
+        if self.proxy is None:
+            if scheme == "https":
+                return http.client.HTTPSConnection(
+                    host, port, timeout=self.connect_timeout, context=self.context
+                )
+            return http.client.HTTPConnection(host, port, timeout=self.connect_timeout)
+
+        proxy_port = self.proxy.port or 8080
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(
+                self.proxy.hostname, proxy_port, timeout=self.connect_timeout, context=self.context
+            )
+            conn.set_tunnel(host, port, headers=self.proxy_headers)
+            return conn
+        return http.client.HTTPConnection(self.proxy.hostname, proxy_port, timeout=self.connect_timeout)
+
+    def _checkout(self, key: tuple[str, str, int]) -> tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._pool.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(*key), False
+
+    def _checkin(self, key: tuple[str, str, int], conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            self._pool.setdefault(key, []).append(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            for conns in self._pool.values():
+                for conn in conns:
+                    conn.close()
+            self._pool.clear()
+
+    def _request(self, url: str, deadline: float):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise FetchError(f"unsupported URL: {url}")
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        headers = {
+            "User-Agent": self.user_agent,
+            "Accept": "*/*",
+            "Accept-Encoding": ", ".join(supported_encodings()),
+        }
+        if parts.username:
+            headers["Authorization"] = _basic_auth(parts)
+        if self.proxy is not None and parts.scheme == "http":
+            # Plain HTTP goes through the proxy as an absolute-form request.
+            target = urllib.parse.urlunsplit(parts._replace(fragment=""))
+            headers.update(self.proxy_headers)
+
+        for attempt in range(2):
+            conn, reused = self._checkout(key)
+            try:
+                conn.timeout = max(0.1, min(self.connect_timeout, deadline - time.monotonic()))
+                conn.request("GET", target, headers=headers)
+                if conn.sock is not None:
+                    conn.sock.settimeout(max(0.1, deadline - time.monotonic()))
+                return key, conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # A pooled keep-alive connection may have been closed by the server.
+                if not reused or attempt:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+        raise FetchError("unreachable")
+
+    def fetch(
+        self,
+        url: str,
+        out_path: Path,
+        headers_path: Path | None = None,
+        cancel: threading.Event | None = None,
+    ) -> FetchResult:
+        started = time.monotonic()
+        deadline = started + self.timeout
+        header_dump: list[str] = []
+        for _ in range(MAX_REDIRECTS + 1):
+            if cancel is not None and cancel.is_set():
+                raise FetchError("cancelled")
+            key, conn, response = self._request(url, deadline)
+            header_dump.append(f"HTTP/{response.version / 10:.1f} {response.status} {response.reason}\r\n")
+            header_dump.extend(f"{name}: {value}\r\n" for name, value in response.getheaders())
+            header_dump.append("\r\n")
+            if response.status in REDIRECT_STATUSES and response.getheader("Location"):
+                self._skip_body(key, conn, response, deadline)
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            break
+        else:
+            raise FetchError(f"too many redirects (>{MAX_REDIRECTS})")
+
+        if headers_path is not None:
+            headers_path.write_text("".join(header_dump), encoding="utf-8")
+        try:
+            if response.status >= 400:
+                raise FetchError(f"HTTP {response.status} {response.reason} from {url}")
+            encoding = response.getheader("Content-Encoding") or ""
+            size = self._stream(response, _Decoder(encoding), out_path, deadline, cancel)
+        except Exception:
+            conn.close()
+            raise
+        self._release(key, conn, response)
+        return FetchResult(url, response.status, size, encoding or "identity", time.monotonic() - started)
+
+    def _skip_body(self, key, conn, response, deadline: float) -> None:
+        """Drain a small redirect body so the connection can be reused; drop it otherwise."""
+        budget = min(MAX_REDIRECT_BODY, self.max_bytes)
+        while time.monotonic() < deadline:
+            chunk = response.read1(READ_CHUNK)
+            if not chunk:
+                self._release(key, conn, response)
+                return
+            budget -= len(chunk)
+            if budget < 0:
+                break
+        response.close()
+        conn.close()
+
+    def _release(self, key, conn, response) -> None:
+        # The body has been read completely; closing the response frees the connection.
+        response.close()
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn)
+
+    def _stream(
+        self,
+        response,
+        decoder: _Decoder,
+        out_path: Path,
+        deadline: float,
+        cancel: threading.Event | None,
+    ) -> int:
+        fd, tmp_name = tempfile.mkstemp(prefix=f".{out_path.name}.", suffix=".tmp", dir=str(out_path.parent))
+        tmp_path = Path(tmp_name)
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as handle:
+                while True:
+                    if time.monotonic() > deadline:
+                        raise FetchError(f"transfer exceeded {self.timeout:g}s budget")
+                    if cancel is not None and cancel.is_set():
+                        raise FetchError("cancelled")
+                    chunk = response.read1(READ_CHUNK)
+                    if not chunk:
+                        break
+                    for piece in decoder.decode(chunk, self.max_bytes - size):
+                        size += len(piece)
+                        if size > self.max_bytes:
+                            raise FetchError(f"response exceeds XRAY_FETCH_MAX_BYTES ({self.max_bytes} bytes)")
+                        handle.write(piece)
+            os.replace(tmp_path, out_path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return size
+
+
+def mirror_key(url: str) -> str:
+    # Hashed, so access tokens in subscription URLs are not written to disk.
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+
+
+class MirrorStats:
+    """Per-mirror latency EWMA and consecutive failures (XRAY_FETCH_MIRROR_STATS)."""
+
+    def __init__(self, path: Path | None):
+        self.path = path
+        self.mirrors: dict[str, dict] = {}
+        if path is None:
+            return
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return
+        except ValueError as exc:
+            print(f"WARNING ignoring unreadable mirror stats {path}: {exc}", file=sys.stderr)
+            return
+        if isinstance(data, dict) and data.get("version") == STATS_VERSION:
+            self.mirrors = data.get("mirrors") or {}
+
+    def order(self, urls: list[str]) -> list[str]:
+        """Healthy mirrors by latency, then unmeasured ones, then failing ones."""
+
+        def rank(item):
+            idx, url = item
+            entry = self.mirrors.get(mirror_key(url)) or {}
+            ewma = entry.get("ewma_ms")
+            return (entry.get("failures", 0), ewma if ewma is not None else float("inf"), idx)
+
+        return [url for _, url in sorted(enumerate(urls), key=rank)]
+
+    def ewma_ms(self, url: str) -> float | None:
+        return (self.mirrors.get(mirror_key(url)) or {}).get("ewma_ms")
+
+    def record(self, url: str, elapsed_ms: float | None, now: float | None = None) -> None:
+        entry = self.mirrors.setdefault(mirror_key(url), {"failures": 0})
+        entry["updated"] = int(time.time() if now is None else now)
+        if elapsed_ms is None:
+            entry["failures"] = entry.get("failures", 0) + 1
+            return
+        previous = entry.get("ewma_ms")
+        entry["ewma_ms"] = round(
+            elapsed_ms if previous is None else previous + EWMA_ALPHA * (elapsed_ms - previous), 1
+        )
+        entry["failures"] = 0
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(prefix=f".{self.path.name}.", suffix=".tmp", dir=str(self.path.parent))
+        tmp_path = Path(tmp_name)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as handle:
+                json.dump({"version": STATS_VERSION, "mirrors": self.mirrors}, handle, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+
+def hedge_delay(stats: MirrorStats, url: str) -> float:
+    raw = os.getenv("XRAY_FETCH_HEDGE_DELAY_SEC", "").strip()
+    if raw:
+        return float(raw)
+    ewma = stats.ewma_ms(url)
+    if ewma is None:
+        return DEFAULT_HEDGE_DELAY_SEC
+    # Hedge once the mirror is clearly slower than it usually is.
+    return min(MAX_HEDGE_DELAY_SEC, max(MIN_HEDGE_DELAY_SEC, 2.0 * ewma / 1000.0))
+
+
+def fetch_mirrors(
+    fetcher: Fetcher,
+    urls: list[str],
+    out_path: Path,
+    headers_path: Path | None,
+    stats: MirrorStats,
+) -> FetchResult:
+    """Fetch from the fastest known mirror, hedging to the next one after a delay.
+
+    The first complete non-empty body wins; the other attempts are cancelled.
+    Only the winner's header dump reaches headers_path, so a failed or losing
+    mirror's Retry-After / profile-update-interval never drives the updater.
+    """
+    pending = stats.order(urls)
+    work_dir = Path(tempfile.mkdtemp(prefix=f".{out_path.name}.mirrors.", dir=str(out_path.parent)))
+    cancel = threading.Event()
+    done: queue.Queue = queue.Queue()
+    errors: list[str] = []
+    running = 0
+    launched = 0
+    last_url = ""
+
+    def attempt(idx: int, url: str) -> None:
+        body = work_dir / f"body{idx}"
+        try:
+            result = fetcher.fetch(url, body, work_dir / f"headers{idx}", cancel)
+            if result.size == 0:
+                raise FetchError("empty body")
+            done.put((idx, url, result, None))
+        except Exception as exc:
+            done.put((idx, url, None, exc))
+
+    def launch() -> None:
+        nonlocal running, launched, last_url
+        last_url = pending.pop(0)
+        threading.Thread(target=attempt, args=(launched, last_url), daemon=True).start()
+        running += 1
+        launched += 1
+
+    try:
+        launch()
+        while running:
+            try:
+                timeout = hedge_delay(stats, last_url) if pending else None
+                idx, url, result, exc = done.get(timeout=timeout)
+            except queue.Empty:
+                launch()
+                continue
+            running -= 1
+            if exc is not None:
+                stats.record(url, None)
+                errors.append(f"{mirror_key(url)}: {exc}")
+                if pending:
+                    launch()
+                continue
+            cancel.set()
+            stats.record(url, result.elapsed * 1000.0)
+            os.replace(work_dir / f"body{idx}", out_path)
+            if headers_path is not None:
+                os.replace(work_dir / f"headers{idx}", headers_path)
+            return result
+        raise FetchError("all mirrors failed: " + "; ".join(errors))
+    finally:
+        cancel.set()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def parse_mirrors(raw: str) -> list[str]:
+    return [url for url in re.split(r"[\s,]+", raw.strip()) if url]
+
+
+def main() -> int:
+    if len(sys.argv) not in (3, 4):
+        print("Usage: fetch_subscription.py <url> <output_file> [<headers_file>]", file=sys.stderr)
+        return 2
+    out_file = Path(sys.argv[2])
+    headers_file = Path(sys.argv[3]) if len(sys.argv) == 4 else None
+    urls = [sys.argv[1]]
+    for url in parse_mirrors(os.getenv("XRAY_SUBSCRIPTION_MIRRORS", "")):
+        if url not in urls:
+            urls.append(url)
+    try:
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        fetcher = Fetcher.from_env()
+        try:
+            if len(urls) == 1:
+                result = fetcher.fetch(urls[0], out_file, headers_file)
+            else:
+                stats_path = os.getenv("XRAY_FETCH_MIRROR_STATS", DEFAULT_STATS_PATH).strip()
+                stats = MirrorStats(Path(stats_path) if stats_path else None)
+                try:
+                    result = fetch_mirrors(fetcher, urls, out_file, headers_file, stats)
+                finally:
+                    stats.save()
+        finally:
+            fetcher.close()
+    except Exception as exc:
+        print(f"fetch_subscription.py error: {exc}", file=sys.stderr)
+        return 1
+    mirror = f" from mirror {mirror_key(result.url)}" if len(urls) > 1 else ""
+    print(
+        f"INFO fetched {result.size} bytes (encoding={result.encoding}) in {result.elapsed:.2f}s{mirror}",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
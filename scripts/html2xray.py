@@ -1,13 +1,34 @@
 #!/usr/bin/env python3
 import base64
 import html
+import itertools
 import json
 import os
 import re
 import sys
 import urllib.parse
-
-SUPPORTED_SCHEMES = ("vless://", "vmess://", "trojan://", "ss://", "ssr://")
+from pathlib import Path
+
+import parse_cache
+import provider_formats
+import xray_json
+
+try:
+    import xray_metrics
+except ImportError:  # pragma: no cover - metrics module not deployed
+    xray_metrics = None
+
+SUPPORTED_SCHEMES = (
+    "vless://",
+    "vmess://",
+    "trojan://",
+    "ss://",
+    "ssr://",
+    "wireguard://",
+    "wg://",
+)
+# Recognized so they are reported instead of silently dropped; Xray-core cannot dial them.
+UNSUPPORTED_SCHEMES = ("hysteria2://", "hy2://", "hysteria://", "tuic://")
 TRAILING_JUNK = ")]},.;'\""
 
 
@@ -140,6 +161,98 @@ def parse_ssr(uri: str) -> dict:
     }
 
 
+def _first_value(q: dict, vmess: dict | None, *keys: str) -> str:
+    for key in keys:
+        if q.get(key):
+            return q[key]
+    if vmess:
+        for key in keys:
+            if vmess.get(key):
+                return str(vmess[key])
+    return ""
+
+
+def _int_params(q: dict, keys: tuple) -> dict:
+    values = {}
+    for key in keys:
+        raw = q.get(key)
+        if raw not in (None, ""):
+            values[key] = int(raw)
+    return values
+
+
+def _wg_key(value: str, field: str) -> str:
+    # Query parsing turns an unescaped "+" into a space.
+    key = value.strip().replace(" ", "+")
+    try:
+        raw = base64.b64decode(b64pad(key), validate=True)
+    except ValueError:
+        raw = b""
+    if len(raw) != 32:
+        raise ValueError(f"WireGuard {field} must be a base64-encoded 32-byte key")
+    return key
+
+
+def _wg_reserved(value: str) -> list[int]:
+    value = value.strip()
+    if not value:
+        return []
+    if "," in value or value.isdigit():
+        reserved = [int(part) for part in value.split(",") if part.strip()]
+    else:
+        reserved = list(b64d(value))
+    if len(reserved) != 3 or any(not 0 <= b <= 255 for b in reserved):
+        raise ValueError("WireGuard reserved must be three bytes")
+    return reserved
+
+
+def _csv(value: str) -> list[str]:
+    return [part.strip() for part in value.split(",") if part.strip()]
+
+
+def parse_wireguard(uri: str) -> dict:
+    # wireguard://<private key>@host:port?publickey=...&address=...&reserved=...&mtu=...#name
+    # Parsed by hand: base64 keys may contain unescaped "/" and "+".
+    rest = uri.split("://", 1)[1]
+    rest, _, fragment = rest.partition("#")
+    rest, _, query = rest.partition("?")
+    userinfo, _, hostport = rest.rpartition("@")
+    u = urllib.parse.urlsplit("//" + hostport.rstrip("/"))
+    q = {k.lower(): v for k, v in urllib.parse.parse_qsl(query, keep_blank_values=True)}
+
+    secret = urllib.parse.unquote(userinfo) or q.get("privatekey") or q.get("secretkey") or ""
+    public_key = q.get("publickey") or q.get("peer_public_key") or ""
+    if not u.hostname or not u.port:
+        raise ValueError("WireGuard link needs host:port")
+    mtu = q.get("mtu") or ""
+    keepalive = q.get("keepalive") or q.get("persistentkeepalive") or ""
+    return check_wireguard_node(
+        {
+            "secret_key": secret,
+            "public_key": public_key,
+            "preshared_key": q.get("presharedkey") or q.get("psk") or "",
+            "host": u.hostname,
+            "port": int(u.port),
+            "address": _csv(q.get("address") or q.get("ip") or q.get("local_address") or ""),
+            "allowed_ips": _csv(q.get("allowedips") or "") or ["0.0.0.0/0", "::/0"],
+            "reserved": q.get("reserved") or "",
+            "mtu": int(mtu) if mtu else None,
+            "keepalive": int(keepalive) if keepalive else None,
+            "name": urllib.parse.unquote(fragment),
+        }
+    )
+
+
+def check_wireguard_node(node: dict) -> dict:
+    """Validate keys and decode reserved bytes of a parsed WireGuard node."""
+    node["secret_key"] = _wg_key(node["secret_key"], "private key")
+    node["public_key"] = _wg_key(node["public_key"], "public key")
+    if node["preshared_key"]:
+        node["preshared_key"] = _wg_key(node["preshared_key"], "preshared key")
+    node["reserved"] = _wg_reserved(node["reserved"])
+    return node
+
+
 def stream_settings_from_common(q: dict, vmess: dict | None = None) -> dict:
     network = (
         q.get("type") or q.get("net") or (vmess.get("net") if vmess else None) or "tcp"
@@ -155,21 +268,80 @@ def stream_settings_from_common(q: dict, vmess: dict | None = None) -> dict:
     else:
         sec = "tls" if security else "none"
 
+    # Aliases used by share links / older clients.
+    network = {"raw": "tcp", "mkcp": "kcp", "splithttp": "xhttp", "gun": "grpc"}.get(
+        network, network
+    )
+    if network in ("h2", "http", "quic"):
+        # Removed from Xray-core (replaced by XHTTP stream-one); such nodes cannot be dialed.
+        raise provider_formats.UnsupportedNode(f"transport '{network}' is not supported by Xray-core anymore")
+
     ss = {"network": network, "security": sec}
+    path = _first_value(q, vmess, "path")
+    host = _first_value(q, vmess, "host")
+    header_type = (q.get("headerType") or "").lower()
+
+    if network == "tcp" and header_type == "http":
+        request = {"path": [p for p in (path or "/").split(",") if p]}
+        if host:
+            request["headers"] = {"Host": [h for h in host.split(",") if h]}
+        ss["tcpSettings"] = {"header": {"type": "http", "request": request}}
 
     if network == "ws":
-        path = q.get("path") or (vmess.get("path") if vmess else None) or "/"
-        host = q.get("host") or (vmess.get("host") if vmess else None) or ""
         headers = {}
         if host:
             headers["Host"] = host
-        ss["wsSettings"] = {"path": path, "headers": headers}
+        ss["wsSettings"] = {"path": path or "/", "headers": headers}
+
+    if network == "httpupgrade":
+        upgrade = {"path": path or "/"}
+        if host:
+            upgrade["host"] = host
+        ss["httpupgradeSettings"] = upgrade
+
+    if network == "xhttp":
+        xhttp = {"path": path or "/"}
+        if host:
+            xhttp["host"] = host
+        mode = q.get("mode") or ""
+        if mode:
+            xhttp["mode"] = mode
+        extra = q.get("extra") or ""
+        if extra:
+            try:
+                parsed_extra = json.loads(extra)
+            except ValueError:
+                parsed_extra = None
+            if isinstance(parsed_extra, dict):
+                xhttp["extra"] = parsed_extra
+        ss["xhttpSettings"] = xhttp
+
+    if network == "kcp":
+        kcp = _int_params(
+            q,
+            ("mtu", "tti", "uplinkCapacity", "downlinkCapacity", "readBufferSize", "writeBufferSize"),
+        )
+        if q.get("congestion"):
+            kcp["congestion"] = q["congestion"].lower() in ("1", "true")
+        if header_type and header_type != "none":
+            kcp["header"] = {"type": header_type}
+        seed = q.get("seed") or ""
+        if seed:
+            kcp["seed"] = seed
+        ss["kcpSettings"] = kcp
 
     if network == "grpc":
         service_name = (
             q.get("serviceName") or (vmess.get("path") if vmess else "") or ""
         )
-        ss["grpcSettings"] = {"serviceName": service_name, "multiMode": False}
+        grpc = {
+            "serviceName": service_name,
+            "multiMode": (q.get("mode") or "").lower() == "multi",
+        }
+        authority = q.get("authority") or ""
+        if authority:
+            grpc["authority"] = authority
+        ss["grpcSettings"] = grpc
 
     sni = (
         q.get("sni")
@@ -252,12 +424,21 @@ def outbound_from_vmess(v: dict, tag: str) -> dict:
     uid = v.get("id") or ""
     aid = int(v.get("aid") or 0)
 
+    network = (v.get("net") or "tcp").lower()
     q = {
-        "type": v.get("net") or v.get("type") or "tcp",
+        "type": network,
         "host": v.get("host") or "",
         "path": v.get("path") or "/",
         "sni": v.get("sni") or v.get("servername") or "",
     }
+    # In vmess JSON "type" is the header type (tcp/kcp) or the gRPC mode.
+    header_type = (v.get("type") or "").lower()
+    if network == "grpc":
+        q["mode"] = header_type
+    elif header_type:
+        q["headerType"] = header_type
+    if network in ("kcp", "mkcp") and v.get("path"):
+        q["seed"] = v["path"]
     if (v.get("tls") or "").lower() in ("tls", "reality"):
         q["security"] = (v.get("tls") or "").lower()
 
@@ -302,7 +483,7 @@ def outbound_from_ssr(node: dict, tag: str) -> dict:
     proto = (node["proto"] or "").lower()
     obfs = (node["obfs"] or "").lower()
     if proto not in ("origin",) or obfs not in ("plain",):
-        raise ValueError(
+        raise provider_formats.UnsupportedNode(
             f"SSR requires plugins (proto={proto}, obfs={obfs}); cannot convert to native Xray"
         )
     return {
@@ -321,16 +502,42 @@ def outbound_from_ssr(node: dict, tag: str) -> dict:
     }
 
 
+def outbound_from_wireguard(node: dict, tag: str) -> dict:
+    host = node["host"]
+    endpoint = f"[{host}]:{node['port']}" if ":" in host else f"{host}:{node['port']}"
+    peer = {
+        "publicKey": node["public_key"],
+        "endpoint": endpoint,
+        "allowedIPs": node["allowed_ips"],
+    }
+    if node["preshared_key"]:
+        peer["preSharedKey"] = node["preshared_key"]
+    if node["keepalive"]:
+        peer["keepAlive"] = node["keepalive"]
+    settings = {
+        "secretKey": node["secret_key"],
+        "address": node["address"] or ["172.16.0.2/32"],
+        "peers": [peer],
+    }
+    if node["mtu"]:
+        settings["mtu"] = node["mtu"]
+    if node["reserved"]:
+        settings["reserved"] = node["reserved"]
+    return {"tag": tag, "protocol": "wireguard", "settings": settings}
+
+
 def extract_links(text: str) -> list[str]:
     text = html.unescape(text)
-    pattern = r'(?:vless|vmess|trojan|ssr|ss)://[^\s"\'<>]+'
+    pattern = (
+        r'(?:vless|vmess|trojan|ssr|ss|wireguard|wg|hysteria2|hysteria|hy2|tuic)://[^\s"\'<>]+'
+    )
     links = re.findall(pattern, text, flags=re.IGNORECASE)
     seen = set()
     out = []
     for l in links:
         l = l.strip().rstrip(TRAILING_JUNK)
         ll = l.lower()
-        if ll.startswith(SUPPORTED_SCHEMES):
+        if ll.startswith(SUPPORTED_SCHEMES + UNSUPPORTED_SCHEMES):
             key = ll
             if key not in seen:
                 seen.add(key)
@@ -338,7 +545,106 @@ def extract_links(text: str) -> list[str]:
     return out
 
 
-def build_config(links: list[str]) -> dict:
+def parse_link(link: str) -> tuple[str, dict]:
+    ll = link.lower()
+    if ll.startswith("vless://"):
+        return "vless", parse_vless(link)
+    if ll.startswith("trojan://"):
+        return "trojan", parse_trojan(link)
+    if ll.startswith("vmess://"):
+        return "vmess", decode_vmess(link)
+    if ll.startswith("ss://"):
+        return "ss", parse_ss(link)
+    if ll.startswith("ssr://"):
+        return "ssr", parse_ssr(link)
+    if ll.startswith(("wireguard://", "wg://")):
+        return "wireguard", parse_wireguard(link)
+    scheme = ll.split("://", 1)[0]
+    raise provider_formats.UnsupportedNode(f"{scheme} is not supported by Xray-core")
+
+
+def parse_entry(entry) -> tuple[str, dict]:
+    """Share link, or a (source, entry) pair from provider_formats."""
+    if isinstance(entry, str):
+        return parse_link(entry)
+    kind, node = provider_formats.node_from_entry(*entry)
+    if kind == "wireguard":
+        node = check_wireguard_node(node)
+    return kind, node
+
+
+def _describe(entry) -> str:
+    if isinstance(entry, str):
+        return f"{entry[:32]}..."
+    return f"{entry[0]} {provider_formats.entry_name(*entry)}"
+
+
+OUTBOUND_BUILDERS = {
+    "vless": outbound_from_vless,
+    "trojan": outbound_from_trojan,
+    "vmess": outbound_from_vmess,
+    "ss": outbound_from_ss,
+    "ssr": outbound_from_ssr,
+    "wireguard": outbound_from_wireguard,
+}
+
+
+def build_outbound(entry, tag: str, cache=None) -> tuple[dict, str]:
+    """(outbound, node name) for a link/provider entry; reuses cached builds."""
+    key = parse_cache.entry_key(entry) if cache is not None else ""
+    cached = cache.get(key) if cache is not None else None
+    if cached is None:
+        try:
+            kind, node = parse_entry(entry)
+            outbound = OUTBOUND_BUILDERS[kind](node, tag)
+        except Exception as e:
+            if cache is not None:
+                failure = {"error": str(e)}
+                if isinstance(e, provider_formats.UnsupportedNode):
+                    failure["unsupported"] = True
+                cache.put(key, failure)
+            raise
+        name = str(node.get("name") or node.get("ps") or "")
+        if cache is not None:
+            cache.put(key, {"outbound": {k: v for k, v in outbound.items() if k != "tag"}, "name": name})
+        return outbound, name
+    if "error" in cached:
+        if cached.get("unsupported"):
+            raise provider_formats.UnsupportedNode(cached["error"])
+        raise ValueError(cached["error"])
+    return {"tag": tag, **cached["outbound"]}, cached.get("name") or ""
+
+
+def _iter_outbounds(links, cache, remarks, stats):
+    for i, link in enumerate(links, start=1):
+        tag = f"node{i}"
+        try:
+            outbound, name = build_outbound(link, tag, cache)
+        except Exception as e:
+            print(f"[WARN] skip {tag} ({_describe(link)}): {e}", file=sys.stderr)
+            if not isinstance(e, provider_formats.UnsupportedNode):
+                stats["errors"] += 1
+            continue
+        stats["ok"] += 1
+        if name:
+            remarks[tag] = name
+        yield outbound
+
+    yield {"tag": "direct", "protocol": "freedom", "settings": {}}
+    yield {"tag": "block", "protocol": "blackhole", "settings": {}}
+
+
+def build_config(links, cache=None, stream=False, stats=None) -> dict:
+    """Xray config for the given links / provider entries.
+
+    With stream=True "outbounds" is a generator for xray_json.write_config_stream:
+    nodes are parsed while the file is written and "remarks" is filled as a side
+    effect (it sorts after "outbounds", so it is complete when emitted). The
+    caller checks that at least one node was written.
+
+    stats, when given, receives "ok" (nodes built) and "errors" (entries that
+    failed to parse; nodes Xray-core cannot dial are skipped without counting).
+    """
     http_port = int(os.getenv("HTTP_PROXY_PORT", "3128"))
     socks_port = int(os.getenv("SOCKS_PROXY_PORT", "1080"))
 
@@ -357,38 +663,21 @@ def build_config(links: list[str]) -> dict:
         },
     ]
 
-    outbounds = []
-    ok = 0
-    for i, link in enumerate(links, start=1):
-        tag = f"node{i}"
-        try:
-            ll = link.lower()
-            if ll.startswith("vless://"):
-                outbounds.append(outbound_from_vless(parse_vless(link), tag))
-                ok += 1
-            elif ll.startswith("trojan://"):
-                outbounds.append(outbound_from_trojan(parse_trojan(link), tag))
-                ok += 1
-            elif ll.startswith("vmess://"):
-                outbounds.append(outbound_from_vmess(decode_vmess(link), tag))
-                ok += 1
-            elif ll.startswith("ss://"):
-                outbounds.append(outbound_from_ss(parse_ss(link), tag))
-                ok += 1
-            elif ll.startswith("ssr://"):
-                outbounds.append(outbound_from_ssr(parse_ssr(link), tag))
-                ok += 1
-        except Exception as e:
-            print(f"[WARN] skip {tag} ({link[:32]}...): {e}", file=sys.stderr)
-
-    if ok == 0:
-        raise SystemExit("No valid nodes parsed (all failed/unsupported)")
-
-    outbounds.append({"tag": "direct", "protocol": "freedom", "settings": {}})
-    outbounds.append({"tag": "block", "protocol": "blackhole", "settings": {}})
+    # Node display names (share-link remarks) by tag; compose_xray_config.py
+    # reads them for provider hints. Not part of the final Xray config.
+    remarks = {}
+    if stats is None:
+        stats = {}
+    stats.update(ok=0, errors=0)
+    outbounds = _iter_outbounds(links, cache, remarks, stats)
+    if not stream:
+        outbounds = list(outbounds)
+        if stats["ok"] == 0:
+            raise SystemExit("No valid nodes parsed (all failed/unsupported)")
 
     return {
         "log": {"loglevel": "info"},
+        "remarks": remarks,
         "inbounds": inbounds,
         "outbounds": outbounds,
         "routing": {
@@ -411,31 +700,74 @@ def main():
         )
         sys.exit(2)
     in_file, out_file = sys.argv[1], sys.argv[2]
-    text = open(in_file, "r", encoding="utf-8", errors="replace").read()
-    links = extract_links(text)
-
-    # Fallback: some providers return subscription as one base64 blob (list of links)
-    if not links:
-        candidate = text.strip()
-        # remove whitespace
-        candidate = re.sub(r"\s+", "", candidate)
-        # try base64 decode whole payload
+    found = 0
+    stats = {}
+    cache = parse_cache.from_env(__file__, provider_formats.__file__)
+
+    def counted(entries):
+        nonlocal found
+        for entry in entries:
+            found += 1
+            yield entry
+
+    # Clash/Mihomo YAML and sing-box JSON are streamed entry by entry.
+    entries = provider_formats.iter_provider_entries(in_file)
+    first = next(entries, None)
+    if first is not None:
+        cfg = build_config(counted(itertools.chain([first], entries)), cache, stream=True, stats=stats)
+    else:
+        text = open(in_file, "r", encoding="utf-8", errors="replace").read()
+        links = extract_links(text)
+
+        # Fallback: some providers return subscription as one base64 blob (list of links)
+        if not links:
+            candidate = text.strip()
+            # remove whitespace
+            candidate = re.sub(r"\s+", "", candidate)
+            # try base64 decode whole payload
+            try:
+                decoded = b64d(candidate).decode("utf-8", errors="replace")
+                links = extract_links(decoded)
+                if links:
+                    text = decoded
+            except Exception:
+                pass
+
+        if not links:
+            raise SystemExit(
+                "No vless/vmess/trojan/ss/ssr/wireguard links or Clash/sing-box proxies found"
+                " (direct or base64)"
+            )
+        cfg = build_config(counted(links), cache, stream=True, stats=stats)
+
+    written = 0
+
+    def counted_outbounds(outbounds):
+        nonlocal written
+        for outbound in outbounds:
+            written += 1
+            yield outbound
+
+    cfg["outbounds"] = counted_outbounds(cfg["outbounds"])
+    xray_json.write_config_stream(cfg, out_file)
+    outbounds_ok = written - 2
+    if outbounds_ok == 0:
+        os.unlink(out_file)
+        os.unlink(xray_json.digest_path_for(Path(out_file)))
+        raise SystemExit("No valid nodes parsed (all failed/unsupported)")
+    if cache is not None:
         try:
-            decoded = b64d(candidate).decode("utf-8", errors="replace")
-            links = extract_links(decoded)
-            if links:
-                text = decoded
-        except Exception:
-            pass
-
-    if not links:
-        raise SystemExit("No vless/vmess/trojan/ss/ssr links found (direct or base64)")
-
-    cfg = build_config(links)
-    with open(out_file, "w", encoding="utf-8") as f:
-        json.dump(cfg, f, ensure_ascii=False, indent=2)
+            cache.save()
+        except OSError as e:
+            print(f"[WARN] failed to save parse cache: {e}", file=sys.stderr)
+        print(f"[INFO] parse cache hits={cache.hits} misses={cache.misses}")
+    if xray_metrics is not None:
+        try:
+            xray_metrics.record_parse(found, stats["errors"])
+        except Exception as e:
+            print(f"[WARN] failed to record parse metrics: {e}", file=sys.stderr)
     print(
-        f"[OK] links_found={len(links)} outbounds_ok={len(cfg['outbounds'])-2} wrote={out_file}"
+        f"[OK] links_found={found} outbounds_ok={outbounds_ok} wrote={out_file}"
     )
 
 
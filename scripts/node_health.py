@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Persistent per-node health history built from Xray observatory results.
+
+Responsibilities:
+- Poll observatory status from Xray's metrics endpoint (expvar /debug/vars,
+  enabled by compose_xray_config.py via XRAY_STATS_LISTEN).
+- Map outbound tags (renumbered on every refresh) to a stable node identity
+  derived from protocol/server/credentials/transport.
+- Store RTT/failure samples in a compact on-disk ring buffer per node, one
+  per observatory probe (keyed by its last_try_time).
+- Summarize history for compose_xray_config.py (quarantine + ranking).
+
+File format (little-endian): header `XNH1` + u16 slots + u32 node count, then
+per node: 8-byte identity, u16 head, u16 count, `slots` x (u32 ts, u16 rtt_ms)
+where rtt_ms == 0xFFFF marks a failed probe.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+
+MAGIC = b"XNH1"
+HEADER = struct.Struct("<4sHI")
+NODE_HEADER = struct.Struct("<8sHH")
+SAMPLE = struct.Struct("<IH")
+FAILED_RTT = 0xFFFF
+DEFAULT_SLOTS = 64
+DEFAULT_DB_PATH = "/var/log/xray/node-health.db"
+DEFAULT_API_URL = "http://127.0.0.1:11111/debug/vars"
+DEFAULT_CONFIG_PATH = "/etc/xray/config.json"
+STALE_NODE_SEC = 7 * 86400
+IGNORED_PROXY_PROTOCOLS = {"freedom", "blackhole", "dns", "loopback"}
+
+
+def _first_server(outbound: dict) -> dict:
+    settings = outbound.get("settings") or {}
+    for key in ("vnext", "servers", "peers"):
+        servers = settings.get(key)
+        if isinstance(servers, list) and servers and isinstance(servers[0], dict):
+            return servers[0]
+    return settings if isinstance(settings, dict) else {}
+
+
+def node_identity(outbound: dict) -> bytes:
+    """Stable 8-byte identity of a proxy outbound (independent of its tag)."""
+    server = _first_server(outbound)
+    users = server.get("users")
+    user = users[0] if isinstance(users, list) and users and isinstance(users[0], dict) else {}
+    stream = outbound.get("streamSettings") or {}
+    key = [
+        outbound.get("protocol"),
+        server.get("address") or server.get("endpoint"),
+        server.get("port"),
+        user.get("id") or server.get("password") or server.get("publicKey"),
+        stream.get("network"),
+        stream.get("security"),
+    ]
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8"))
+    return digest.digest()[:8]
+
+
+def proxy_identities(config: dict) -> dict[str, bytes]:
+    identities = {}
+    for outbound in config.get("outbounds") or []:
+        if not isinstance(outbound, dict):
+            continue
+        tag = outbound.get("tag")
+        if not tag or tag in ("direct", "block"):
+            continue
+        if outbound.get("protocol") in IGNORED_PROXY_PROTOCOLS:
+            continue
+        identities[tag] = node_identity(outbound)
+    return identities
+
+
+class HealthHistory:
+    def __init__(self, slots: int = DEFAULT_SLOTS):
+        if not 0 < slots < 65536:
+            raise ValueError("History slots must be in 1..65535")
+        self.slots = slots
+        # identity -> [head, count, [(ts, rtt_ms), ...]] (list is a fixed-size ring)
+        self.nodes: dict[bytes, list] = {}
+
+    def record(self, identity: bytes, ts: int, rtt_ms: int | None) -> None:
+        entry = self.nodes.get(identity)
+        if entry is None:
+            entry = [0, 0, [(0, 0)] * self.slots]
+            self.nodes[identity] = entry
+        value = FAILED_RTT if rtt_ms is None else max(0, min(FAILED_RTT - 1, int(rtt_ms)))
+        head, count, ring = entry
+        ring[head] = (int(ts), value)
+        entry[0] = (head + 1) % self.slots
+        entry[1] = min(self.slots, count + 1)
+
+    def samples(self, identity: bytes) -> list[tuple[int, int | None]]:
+        """Samples oldest-first; failed probes have rtt None."""
+        entry = self.nodes.get(identity)
+        if entry is None:
+            return []
+        head, count, ring = entry
+        start = (head - count) % self.slots
+        ordered = [ring[(start + i) % self.slots] for i in range(count)]
+        return [(ts, None if rtt == FAILED_RTT else rtt) for ts, rtt in ordered]
+
+    def last_timestamp(self, identity: bytes) -> int | None:
+        entry = self.nodes.get(identity)
+        if entry is None or not entry[1]:
+            return None
+        head, _, ring = entry
+        return ring[(head - 1) % self.slots][0]
+
+    def prune(self, now: int, max_age_sec: int = STALE_NODE_SEC) -> None:
+        for identity in list(self.nodes):
+            samples = self.samples(identity)
+            if not samples or now - samples[-1][0] > max_age_sec:
+                del self.nodes[identity]
+
+    def to_bytes(self) -> bytes:
+        chunks = [HEADER.pack(MAGIC, self.slots, len(self.nodes))]
+        for identity, (head, count, ring) in sorted(self.nodes.items()):
+            chunks.append(NODE_HEADER.pack(identity, head, count))
+            chunks.extend(SAMPLE.pack(ts, rtt) for ts, rtt in ring)
+        return b"".join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HealthHistory":
+        magic, slots, node_count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a node health history file")
+        history = cls(slots)
+        offset = HEADER.size
+        record_size = NODE_HEADER.size + SAMPLE.size * slots
+        if len(data) < offset + record_size * node_count:
+            raise ValueError("Truncated node health history file")
+        for _ in range(node_count):
+            identity, head, count = NODE_HEADER.unpack_from(data, offset)
+            offset += NODE_HEADER.size
+            ring = [SAMPLE.unpack_from(data, offset + i * SAMPLE.size) for i in range(slots)]
+            offset += SAMPLE.size * slots
+            history.nodes[identity] = [head % slots, min(count, slots), ring]
+        return history
+
+
+def load_history(path: Path, slots: int = DEFAULT_SLOTS) -> HealthHistory:
+    try:
+        return HealthHistory.from_bytes(path.read_bytes())
+    except FileNotFoundError:
+        return HealthHistory(slots)
+    except (ValueError, struct.error) as exc:
+        print(f"WARNING ignoring unreadable node health history {path}: {exc}", file=sys.stderr)
+        return HealthHistory(slots)
+
+
+def save_history(path: Path, history: HealthHistory) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            handle.write(history.to_bytes())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def summarize(samples: list[tuple[int, int | None]]) -> dict:
+    rtts = sorted(rtt for _, rtt in samples if rtt is not None)
+    failures = len(samples) - len(rtts)
+    recent_failures = 0
+    for _, rtt in reversed(samples):
+        if rtt is not None:
+            break
+        recent_failures += 1
+    return {
+        "samples": len(samples),
+        "failures": failures,
+        "fail_ratio": failures / len(samples) if samples else 0.0,
+        "recent_failures": recent_failures,
+        "median_rtt": statistics.median(rtts) if rtts else None,
+        "p90_rtt": rtts[min(len(rtts) - 1, int(len(rtts) * 0.9))] if rtts else None,
+    }
+
+
+def fetch_observatory(api_url: str, timeout: float = 5.0) -> dict[str, dict]:
+    with urllib.request.urlopen(api_url, timeout=timeout) as resp:
+        payload = json.loads(resp.read().decode("utf-8"))
+    observatory = payload.get("observatory") if isinstance(payload, dict) else None
+    if not isinstance(observatory, dict):
+        raise ValueError(f"No observatory data at {api_url} (is XRAY_STATS_LISTEN set?)")
+    return observatory
+
+
+def load_live_config(path: Path) -> dict:
+    """Read the committed config (single file or -confdir fragment set)."""
+    if path.is_dir():
+        merged: dict = {}
+        for fragment in sorted(path.glob("*.json")):
+            merged.update(json.loads(fragment.read_text(encoding="utf-8")))
+        return merged
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def collect_once(
+    history: HealthHistory,
+    identities: dict[str, bytes],
+    observatory: dict[str, dict],
+    now: int | None = None,
+) -> int:
+    now = int(time.time()) if now is None else now
+    recorded = 0
+    for tag, identity in identities.items():
+        status = observatory.get(tag)
+        if not isinstance(status, dict):
+            continue
+        # Polling faster than the observatory probes must not repeat its last
+        # result: a sample is keyed by the probe time and recorded once.
+        probed_at = status.get("last_try_time")
+        if isinstance(probed_at, (int, float)) and probed_at > 0:
+            ts = int(probed_at)
+            last = history.last_timestamp(identity)
+            if last is not None and ts <= last:
+                continue
+        else:
+            ts = now
+        alive = bool(status.get("alive"))
+        delay = status.get("delay")
+        rtt = int(delay) if alive and isinstance(delay, (int, float)) else None
+        history.record(identity, ts, rtt)
+        recorded += 1
+    history.prune(now)
+    return recorded
+
+
+def main() -> int:
+    usage = "Usage: node_health.py collect [--once] | show"
+    if len(sys.argv) < 2 or sys.argv[1] not in ("collect", "show"):
+        print(usage, file=sys.stderr)
+        return 2
+
+    db_path = Path(os.getenv("XRAY_HEALTH_DB", DEFAULT_DB_PATH))
+    config_path = Path(os.getenv("XRAY_HEALTH_CONFIG", DEFAULT_CONFIG_PATH))
+    api_url = os.getenv("XRAY_HEALTH_API_URL", DEFAULT_API_URL)
+    interval = float(os.getenv("XRAY_HEALTH_INTERVAL_SEC", "60"))
+
+    try:
+        if sys.argv[1] == "show":
+            history = load_history(db_path)
+            identities = proxy_identities(load_live_config(config_path))
+            for tag, identity in identities.items():
+                stats = summarize(history.samples(identity))
+                print(
+                    f"{tag:16} id={identity.hex()} samples={stats['samples']} "
+                    f"fail_ratio={stats['fail_ratio']:.2f} median_rtt={stats['median_rtt']}"
+                )
+            return 0
+
+        once = "--once" in sys.argv[2:]
+        cached_key = None
+        identities: dict[str, bytes] = {}
+        while True:
+            try:
+                st = os.stat(config_path)
+                key = (st.st_ino, st.st_mtime_ns, st.st_size)
+                if key != cached_key:
+                    identities = proxy_identities(load_live_config(config_path))
+                    cached_key = key
+                history = load_history(db_path)
+                recorded = collect_once(history, identities, fetch_observatory(api_url))
+                save_history(db_path, history)
+                if once:
+                    print(f"INFO recorded {recorded} node health samples into {db_path}")
+                    return 0
+            except Exception as exc:
+                if once:
+                    raise
+                print(f"WARNING node health collection failed: {exc}", file=sys.stderr)
+            time.sleep(interval)
+    except Exception as exc:
+        print(f"node_health.py error: {exc}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
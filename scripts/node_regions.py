@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Region detection for proxy nodes (used by compose_xray_config.py).
+
+Sources, in order of preference:
+- flag emoji in the node name (regional indicator pair, e.g. 🇩🇪 -> DE);
+- ISO 3166 alpha-2 country code token in the node name ("DE", "[US]");
+- optional local GeoIP lookup of the resolved server address
+  (XRAY_REGION_GEOIP_DB, MaxMind .mmdb; needs the maxminddb package);
+- optional RTT clusters from node health history (near/mid/far).
+
+Countries can be folded into named groups (XRAY_REGION_GROUPS="eu=DE,NL;us=US,CA").
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import socket
+
+try:
+    import maxminddb
+except ImportError:  # pragma: no cover - optional dependency
+    maxminddb = None
+
+
+ISO_COUNTRY_CODES = frozenset(
+    """
+    AD AE AF AG AI AL AM AO AQ AR AS AT AU AW AX AZ BA BB BD BE BF BG BH BI BJ BL BM BN BO BQ
+    BR BS BT BV BW BY BZ CA CC CD CF CG CH CI CK CL CM CN CO CR CU CV CW CX CY CZ DE DJ DK DM
+    DO DZ EC EE EG EH ER ES ET FI FJ FK FM FO FR GA GB GD GE GF GG GH GI GL GM GN GP GQ GR GS
+    GT GU GW GY HK HM HN HR HT HU ID IE IL IM IN IO IQ IR IS IT JE JM JO JP KE KG KH KI KM KN
+    KP KR KW KY KZ LA LB LC LI LK LR LS LT LU LV LY MA MC MD ME MF MG MH MK ML MM MN MO MP MQ
+    MR MS MT MU MV MW MX MY MZ NA NC NE NF NG NI NL NO NP NR NU NZ OM PA PE PF PG PH PK PL PM
+    PN PR PS PT PW PY QA RE RO RS RU RW SA SB SC SD SE SG SH SI SJ SK SL SM SN SO SR SS ST SV
+    SX SY SZ TC TD TF TG TH TJ TK TL TM TN TO TR TT TV TW TZ UA UG UM US UY UZ VA VC VE VG VI
+    VN VU WF WS YE YT ZA ZM ZW UK
+    """.split()
+)
+FLAG_RE = re.compile("([\U0001F1E6-\U0001F1FF])([\U0001F1E6-\U0001F1FF])")
+CODE_TOKEN_RE = re.compile(r"(?<![A-Za-z])([A-Z]{2})(?![A-Za-z])")
+REGION_LABEL_RE = re.compile(r"[^a-z0-9]")
+
+
+def sanitize_region(label: str) -> str:
+    return REGION_LABEL_RE.sub("", label.lower())
+
+
+def country_from_name(name: str) -> str | None:
+    match = FLAG_RE.search(name or "")
+    if match:
+        code = "".join(chr(ord(ch) - 0x1F1E6 + ord("A")) for ch in match.groups())
+        return "GB" if code == "UK" else code
+    for token in CODE_TOKEN_RE.findall(name or ""):
+        if token in ISO_COUNTRY_CODES:
+            return "GB" if token == "UK" else token
+    return None
+
+
+def parse_region_groups(raw: str) -> dict[str, str]:
+    """'eu=DE,NL;us=US' -> {'DE': 'eu', 'NL': 'eu', 'US': 'us'}."""
+    mapping = {}
+    for part in raw.split(";"):
+        group, sep, codes = part.partition("=")
+        group = sanitize_region(group)
+        if not sep or not group:
+            continue
+        for code in codes.split(","):
+            code = code.strip().upper()
+            if code:
+                mapping[code] = group
+    return mapping
+
+
+def server_address(outbound: dict) -> str | None:
+    settings = outbound.get("settings") or {}
+    for key in ("vnext", "servers", "peers"):
+        servers = settings.get(key)
+        if isinstance(servers, list) and servers and isinstance(servers[0], dict):
+            return servers[0].get("address") or servers[0].get("endpoint")
+    return settings.get("address") if isinstance(settings, dict) else None
+
+
+class GeoIPResolver:
+    def __init__(self, db_path: str):
+        if maxminddb is None:
+            raise ValueError("XRAY_REGION_GEOIP_DB is set but the maxminddb package is not installed")
+        self.reader = maxminddb.open_database(db_path)
+        self.cache: dict[str, str | None] = {}
+
+    def country(self, address: str) -> str | None:
+        host = address.rsplit(":", 1)[0] if address.count(":") == 1 else address
+        if host in self.cache:
+            return self.cache[host]
+        code = None
+        try:
+            infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+        except OSError:
+            infos = []
+        for info in infos:
+            record = self.reader.get(info[4][0])
+            if isinstance(record, dict):
+                country = record.get("country") or record.get("registered_country") or {}
+                code = country.get("iso_code")
+                if code:
+                    break
+        self.cache[host] = code
+        return code
+
+
+def rtt_cluster(median_rtt: float | None, bounds: list[float]) -> str | None:
+    if median_rtt is None:
+        return None
+    labels = ("near", "mid", "far")
+    for idx, bound in enumerate(bounds[: len(labels) - 1]):
+        if median_rtt <= bound:
+            return labels[idx]
+    return labels[min(len(bounds), len(labels) - 1)]
+
+
+def detect_regions(
+    tags: list[str],
+    outbounds_by_tag: dict[str, dict],
+    remarks: dict[str, str],
+    medians: dict[str, float | None] | None = None,
+) -> dict[str, str]:
+    """Return {tag: region} for every tag whose region could be determined."""
+    groups = parse_region_groups(os.getenv("XRAY_REGION_GROUPS", ""))
+    geoip_db = os.getenv("XRAY_REGION_GEOIP_DB", "").strip()
+    resolver = GeoIPResolver(geoip_db) if geoip_db else None
+    use_rtt = os.getenv("XRAY_REGION_RTT_CLUSTERS", "0").strip() in ("1", "true", "yes", "on")
+    bounds = [
+        float(v) for v in os.getenv("XRAY_REGION_RTT_BOUNDS", "80,200").split(",") if v.strip()
+    ]
+
+    regions = {}
+    for tag in tags:
+        country = country_from_name(remarks.get(tag) or tag)
+        if country is None and resolver is not None:
+            address = server_address(outbounds_by_tag.get(tag) or {})
+            if address:
+                country = resolver.country(address)
+        if country is not None:
+            regions[tag] = groups.get(country.upper()) or sanitize_region(country)
+            continue
+        if use_rtt and medians is not None:
+            cluster = rtt_cluster(medians.get(tag), bounds)
+            if cluster is not None:
+                regions[tag] = cluster
+    return regions
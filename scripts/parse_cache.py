@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Persistent parse cache for subscription entries (used by html2xray.py).
+
+Responsibilities:
+- Map sha256(normalized link or provider entry) -> built outbound without its
+  tag, plus the node name; failures are cached too, so broken links are not
+  re-parsed on every refresh.
+- Invalidate everything when the parser version changes (html2xray.py passes
+  a hash of the parser sources).
+- Keep at most XRAY_PARSE_CACHE_MAX entries, evicting least recently used.
+- Rewrite the cache file only when something was added, so an unchanged
+  subscription costs one load plus hashing.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+
+CACHE_FORMAT = 1
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def entry_key(entry) -> str:
+    """sha256 of a share link or a (source, entry) pair from provider_formats."""
+    if isinstance(entry, str):
+        payload = entry.strip()
+    else:
+        source, item = entry
+        body = item.strip() if isinstance(item, str) else json.dumps(item, sort_keys=True)
+        payload = f"{source}\n{body}"
+    return hashlib.sha256(payload.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+class ParseCache:
+    def __init__(self, path: Path, version: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.version = f"{CACHE_FORMAT}:{version}"
+        self.max_entries = max(1, max_entries)
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.used: list[str] = []
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return
+        except ValueError as exc:
+            print(f"[WARN] ignoring unreadable parse cache {self.path}: {exc}", file=sys.stderr)
+            return
+        if isinstance(data, dict) and data.get("version") == self.version:
+            self.entries = OrderedDict(data.get("entries") or {})
+
+    def get(self, key: str) -> dict | None:
+        cached = self.entries.get(key)
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append(key)
+        return cached
+
+    def put(self, key: str, value: dict) -> None:
+        self.entries[key] = value
+        self.used.append(key)
+
+    def save(self) -> None:
+        if not self.misses:
+            return
+        for key in self.used:
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(prefix=f".{self.path.name}.", suffix=".tmp", dir=str(self.path.parent))
+        tmp_path = Path(tmp_name)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as handle:
+                # json.dumps uses the C encoder; json.dump to a file does not.
+                handle.write(
+                    json.dumps(
+                        {"version": self.version, "entries": self.entries},
+                        ensure_ascii=False,
+                        separators=(",", ":"),
+                    )
+                )
+            os.replace(tmp_path, self.path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+
+def source_version(*paths: str) -> str:
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(Path(path).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def from_env(*parser_sources: str) -> ParseCache | None:
+    raw = os.getenv("XRAY_PARSE_CACHE", "").strip()
+    if not raw:
+        return None
+    max_entries = int(os.getenv("XRAY_PARSE_CACHE_MAX", str(DEFAULT_MAX_ENTRIES)))
+    return ParseCache(Path(raw), source_version(*parser_sources), max_entries)
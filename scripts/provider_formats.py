@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+"""
+Clash/Mihomo YAML and sing-box JSON subscription ingestion (used by html2xray.py).
+
+Responsibilities:
+- Stream proxy entries out of a provider file without loading the whole
+  document: Clash `proxies:` list items one at a time, sing-box top-level
+  `outbounds` array elements one at a time.
+- Convert each entry into the intermediate node dicts the share-link parsers
+  produce, so html2xray.py builds outbounds with the same outbound_from_*
+  builders (("vless", node), ("vmess", node), ...).
+- Parse YAML items with PyYAML when it is installed, otherwise with a small
+  built-in parser for the subset Clash profiles use (block/flow mappings,
+  lists, quoted and plain scalars).
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from typing import Iterator
+
+try:
+    import yaml
+except ImportError:  # pragma: no cover - optional dependency
+    yaml = None
+
+
+CHUNK_SIZE = 1 << 16
+CLASH_SECTION_RE = re.compile(r"^proxies:\s*(#.*)?$")
+# sing-box outbound types that are not proxy nodes.
+SINGBOX_NON_NODE_TYPES = ("direct", "block", "dns", "selector", "urltest")
+INT_RE = re.compile(r"^[-+]?\d+$")
+
+
+class UnsupportedNode(ValueError):
+    """A well-formed node Xray-core cannot dial: skipped on purpose, not a parse error."""
+
+
+# --- YAML -------------------------------------------------------------------
+
+
+def _strip_comment(line: str) -> str:
+    quote = ""
+    for idx, ch in enumerate(line):
+        if quote:
+            if ch == quote:
+                quote = ""
+        elif ch in "'\"":
+            quote = ch
+        elif ch == "#" and (idx == 0 or line[idx - 1] in " \t"):
+            return line[:idx].rstrip()
+    return line.rstrip()
+
+
+def _scalar(text: str):
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] == '"':
+        return json.loads(text)
+    if len(text) >= 2 and text[0] == text[-1] == "'":
+        return text[1:-1].replace("''", "'")
+    lowered = text.lower()
+    if lowered in ("", "~", "null"):
+        return None
+    if lowered in ("true", "false"):
+        return lowered == "true"
+    if INT_RE.match(text):
+        return int(text)
+    return text
+
+
+def _flow(text: str, pos: int = 0):
+    """Parse a YAML flow collection/scalar starting at pos; returns (value, end)."""
+    while pos < len(text) and text[pos] in " \t":
+        pos += 1
+    if pos < len(text) and text[pos] in "{[":
+        closing = "}" if text[pos] == "{" else "]"
+        is_map = closing == "}"
+        result: dict | list = {} if is_map else []
+        pos += 1
+        while True:
+            while pos < len(text) and text[pos] in " \t,":
+                pos += 1
+            if pos >= len(text):
+                raise ValueError("unterminated YAML flow collection")
+            if text[pos] == closing:
+                return result, pos + 1
+            if is_map:
+                key, pos = _flow_token(text, pos, ":")
+                if pos >= len(text) or text[pos] != ":":
+                    raise ValueError(f"expected ':' after YAML key {key!r}")
+                value, pos = _flow(text, pos + 1)
+                result[str(_scalar(key))] = value
+            else:
+                value, pos = _flow(text, pos)
+                result.append(value)
+    token, pos = _flow_token(text, pos, "")
+    return _scalar(token), pos
+
+
+def _flow_token(text: str, pos: int, stop: str) -> tuple[str, int]:
+    start = pos
+    if pos < len(text) and text[pos] in "'\"":
+        quote = text[pos]
+        pos += 1
+        while pos < len(text):
+            if text[pos] == "\\" and quote == '"':
+                pos += 2
+                continue
+            if text[pos] == quote:
+                if quote == "'" and text[pos + 1 : pos + 2] == "'":
+                    pos += 2
+                    continue
+                break
+            pos += 1
+        pos += 1
+        token = text[start:pos]
+        while pos < len(text) and text[pos] in " \t":
+            pos += 1
+        return token, pos
+    while pos < len(text) and text[pos] not in ",]}":
+        # A key ends at ": "; plain values may contain ':' (URLs, IPv6).
+        if stop and text[pos] == stop and (pos + 1 >= len(text) or text[pos + 1] in " \t,]}"):
+            break
+        pos += 1
+    return text[start:pos].strip(), pos
+
+
+def _split_key(text: str) -> tuple[str, str] | None:
+    if text[:1] in "{[":
+        return None
+    quote = ""
+    for idx, ch in enumerate(text):
+        if quote:
+            if ch == quote:
+                quote = ""
+        elif ch in "'\"" and idx == 0:
+            quote = ch
+        elif ch == ":" and (idx + 1 == len(text) or text[idx + 1] in " \t"):
+            return str(_scalar(text[:idx])), text[idx + 1 :].strip()
+    return None
+
+
+def _value(rest: str):
+    return _flow(rest)[0] if rest[:1] in "{[" else _scalar(rest)
+
+
+def _block(lines: list[tuple[int, str]], i: int, indent: int):
+    if lines[i][1].startswith("-"):
+        return _block_list(lines, i, indent)
+    return _block_map(lines, i, indent)
+
+
+def _nested(lines: list[tuple[int, str]], i: int, indent: int):
+    # Value on the following lines: deeper block, or a list at the key's indent.
+    if i < len(lines) and (
+        lines[i][0] > indent or (lines[i][0] == indent and lines[i][1].startswith("- "))
+    ):
+        return _block(lines, i, lines[i][0])
+    return None, i
+
+
+def _block_map(lines: list[tuple[int, str]], i: int, indent: int):
+    result = {}
+    while i < len(lines) and lines[i][0] == indent and not lines[i][1].startswith("- "):
+        pair = _split_key(lines[i][1])
+        if pair is None:
+            raise ValueError(f"cannot parse YAML line: {lines[i][1]!r}")
+        key, rest = pair
+        i += 1
+        if rest:
+            result[key] = _value(rest)
+        else:
+            result[key], i = _nested(lines, i, indent)
+    return result, i
+
+
+def _block_list(lines: list[tuple[int, str]], i: int, indent: int):
+    result = []
+    while i < len(lines) and lines[i][0] == indent and lines[i][1].startswith("-"):
+        rest = lines[i][1][1:].lstrip()
+        if not rest:
+            i += 1
+            value = None
+            if i < len(lines) and lines[i][0] > indent:
+                value, i = _block(lines, i, lines[i][0])
+        elif _split_key(rest) is not None:
+            # "- key: value" opens a mapping whose keys align with "key".
+            child_indent = indent + len(lines[i][1]) - len(rest)
+            lines[i] = (child_indent, rest)
+            value, i = _block_map(lines, i, child_indent)
+        else:
+            value, i = _value(rest), i + 1
+        result.append(value)
+    return result, i
+
+
+def parse_yaml_item(text: str) -> dict:
+    """Parse one Clash list item ("- name: ...", "- {name: ..., ...}")."""
+    if yaml is not None:
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        value = yaml.load(text, Loader=loader)
+        return value[0] if isinstance(value, list) and value else value
+    lines = []
+    for raw in text.splitlines():
+        line = _strip_comment(raw)
+        if line.strip():
+            lines.append((len(line) - len(line.lstrip(" ")), line.strip()))
+    if not lines:
+        return {}
+    if lines[0][1].lstrip("- ").startswith("{"):
+        # Flow mapping, possibly wrapped over several lines.
+        return _flow(" ".join(line for _, line in lines).lstrip("- "))[0]
+    value, _ = _block_list(lines, 0, lines[0][0])
+    return value[0] if value else {}
+
+
+def iter_clash_proxies(path: str) -> Iterator[str]:
+    """Yield the raw text of Clash `proxies:` list items one by one."""
+    with open(path, "r", encoding="utf-8", errors="replace") as handle:
+        for line in handle:
+            if CLASH_SECTION_RE.match(line.rstrip("\r\n")):
+                break
+        else:
+            return
+        item: list[str] = []
+        item_indent = None
+        for line in handle:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                if item:
+                    item.append(line)
+                continue
+            indent = len(line) - len(line.lstrip(" "))
+            if item_indent is None:
+                if not stripped.startswith("-"):
+                    return
+                item_indent = indent
+            if indent < item_indent or (indent == item_indent and not stripped.startswith("-")):
+                break
+            if indent == item_indent and item:
+                yield "".join(item)
+                item = []
+            item.append(line)
+        if item:
+            yield "".join(item)
+
+
+# --- sing-box JSON ----------------------------------------------------------
+
+
+class _JsonReader:
+    def __init__(self, handle):
+        self.handle = handle
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.handle.read(max(CHUNK_SIZE, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return bool(chunk)
+
+    def peek(self) -> str:
+        while self.pos >= len(self.buf):
+            if not self.fill():
+                return ""
+        return self.buf[self.pos]
+
+    def skip(self, chars: str) -> str:
+        while True:
+            ch = self.peek()
+            if not ch or ch not in chars:
+                return ch
+            self.pos += 1
+
+    def decode(self, decoder: json.JSONDecoder):
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A value ending exactly at the buffer end may be a truncated number/literal.
+            if end == len(self.buf) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def _seek_top_level_key(reader: _JsonReader, key: str) -> bool:
+    """Advance to the value of a top-level object key; False when absent."""
+    if reader.skip(" \t\r\n") != "{":
+        return False
+    decoder = json.JSONDecoder()
+    reader.pos += 1
+    while True:
+        ch = reader.skip(" \t\r\n,")
+        if ch != '"':
+            return False
+        name = reader.decode(decoder)
+        if reader.skip(" \t\r\n") != ":":
+            return False
+        reader.pos += 1
+        reader.skip(" \t\r\n")
+        if name == key:
+            return True
+        reader.decode(decoder)
+
+
+def iter_singbox_outbounds(path: str) -> Iterator[dict]:
+    """Yield proxy entries of a sing-box config's top-level `outbounds` array."""
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8", errors="replace") as handle:
+        reader = _JsonReader(handle)
+        if not _seek_top_level_key(reader, "outbounds") or reader.peek() != "[":
+            return
+        reader.pos += 1
+        while True:
+            ch = reader.skip(" \t\r\n,")
+            if ch in ("]", ""):
+                return
+            entry = reader.decode(decoder)
+            if isinstance(entry, dict) and entry.get("type") not in SINGBOX_NON_NODE_TYPES:
+                yield entry
+
+
+def iter_provider_entries(path: str) -> Iterator[tuple[str, dict | str]]:
+    """("singbox", outbound) / ("clash", item text) pairs; empty for share-link subscriptions.
+
+    Clash items are parsed lazily (node_from_entry), so one malformed item only
+    skips that node.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as handle:
+        head = handle.read(1024).lstrip("\ufeff \t\r\n")
+    if head.startswith("{"):
+        for entry in iter_singbox_outbounds(path):
+            yield "singbox", entry
+        return
+    for entry in iter_clash_proxies(path):
+        yield "clash", entry
+
+
+# --- entry -> share-link node dicts -----------------------------------------
+
+
+def _str(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, list):
+        return ",".join(str(v) for v in value)
+    return str(value)
+
+
+def _port(value) -> int:
+    port = int(value)
+    if not 0 < port < 65536:
+        raise ValueError(f"invalid port {value!r}")
+    return port
+
+
+def _header_host(headers) -> str:
+    if not isinstance(headers, dict):
+        return ""
+    return _str(headers.get("Host") or headers.get("host"))
+
+
+def _clash_query(p: dict) -> dict:
+    network = _str(p.get("network") or "tcp").lower()
+    q = {"type": network}
+    reality = p.get("reality-opts") or {}
+    if reality:
+        q["security"] = "reality"
+        q["pbk"] = _str(reality.get("public-key"))
+        q["sid"] = _str(reality.get("short-id"))
+    elif p.get("tls") or p.get("type") == "trojan":
+        q["security"] = "tls"
+    q["sni"] = _str(p.get("servername") or p.get("sni"))
+    q["fp"] = _str(p.get("client-fingerprint"))
+    q["alpn"] = _str(p.get("alpn"))
+    q["flow"] = _str(p.get("flow"))
+
+    if network == "ws":
+        opts = p.get("ws-opts") or {}
+        q["path"] = _str(opts.get("path"))
+        q["host"] = _header_host(opts.get("headers"))
+        if opts.get("v2ray-http-upgrade"):
+            q["type"] = "httpupgrade"
+    elif network == "grpc":
+        q["serviceName"] = _str((p.get("grpc-opts") or {}).get("grpc-service-name"))
+    elif network == "http":
+        # Clash "http" is raw TCP with the HTTP header obfuscation.
+        opts = p.get("http-opts") or {}
+        q["type"] = "tcp"
+        q["headerType"] = "http"
+        q["path"] = _str(opts.get("path") or "/")
+        headers = opts.get("headers") or {}
+        q["host"] = _str(headers.get("Host") or headers.get("host"))
+    elif network == "h2":
+        opts = p.get("h2-opts") or {}
+        q["path"] = _str(opts.get("path"))
+        q["host"] = _str(opts.get("host"))
+    return {k: v for k, v in q.items() if v}
+
+
+def _wireguard_node(
+    name: str,
+    host: str,
+    port,
+    private_key,
+    public_key,
+    preshared_key,
+    address: list,
+    allowed_ips,
+    reserved,
+    mtu,
+    keepalive,
+) -> dict:
+    if isinstance(reserved, list):
+        reserved = ",".join(str(b) for b in reserved)
+    if isinstance(allowed_ips, str):
+        allowed_ips = [allowed_ips]
+    return {
+        "name": name,
+        "host": _str(host),
+        "port": _port(port),
+        "secret_key": _str(private_key),
+        "public_key": _str(public_key),
+        "preshared_key": _str(preshared_key),
+        "address": [a for a in address if a],
+        "allowed_ips": list(allowed_ips or []) or ["0.0.0.0/0", "::/0"],
+        "reserved": _str(reserved),
+        "mtu": int(mtu) if mtu else None,
+        "keepalive": int(keepalive) if keepalive else None,
+    }
+
+
+def node_from_clash(p: dict) -> tuple[str, dict]:
+    kind = _str(p.get("type")).lower()
+    name = _str(p.get("name"))
+    host = _str(p.get("server"))
+    if kind == "vless":
+        return "vless", {"id": _str(p.get("uuid")), "host": host, "port": _port(p.get("port")),
+                         "q": _clash_query(p), "name": name}
+    if kind == "trojan":
+        return "trojan", {"password": _str(p.get("password")), "host": host,
+                          "port": _port(p.get("port")), "q": _clash_query(p), "name": name}
+    if kind == "vmess":
+        q = _clash_query(p)
+        return "vmess", {
+            "ps": name,
+            "add": host,
+            "port": _port(p.get("port")),
+            "id": _str(p.get("uuid")),
+            "aid": int(p.get("alterId") or 0),
+            "net": q.get("type", "tcp"),
+            "type": q.get("headerType", ""),
+            "host": q.get("host", ""),
+            "path": q.get("path") or q.get("serviceName") or "",
+            "tls": q.get("security", ""),
+            "sni": q.get("sni", ""),
+        }
+    if kind == "ss":
+        if p.get("plugin"):
+            raise UnsupportedNode(f"shadowsocks plugin '{p['plugin']}' is not supported by Xray-core")
+        return "ss", {"method": _str(p.get("cipher")), "password": _str(p.get("password")),
+                      "host": host, "port": _port(p.get("port")), "name": name}
+    if kind == "wireguard":
+        peer = (p.get("peers") or [p])[0]
+        return "wireguard", _wireguard_node(
+            name,
+            peer.get("server") or host,
+            peer.get("port") or p.get("port"),
+            p.get("private-key"),
+            peer.get("public-key"),
+            peer.get("pre-shared-key"),
+            [_str(p.get("ip")), _str(p.get("ipv6"))],
+            peer.get("allowed-ips"),
+            peer.get("reserved") or p.get("reserved"),
+            p.get("mtu"),
+            p.get("persistent-keepalive"),
+        )
+    raise UnsupportedNode(f"Clash proxy type '{kind}' is not supported by Xray-core")
+
+
+def _singbox_query(o: dict) -> dict:
+    transport = o.get("transport") or {}
+    network = _str(transport.get("type") or "tcp").lower()
+    q = {"type": network}
+    tls = o.get("tls") or {}
+    if tls.get("enabled"):
+        reality = tls.get("reality") or {}
+        if reality.get("enabled"):
+            q["security"] = "reality"
+            q["pbk"] = _str(reality.get("public_key"))
+            q["sid"] = _str(reality.get("short_id"))
+        else:
+            q["security"] = "tls"
+        q["sni"] = _str(tls.get("server_name"))
+        q["alpn"] = _str(tls.get("alpn"))
+        utls = tls.get("utls") or {}
+        if utls.get("enabled"):
+            q["fp"] = _str(utls.get("fingerprint") or "chrome")
+    q["flow"] = _str(o.get("flow"))
+    if network in ("ws", "httpupgrade"):
+        q["path"] = _str(transport.get("path"))
+        q["host"] = _str(transport.get("host")) or _header_host(transport.get("headers"))
+    elif network == "grpc":
+        q["serviceName"] = _str(transport.get("service_name"))
+    elif network == "http":
+        # sing-box "http" is HTTP/2 with TLS; Xray-core removed that transport.
+        q["type"] = "h2"
+    return {k: v for k, v in q.items() if v}
+
+
+def node_from_singbox(o: dict) -> tuple[str, dict]:
+    kind = _str(o.get("type")).lower()
+    name = _str(o.get("tag"))
+    host = _str(o.get("server"))
+    port = o.get("server_port")
+    if kind == "vless":
+        return "vless", {"id": _str(o.get("uuid")), "host": host, "port": _port(port),
+                         "q": _singbox_query(o), "name": name}
+    if kind == "trojan":
+        return "trojan", {"password": _str(o.get("password")), "host": host,
+                          "port": _port(port), "q": _singbox_query(o), "name": name}
+    if kind == "vmess":
+        q = _singbox_query(o)
+        return "vmess", {
+            "ps": name,
+            "add": host,
+            "port": _port(port),
+            "id": _str(o.get("uuid")),
+            "aid": int(o.get("alter_id") or 0),
+            "net": q.get("type", "tcp"),
+            "type": "",
+            "host": q.get("host", ""),
+            "path": q.get("path") or q.get("serviceName") or "",
+            "tls": q.get("security", ""),
+            "sni": q.get("sni", ""),
+        }
+    if kind == "shadowsocks":
+        if o.get("plugin"):
+            raise UnsupportedNode(f"shadowsocks plugin '{o['plugin']}' is not supported by Xray-core")
+        return "ss", {"method": _str(o.get("method")), "password": _str(o.get("password")),
+                      "host": host, "port": _port(port), "name": name}
+    if kind == "wireguard":
+        peer = (o.get("peers") or [o])[0]
+        return "wireguard", _wireguard_node(
+            name,
+            peer.get("server") or host,
+            peer.get("server_port") or port,
+            o.get("private_key"),
+            peer.get("public_key") or o.get("peer_public_key"),
+            peer.get("pre_shared_key"),
+            list(o.get("local_address") or []),
+            peer.get("allowed_ips"),
+            peer.get("reserved") or o.get("reserved"),
+            o.get("mtu"),
+            None,
+        )
+    raise UnsupportedNode(f"sing-box outbound type '{kind}' is not supported by Xray-core")
+
+
+def entry_name(source: str, entry: dict | str) -> str:
+    if isinstance(entry, str):
+        return entry.strip().splitlines()[0][:48] if entry.strip() else "?"
+    return _str(entry.get("tag") or entry.get("name")) or "?"
+
+
+def node_from_entry(source: str, entry: dict | str) -> tuple[str, dict]:
+    if source == "clash":
+        proxy = parse_yaml_item(entry) if isinstance(entry, str) else entry
+        if not isinstance(proxy, dict):
+            raise ValueError("Clash proxy entry is not a mapping")
+        return node_from_clash(proxy)
+    return node_from_singbox(entry)
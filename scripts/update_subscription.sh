@@ -1,23 +1,40 @@
 #!/bin/sh
 # update_subscription.sh
-# - Downloads XRAY_SUBSCRIPTION_URL payload
-# - If payload is full Xray JSON (has .inbounds and .outbounds) -> use as source
-# - Else (HTML / text / base64 subscription) -> extract links via html2xray.py and generate source Xray config
+# - Downloads XRAY_SUBSCRIPTION_URL payload via fetch_subscription.py (streaming, compression, budgets,
+#   hedged requests across XRAY_SUBSCRIPTION_MIRRORS)
+# - If payload is full Xray JSON (has .inbounds and Xray-style .outbounds) -> use as source
+# - Else (HTML / text / base64 links, Clash/Mihomo YAML, sing-box JSON) -> convert via html2xray.py
 # - Compose final local config via compose_xray_config.py (gateway/routing/bypass policy)
 # - Applies config via single-writer pipeline (lock + validation + atomic replace)
 # - Logs to stdout + /var/log/xray/updater.log (best-effort)
+# - Records Prometheus metrics via xray_metrics.py when XRAY_METRICS_DIR is set (best-effort)
 
 set -eu
 
 LOG_FILE="/var/log/xray/updater.log"
 TARGET_CONFIG="/etc/xray/config.json"
 DOWNLOAD_FILE="/tmp/subscription.body"
+# Response headers are kept for updater_daemon.py (profile-update-interval / Retry-After hints)
+HEADERS_FILE="${SUB_UPDATE_HEADERS_FILE:-/tmp/subscription.headers}"
 WORK_CONFIG="/tmp/new-config.json"
 FINAL_CONFIG="/tmp/new-config.final.json"
+# sha256 sidecars written next to streamed configs (see xray_json.write_config_stream)
+CONFIG_DIGESTS="/tmp/.new-config.json.sha256 /tmp/.new-config.final.json.sha256"
 APPLY_SCRIPT="/scripts/apply_xray_config.py"
+FETCH_SCRIPT="/scripts/fetch_subscription.py"
+CONFIG_TOOL="/scripts/config_tool.py"
+METRICS_SCRIPT="/scripts/xray_metrics.py"
 RAW_SUBSCRIPTION_DIR="/var/log/xray/raw"
 RAW_SUBSCRIPTION_FILE="$RAW_SUBSCRIPTION_DIR/subscription.raw"
 SAVE_RAW_SUBSCRIPTION="${XRAY_SAVE_RAW_SUBSCRIPTION:-0}"
+CONFIG_FRAGMENTS="${XRAY_CONFIG_FRAGMENTS:-0}"
+
+# Fragment mode: compose writes a directory of -confdir fragments and the apply
+# pipeline commits it to XRAY_CONFDIR (symlink to an immutable generation).
+if [ "$CONFIG_FRAGMENTS" = "1" ]; then
+  TARGET_CONFIG="${XRAY_CONFDIR:-/etc/xray/conf.d}"
+  FINAL_CONFIG="/tmp/new-config.final.d"
+fi
 
 log() {
   msg="$(date '+%Y-%m-%d %H:%M:%S') $1"
@@ -33,11 +50,24 @@ require_bin() {
   fi
 }
 
-# Ensure required tools exist in container
-require_bin curl
-require_bin jq
+record_update_metrics() {
+  rc="$1"
+  if [ -z "${XRAY_METRICS_DIR:-}" ] || [ -z "${UPDATE_STARTED_AT:-}" ] || [ ! -f "$METRICS_SCRIPT" ]; then
+    return 0
+  fi
+  status="ok"
+  [ "$rc" -eq 0 ] || status="error"
+  python3 "$METRICS_SCRIPT" update "$UPDATE_STARTED_AT" "$status" >/dev/null 2>&1 || \
+    log "WARNING Failed to record update metrics"
+}
+
+trap 'record_update_metrics $?' EXIT
+
+# Ensure required tools exist in container (no curl/jq: fetching and JSON checks are in Python)
 require_bin python3
 
+UPDATE_STARTED_AT="$(python3 -c 'import time; print(time.time())')"
+
 if [ ! -f "$APPLY_SCRIPT" ]; then
   log "ERROR Apply pipeline script not found: $APPLY_SCRIPT"
   exit 1
@@ -50,33 +80,28 @@ fi
 
 # Download
 log "INFO Downloading subscription"
-if ! curl -fsSL --connect-timeout 10 --max-time 60 -o "$DOWNLOAD_FILE" "$XRAY_SUBSCRIPTION_URL"; then
+if ! python3 "$FETCH_SCRIPT" "$XRAY_SUBSCRIPTION_URL" "$DOWNLOAD_FILE" "$HEADERS_FILE"; then
   log "ERROR Failed to download subscription"
   exit 1
 fi
 
-# Decide mode: full JSON vs. "links" (HTML/text/base64/etc.)
-if jq -e '.inbounds and .outbounds' "$DOWNLOAD_FILE" >/dev/null 2>&1; then
+# Decide mode: full Xray JSON vs. everything html2xray.py converts.
+# sing-box configs also have inbounds/outbounds, but their outbounds use "type", not "protocol".
+if python3 "$CONFIG_TOOL" is-xray "$DOWNLOAD_FILE" 2>/dev/null; then
   log "INFO Full Xray JSON detected; normalizing inbound ports"
 
-  jq \
-    --argjson http_port "${HTTP_PROXY_PORT:-3128}" \
-    --argjson socks_port "${SOCKS_PROXY_PORT:-1080}" \
-    '
-    .inbounds |= map(
-      if .protocol == "http" then .port = $http_port
-      elif .protocol == "socks" then .port = $socks_port
-      else .
-      end
-    )
-    ' "$DOWNLOAD_FILE" > "$WORK_CONFIG"
+  if ! python3 "$CONFIG_TOOL" normalize-ports "$DOWNLOAD_FILE" "$WORK_CONFIG"; then
+    log "ERROR Failed to normalize inbound ports; keep current config"
+    exit 1
+  fi
 
 else
-  log "INFO Not a full Xray JSON; trying to extract links (html/text/base64) and generate Xray config"
+  log "INFO Not a full Xray JSON; converting provider format (links/base64/Clash/sing-box) to Xray config"
 
   # html2xray.py MUST accept: <input_file> <output_file>
   # It should:
-  # - extract vless/vmess/trojan/ss/ssr links from HTML/text
+  # - stream Clash/Mihomo `proxies:` or sing-box `outbounds` entries when present
+  # - else extract vless/vmess/trojan/ss/ssr/wireguard links from HTML/text
   # - if none found, try base64-decode whole payload and extract again
   # - write a FULL Xray JSON config with inbounds/outbounds to output_file
   if ! python3 /scripts/html2xray.py "$DOWNLOAD_FILE" "$WORK_CONFIG"; then
@@ -86,7 +111,7 @@ else
 fi
 
 # Validate generated JSON before replacing config
-if ! jq -e '.inbounds and .outbounds' "$WORK_CONFIG" >/dev/null 2>&1; then
+if ! python3 "$CONFIG_TOOL" require "$WORK_CONFIG" inbounds outbounds >/dev/null 2>&1; then
   log "ERROR Generated config is not a valid full Xray config (missing inbounds/outbounds); keep current config"
   # Show last bytes for debugging (best-effort, no secrets beyond structure)
   tail -c 200 "$WORK_CONFIG" | tr '\n' ' ' | tr -d '\r' | sed 's/[^[:print:]]/?/g' 1>&2 || true
@@ -100,22 +125,36 @@ if ! python3 /scripts/compose_xray_config.py "$WORK_CONFIG" "$FINAL_CONFIG"; the
 fi
 
 # Ensure final config is valid
-if ! jq -e '.inbounds and .outbounds and .routing' "$FINAL_CONFIG" >/dev/null 2>&1; then
-  log "ERROR Final config is invalid (missing inbounds/outbounds/routing); keep current config"
-  tail -c 200 "$FINAL_CONFIG" | tr '\n' ' ' | tr -d '\r' | sed 's/[^[:print:]]/?/g' 1>&2 || true
-  exit 1
+if [ "$CONFIG_FRAGMENTS" = "1" ]; then
+  if ! python3 "$CONFIG_TOOL" require "$FINAL_CONFIG" inbounds outbounds routing >/dev/null 2>&1; then
+    log "ERROR Final config fragments are invalid (missing inbounds/outbounds/routing); keep current config"
+    exit 1
+  fi
+  NODES_SOURCE="$(ls "$FINAL_CONFIG"/*_outbounds.json 2>/dev/null | head -n 1)"
+else
+  if ! python3 "$CONFIG_TOOL" require "$FINAL_CONFIG" inbounds outbounds routing >/dev/null 2>&1; then
+    log "ERROR Final config is invalid (missing inbounds/outbounds/routing); keep current config"
+    tail -c 200 "$FINAL_CONFIG" | tr '\n' ' ' | tr -d '\r' | sed 's/[^[:print:]]/?/g' 1>&2 || true
+    exit 1
+  fi
+  NODES_SOURCE="$FINAL_CONFIG"
+fi
+
+if [ -n "${XRAY_METRICS_DIR:-}" ] && [ -f "$METRICS_SCRIPT" ] && [ -n "$NODES_SOURCE" ]; then
+  python3 "$METRICS_SCRIPT" nodes "$NODES_SOURCE" >/dev/null 2>&1 || \
+    log "WARNING Failed to record node metrics"
 fi
 
 # Single-writer apply pipeline (validate + lock + atomic replace)
 if ! python3 "$APPLY_SCRIPT" "$FINAL_CONFIG" "$TARGET_CONFIG"; then
   log "ERROR Failed to apply final config; keep current config"
-  rm -f "$FINAL_CONFIG" 2>/dev/null || true
-  rm -f "$WORK_CONFIG" 2>/dev/null || true
+  rm -rf "$FINAL_CONFIG" 2>/dev/null || true
+  rm -f "$WORK_CONFIG" $CONFIG_DIGESTS 2>/dev/null || true
   exit 1
 fi
 
-rm -f "$FINAL_CONFIG" 2>/dev/null || true
-rm -f "$WORK_CONFIG" 2>/dev/null || true
+rm -rf "$FINAL_CONFIG" 2>/dev/null || true
+rm -f "$WORK_CONFIG" $CONFIG_DIGESTS 2>/dev/null || true
 log "INFO Apply pipeline finished"
 
 # Optional raw payload retention for troubleshooting.
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Long-running subscription updater (replaces the `while true; sleep` loop).
+
+Responsibilities:
+- Run update_subscription.sh on a jittered schedule (SUB_UPDATE_INTERVAL_MIN).
+- Retry failures with exponential backoff instead of waiting a full interval.
+- Honour provider hints from the last response headers:
+  `profile-update-interval` (hours) and `Retry-After` (seconds or HTTP date).
+- Accept immediate triggers over a Unix socket or SIGUSR1; a single-flight
+  guard merges overlapping triggers into the run already in progress.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import os
+import random
+import signal
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+
+UPDATE_SCRIPT = "/scripts/update_subscription.sh"
+DEFAULT_HEADERS_FILE = "/tmp/subscription.headers"
+DEFAULT_TRIGGER_SOCKET = "/tmp/xray-updater.sock"
+MIN_PROVIDER_INTERVAL_SEC = 300.0
+MAX_PROVIDER_INTERVAL_SEC = 86400.0
+
+
+def _log(message: str) -> None:
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}", flush=True)
+
+
+def _env_float(name: str, default: float) -> float:
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return float(raw)
+    except ValueError as exc:
+        raise ValueError(f"{name} must be a number: {raw}") from exc
+
+
+@dataclass
+class Schedule:
+    interval_sec: float = 3600.0
+    jitter_ratio: float = 0.1
+    retry_min_sec: float = 30.0
+    retry_max_sec: float = 1800.0
+    honor_provider_interval: bool = True
+
+    @classmethod
+    def from_env(cls) -> "Schedule":
+        interval_sec = _env_float("SUB_UPDATE_INTERVAL_MIN", 60.0) * 60.0
+        if interval_sec <= 0:
+            raise ValueError("SUB_UPDATE_INTERVAL_MIN must be positive")
+        return cls(
+            interval_sec=interval_sec,
+            jitter_ratio=_env_float("SUB_UPDATE_JITTER_PCT", 10.0) / 100.0,
+            retry_min_sec=_env_float("SUB_UPDATE_RETRY_MIN_SEC", 30.0),
+            retry_max_sec=_env_float("SUB_UPDATE_RETRY_MAX_SEC", min(interval_sec, 1800.0)),
+            honor_provider_interval=os.getenv("SUB_UPDATE_HONOR_PROVIDER_INTERVAL", "1").strip()
+            in ("1", "true", "yes", "on"),
+        )
+
+
+def jittered(base: float, ratio: float, rng: random.Random) -> float:
+    if base <= 0 or ratio <= 0:
+        return max(0.0, base)
+    spread = base * ratio
+    return max(0.0, base + rng.uniform(-spread, spread))
+
+
+def backoff_delay(failures: int, schedule: Schedule, rng: random.Random) -> float:
+    # Full jitter keeps a fleet that failed together from retrying together.
+    ceiling = min(schedule.retry_max_sec, schedule.retry_min_sec * (2 ** max(0, failures - 1)))
+    return rng.uniform(min(schedule.retry_min_sec, ceiling), ceiling)
+
+
+def parse_provider_hints(headers_text: str, now: float | None = None) -> dict[str, float]:
+    """Extract scheduling hints from a -D style header dump (last response wins)."""
+    now = time.time() if now is None else now
+    values: dict[str, str] = {}
+    for line in headers_text.splitlines():
+        if line.upper().startswith("HTTP/"):
+            values = {}
+            continue
+        name, sep, value = line.partition(":")
+        if sep:
+            values[name.strip().lower()] = value.strip()
+
+    hints: dict[str, float] = {}
+    raw_interval = values.get("profile-update-interval")
+    if raw_interval:
+        try:
+            hours = float(raw_interval)
+        except ValueError:
+            hours = 0.0
+        if hours > 0:
+            hints["interval_sec"] = min(
+                MAX_PROVIDER_INTERVAL_SEC, max(MIN_PROVIDER_INTERVAL_SEC, hours * 3600.0)
+            )
+
+    raw_retry = values.get("retry-after")
+    if raw_retry:
+        if raw_retry.isdigit():
+            hints["retry_after_sec"] = float(raw_retry)
+        else:
+            try:
+                when = email.utils.parsedate_to_datetime(raw_retry).timestamp()
+            except (TypeError, ValueError):
+                when = None
+            if when is not None:
+                hints["retry_after_sec"] = max(0.0, when - now)
+    return hints
+
+
+def next_delay(
+    ok: bool,
+    failures: int,
+    hints: dict[str, float],
+    schedule: Schedule,
+    rng: random.Random,
+) -> float:
+    if ok:
+        base = schedule.interval_sec
+        if schedule.honor_provider_interval and "interval_sec" in hints:
+            base = hints["interval_sec"]
+        return jittered(base, schedule.jitter_ratio, rng)
+    delay = backoff_delay(failures, schedule, rng)
+    return max(delay, hints.get("retry_after_sec", 0.0))
+
+
+async def run_update_script(script: str, headers_file: Path) -> tuple[bool, dict[str, float]]:
+    try:
+        headers_file.unlink()
+    except FileNotFoundError:
+        pass
+    proc = await asyncio.create_subprocess_exec("/bin/sh", script)
+    rc = await proc.wait()
+    try:
+        hints = parse_provider_hints(headers_file.read_text(encoding="utf-8", errors="replace"))
+    except OSError:
+        hints = {}
+    return rc == 0, hints
+
+
+class UpdaterDaemon:
+    def __init__(self, schedule: Schedule, runner, rng: random.Random | None = None):
+        self.schedule = schedule
+        self.runner = runner
+        self.rng = rng or random.Random()
+        self.failures = 0
+        self.runs = 0
+        self.last_delay = 0.0
+        self._inflight: asyncio.Task | None = None
+        self._run_pending = True
+        self._wake = asyncio.Event()
+
+    async def _run_once(self) -> bool:
+        self.runs += 1
+        try:
+            ok, hints = await self.runner()
+        except Exception as exc:
+            _log(f"ERROR update run crashed: {exc}")
+            ok, hints = False, {}
+        self.failures = 0 if ok else self.failures + 1
+        self.last_delay = next_delay(ok, self.failures, hints, self.schedule, self.rng)
+        status = "ok" if ok else f"failed (attempt {self.failures})"
+        _log(f"INFO update {status}; next run in {self.last_delay:.0f}s")
+        return ok
+
+    def run_now(self) -> asyncio.Task:
+        """Start a run, or join the one in progress (single-flight)."""
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.get_running_loop().create_task(self._run_once())
+        return self._inflight
+
+    def trigger(self) -> None:
+        self._run_pending = True
+        self._wake.set()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            command = (await reader.readline()).decode("utf-8", errors="replace").strip()
+            if command in ("", "update"):
+                ok = await asyncio.shield(self.run_now())
+                # Restart the schedule timer from this run without running again.
+                self._wake.set()
+                writer.write(b"ok\n" if ok else b"error\n")
+            elif command == "status":
+                running = self._inflight is not None and not self._inflight.done()
+                writer.write(
+                    f"runs={self.runs} failures={self.failures} running={int(running)}\n".encode()
+                )
+            else:
+                writer.write(b"unknown command\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve_forever(self) -> None:
+        while True:
+            if self._run_pending:
+                self._run_pending = False
+                await self.run_now()
+                # Triggers that arrived during the run were merged into it.
+                self._run_pending = False
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.last_delay)
+                if self._run_pending:
+                    _log("INFO immediate update triggered")
+            except asyncio.TimeoutError:
+                self._run_pending = True
+
+
+async def _amain() -> int:
+    schedule = Schedule.from_env()
+    script = os.getenv("SUB_UPDATE_SCRIPT", UPDATE_SCRIPT)
+    headers_file = Path(os.getenv("SUB_UPDATE_HEADERS_FILE", DEFAULT_HEADERS_FILE))
+    socket_path = os.getenv("SUB_UPDATE_TRIGGER_SOCKET", DEFAULT_TRIGGER_SOCKET).strip()
+
+    daemon = UpdaterDaemon(schedule, lambda: run_update_script(script, headers_file))
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, daemon.trigger)
+
+    server = None
+    if socket_path:
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+        server = await asyncio.start_unix_server(daemon.handle_client, path=socket_path)
+        os.chmod(socket_path, 0o600)
+        _log(f"INFO trigger socket listening on {socket_path}")
+
+    _log(
+        f"INFO updater started: interval={schedule.interval_sec:.0f}s "
+        f"jitter={schedule.jitter_ratio:.0%} retry={schedule.retry_min_sec:.0f}-"
+        f"{schedule.retry_max_sec:.0f}s"
+    )
+    try:
+        await daemon.serve_forever()
+    finally:
+        if server is not None:
+            server.close()
+    return 0
+
+
+def main() -> int:
+    if len(sys.argv) == 2 and sys.argv[1] == "trigger":
+        return _send_trigger()
+    if len(sys.argv) != 1:
+        print("Usage: updater_daemon.py [trigger]", file=sys.stderr)
+        return 2
+    try:
+        return asyncio.run(_amain())
+    except KeyboardInterrupt:
+        return 0
+    except Exception as exc:
+        print(f"updater_daemon.py error: {exc}", file=sys.stderr)
+        return 1
+
+
+def _send_trigger() -> int:
+    socket_path = os.getenv("SUB_UPDATE_TRIGGER_SOCKET", DEFAULT_TRIGGER_SOCKET).strip()
+
+    async def _request() -> str:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(b"update\n")
+        await writer.drain()
+        reply = (await reader.readline()).decode("utf-8", errors="replace").strip()
+        writer.close()
+        return reply
+
+    try:
+        reply = asyncio.run(_request())
+    except OSError as exc:
+        print(f"updater_daemon.py error: cannot reach {socket_path}: {exc}", file=sys.stderr)
+        return 1
+    print(f"INFO triggered update: {reply}")
+    return 0 if reply == "ok" else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
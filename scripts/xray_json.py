@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+JSON serialization for generated Xray configs.
+
+- Compact output by default (no indentation, minimal separators) with sorted
+  keys, so identical configs always serialize to identical bytes.
+- XRAY_CONFIG_PRETTY=1 switches to indented output for debugging.
+- Uses orjson when it is installed (XRAY_JSON_BACKEND=auto|json|orjson).
+- Streaming writer: top-level lists and generators are emitted item by item
+  (same bytes as the compact dump), with the sha256 computed while writing
+  and stored in a sidecar for apply_xray_config.py's no-op check. Only the
+  serialization is streamed: callers such as compose_xray_config.py still hold
+  the whole config, so peak memory stays O(config).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+BACKENDS = ("auto", "json", "orjson")
+
+
+def _parse_bool_env(name: str, default: bool) -> bool:
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    return raw.strip().lower() in ("1", "true", "yes", "on")
+
+
+def resolve_backend(name: str | None = None) -> str:
+    requested = (name or os.getenv("XRAY_JSON_BACKEND", "auto")).strip().lower() or "auto"
+    if requested not in BACKENDS:
+        raise ValueError(f"XRAY_JSON_BACKEND must be one of: {', '.join(BACKENDS)}")
+    if requested == "orjson" and orjson is None:
+        raise ValueError("XRAY_JSON_BACKEND=orjson but orjson is not installed")
+    if requested == "auto":
+        return "orjson" if orjson is not None else "json"
+    return requested
+
+
+def dumps_config(config: dict, pretty: bool | None = None, backend: str | None = None) -> bytes:
+    if pretty is None:
+        pretty = _parse_bool_env("XRAY_CONFIG_PRETTY", False)
+    if resolve_backend(backend) == "orjson":
+        option = orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(config, option=option) + b"\n"
+
+    if pretty:
+        text = json.dumps(config, ensure_ascii=False, indent=2, sort_keys=True)
+    else:
+        text = json.dumps(
+            config, ensure_ascii=False, separators=(",", ":"), sort_keys=True
+        )
+    return (text + "\n").encode("utf-8")
+
+
+def loads_config(data: bytes | str, backend: str | None = None):
+    if resolve_backend(backend) == "orjson":
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    return json.loads(data)
+
+
+def write_config(config: dict, path: str, pretty: bool | None = None) -> int:
+    payload = dumps_config(config, pretty=pretty)
+    _drop_digest(Path(path))
+    with open(path, "wb") as f:
+        f.write(payload)
+    return len(payload)
+
+
+def _compact_dumps(backend: str | None = None):
+    if resolve_backend(backend) == "orjson":
+        return lambda value: orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+    return lambda value: encoder.encode(value).encode("utf-8")
+
+
+def iter_config_chunks(config: dict, backend: str | None = None):
+    """Compact serialization of config as byte chunks (one per list item).
+
+    Values that are lists or iterators are emitted element by element, so a
+    generator of outbounds is never materialized. Keys are written in sorted
+    order; a generator may fill values of keys that sort after it.
+    """
+    dumps = _compact_dumps(backend)
+    yield b"{"
+    for idx, key in enumerate(sorted(config)):
+        yield (b"," if idx else b"") + dumps(key) + b":"
+        value = config[key]
+        if isinstance(value, list) or hasattr(value, "__next__"):
+            yield b"["
+            for item_idx, item in enumerate(value):
+                yield (b"," if item_idx else b"") + dumps(item)
+            yield b"]"
+        else:
+            yield dumps(value)
+    yield b"}\n"
+
+
+def digest_path_for(path: Path) -> Path:
+    return path.parent / f".{path.name}.sha256"
+
+
+def _drop_digest(path: Path) -> None:
+    try:
+        digest_path_for(path).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def read_digest(path: Path) -> str | None:
+    """sha256 recorded by write_config_stream, if the file is unchanged since."""
+    try:
+        entry = json.loads(digest_path_for(path).read_text(encoding="utf-8"))
+        st = path.stat()
+    except (OSError, ValueError):
+        return None
+    if (
+        not isinstance(entry, dict)
+        or entry.get("size") != st.st_size
+        or entry.get("mtime_ns") != st.st_mtime_ns
+        or not isinstance(entry.get("sha256"), str)
+    ):
+        return None
+    return entry["sha256"]
+
+
+def write_config_stream(config: dict, path: str, pretty: bool | None = None) -> tuple[int, str]:
+    """Write config incrementally; returns (size, sha256) and records the digest sidecar."""
+    if pretty is None:
+        pretty = _parse_bool_env("XRAY_CONFIG_PRETTY", False)
+    if pretty:
+        # Debug output: indentation needs the whole document.
+        materialized = {
+            k: list(v) if hasattr(v, "__next__") else v for k, v in config.items()
+        }
+        chunks = iter([dumps_config(materialized, pretty=True)])
+    else:
+        chunks = iter_config_chunks(config)
+
+    digest = hashlib.sha256()
+    size = 0
+    target = Path(path)
+    _drop_digest(target)
+    try:
+        with open(target, "wb") as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+    except BaseException:
+        # A failing generator must not leave a truncated config behind.
+        target.unlink(missing_ok=True)
+        raise
+    sha256 = digest.hexdigest()
+    st = target.stat()
+    digest_path_for(target).write_text(
+        json.dumps({"sha256": sha256, "size": st.st_size, "mtime_ns": st.st_mtime_ns}),
+        encoding="utf-8",
+    )
+    return size, sha256
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Prometheus metrics for the update pipeline and the Xray supervisor.
+
+Responsibilities:
+- Keep a small JSON state file with updater counters under XRAY_METRICS_DIR.
+- Re-render a node-exporter textfile (updater.prom) after every recorded event.
+- Serve every *.prom file of the metrics directory over a tiny local HTTP
+  endpoint (xray_watch.sh writes its own xray_watch.prom next to ours).
+
+Metrics are best-effort: with XRAY_METRICS_DIR unset every record call is a
+no-op, and recording errors never fail the update pipeline.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows host tests
+    fcntl = None
+
+
+STATE_FILE_NAME = "updater.state.json"
+TEXTFILE_NAME = "updater.prom"
+DEFAULT_LISTEN = "127.0.0.1:9550"
+UPDATE_DURATION_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+APPLY_RESULTS = ("changed", "unchanged", "failed")
+UPDATE_STATUSES = ("ok", "error")
+IGNORED_PROXY_PROTOCOLS = {"freedom", "blackhole", "dns", "loopback"}
+
+
+def metrics_dir() -> Path | None:
+    raw = os.getenv("XRAY_METRICS_DIR", "").strip()
+    if not raw:
+        return None
+    return Path(raw)
+
+
+def _empty_state() -> dict:
+    return {
+        "update_duration_buckets": [0] * len(UPDATE_DURATION_BUCKETS),
+        "update_duration_sum": 0.0,
+        "update_duration_count": 0,
+        "updates_total": {status: 0 for status in UPDATE_STATUSES},
+        "last_run_timestamp": 0.0,
+        "last_success_timestamp": 0.0,
+        "nodes": {},
+        "links_found": 0,
+        "parse_failures_total": 0,
+        "apply_total": {result: 0 for result in APPLY_RESULTS},
+    }
+
+
+def _load_state(path: Path) -> dict:
+    state = _empty_state()
+    try:
+        stored = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return state
+    if not isinstance(stored, dict):
+        return state
+    for key, default in state.items():
+        value = stored.get(key)
+        if isinstance(default, dict) and isinstance(value, dict):
+            default.update(value)
+        elif isinstance(default, list):
+            if isinstance(value, list) and len(value) == len(default):
+                state[key] = value
+        elif value is not None:
+            state[key] = value
+    return state
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    fd, tmp_name = tempfile.mkstemp(
+        prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent)
+    )
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            handle.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render_updater_metrics(state: dict) -> str:
+    lines = [
+        "# HELP xray_updater_duration_seconds Duration of subscription update runs.",
+        "# TYPE xray_updater_duration_seconds histogram",
+    ]
+    cumulative = 0
+    for bound, count in zip(UPDATE_DURATION_BUCKETS, state["update_duration_buckets"]):
+        cumulative += count
+        lines.append(
+            f'xray_updater_duration_seconds_bucket{{le="{_format_value(bound)}"}} {cumulative}'
+        )
+    lines.append(
+        f'xray_updater_duration_seconds_bucket{{le="+Inf"}} {state["update_duration_count"]}'
+    )
+    lines.append(
+        f"xray_updater_duration_seconds_sum {_format_value(state['update_duration_sum'])}"
+    )
+    lines.append(f"xray_updater_duration_seconds_count {state['update_duration_count']}")
+
+    lines.append("# HELP xray_updater_runs_total Subscription update runs by final status.")
+    lines.append("# TYPE xray_updater_runs_total counter")
+    for status in sorted(state["updates_total"]):
+        lines.append(
+            f'xray_updater_runs_total{{status="{_escape_label(status)}"}} '
+            f"{state['updates_total'][status]}"
+        )
+
+    lines.append(
+        "# HELP xray_updater_last_run_timestamp_seconds Unix time of the last finished update run."
+    )
+    lines.append("# TYPE xray_updater_last_run_timestamp_seconds gauge")
+    lines.append(
+        f"xray_updater_last_run_timestamp_seconds {_format_value(state['last_run_timestamp'])}"
+    )
+    lines.append(
+        "# HELP xray_updater_last_success_timestamp_seconds Unix time of the last successful update run."
+    )
+    lines.append("# TYPE xray_updater_last_success_timestamp_seconds gauge")
+    lines.append(
+        "xray_updater_last_success_timestamp_seconds "
+        f"{_format_value(state['last_success_timestamp'])}"
+    )
+
+    lines.append("# HELP xray_updater_nodes Proxy outbounds in the last composed config by protocol.")
+    lines.append("# TYPE xray_updater_nodes gauge")
+    for protocol in sorted(state["nodes"]):
+        lines.append(
+            f'xray_updater_nodes{{protocol="{_escape_label(protocol)}"}} {state["nodes"][protocol]}'
+        )
+
+    lines.append("# HELP xray_updater_links_found Share links found in the last parsed subscription.")
+    lines.append("# TYPE xray_updater_links_found gauge")
+    lines.append(f"xray_updater_links_found {state['links_found']}")
+    lines.append("# HELP xray_updater_parse_failures_total Nodes that failed to parse (unsupported nodes are not counted).")
+    lines.append("# TYPE xray_updater_parse_failures_total counter")
+    lines.append(f"xray_updater_parse_failures_total {state['parse_failures_total']}")
+
+    lines.append("# HELP xray_updater_apply_total Apply pipeline results.")
+    lines.append("# TYPE xray_updater_apply_total counter")
+    for result in sorted(state["apply_total"]):
+        lines.append(
+            f'xray_updater_apply_total{{result="{_escape_label(result)}"}} '
+            f"{state['apply_total'][result]}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def _update_state(mutate, directory: Path | None = None) -> bool:
+    directory = directory or metrics_dir()
+    if directory is None:
+        return False
+    directory.mkdir(parents=True, exist_ok=True)
+    state_path = directory / STATE_FILE_NAME
+    lock_path = directory / f".{STATE_FILE_NAME}.lock"
+
+    with lock_path.open("a+", encoding="utf-8") as lock_handle:
+        if fcntl is not None:
+            fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+        state = _load_state(state_path)
+        mutate(state)
+        _write_atomic(state_path, json.dumps(state, sort_keys=True) + "\n")
+        _write_atomic(directory / TEXTFILE_NAME, render_updater_metrics(state))
+    return True
+
+
+def record_update(
+    started_at: float,
+    status: str,
+    now: float | None = None,
+    directory: Path | None = None,
+) -> bool:
+    if status not in UPDATE_STATUSES:
+        raise ValueError(f"Update status must be one of: {', '.join(UPDATE_STATUSES)}")
+    finished_at = time.time() if now is None else now
+    duration = max(0.0, finished_at - started_at)
+
+    def mutate(state: dict) -> None:
+        for idx, bound in enumerate(UPDATE_DURATION_BUCKETS):
+            if duration <= bound:
+                state["update_duration_buckets"][idx] += 1
+                break
+        state["update_duration_sum"] += duration
+        state["update_duration_count"] += 1
+        state["updates_total"][status] = state["updates_total"].get(status, 0) + 1
+        state["last_run_timestamp"] = finished_at
+        if status == "ok":
+            state["last_success_timestamp"] = finished_at
+
+    return _update_state(mutate, directory)
+
+
+def count_nodes_by_protocol(config: dict) -> dict[str, int]:
+    counts: dict[str, int] = {}
+    for outbound in config.get("outbounds") or []:
+        if not isinstance(outbound, dict):
+            continue
+        proto = outbound.get("protocol")
+        if not isinstance(proto, str) or proto in IGNORED_PROXY_PROTOCOLS:
+            continue
+        if outbound.get("tag") in ("direct", "block"):
+            continue
+        counts[proto] = counts.get(proto, 0) + 1
+    return counts
+
+
+def record_nodes(config: dict, directory: Path | None = None) -> bool:
+    counts = count_nodes_by_protocol(config)
+
+    def mutate(state: dict) -> None:
+        state["nodes"] = counts
+
+    return _update_state(mutate, directory)
+
+
+def record_parse(links_found: int, failures: int, directory: Path | None = None) -> bool:
+    def mutate(state: dict) -> None:
+        state["links_found"] = links_found
+        state["parse_failures_total"] += max(0, failures)
+
+    return _update_state(mutate, directory)
+
+
+def record_apply(result: str, directory: Path | None = None) -> bool:
+    if result not in APPLY_RESULTS:
+        raise ValueError(f"Apply result must be one of: {', '.join(APPLY_RESULTS)}")
+
+    def mutate(state: dict) -> None:
+        state["apply_total"][result] = state["apply_total"].get(result, 0) + 1
+
+    return _update_state(mutate, directory)
+
+
+def _supervisor_uptime(text: str, now: float) -> str:
+    for line in text.splitlines():
+        if line.startswith("xray_supervisor_start_time_seconds "):
+            try:
+                started = float(line.split()[1])
+            except (IndexError, ValueError):
+                return ""
+            return (
+                "# HELP xray_supervisor_uptime_seconds Seconds since xray_watch.sh started.\n"
+                "# TYPE xray_supervisor_uptime_seconds gauge\n"
+                f"xray_supervisor_uptime_seconds {_format_value(max(0.0, now - started))}\n"
+            )
+    return ""
+
+
+def collect_textfiles(directory: Path, now: float | None = None) -> str:
+    chunks = []
+    for path in sorted(directory.glob("*.prom")):
+        try:
+            text = path.read_text(encoding="utf-8")
+        except OSError:
+            continue
+        if text and not text.endswith("\n"):
+            text += "\n"
+        chunks.append(text)
+    body = "".join(chunks)
+    return body + _supervisor_uptime(body, time.time() if now is None else now)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    directory: Path = Path(".")
+
+    def do_GET(self) -> None:  # noqa: N802 - http.server API
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = collect_textfiles(self.directory).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format: str, *args) -> None:  # noqa: A002
+        return
+
+
+def parse_listen(value: str) -> tuple[str, int]:
+    host, sep, port = value.strip().rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError(f"Invalid listen address (expected host:port): {value}")
+    return host or "127.0.0.1", int(port)
+
+
+def make_server(directory: Path, listen: str) -> ThreadingHTTPServer:
+    handler = type("MetricsHandler", (_MetricsHandler,), {"directory": directory})
+    return ThreadingHTTPServer(parse_listen(listen), handler)
+
+
+def main() -> int:
+    usage = (
+        "Usage: xray_metrics.py update <started_at> <ok|error> | nodes <config_json> | "
+        "apply <changed|unchanged|failed> | render | serve [host:port]"
+    )
+    if len(sys.argv) < 2:
+        print(usage, file=sys.stderr)
+        return 2
+
+    command, args = sys.argv[1], sys.argv[2:]
+    directory = metrics_dir()
+    try:
+        if command == "serve":
+            if directory is None:
+                raise ValueError("XRAY_METRICS_DIR is not set")
+            listen = args[0] if args else os.getenv("XRAY_METRICS_LISTEN", DEFAULT_LISTEN)
+            directory.mkdir(parents=True, exist_ok=True)
+            server = make_server(directory, listen)
+            print(f"INFO Serving metrics from {directory} on http://{listen}/metrics")
+            server.serve_forever()
+            return 0
+        if command == "render":
+            if directory is not None:
+                sys.stdout.write(collect_textfiles(directory))
+            return 0
+        if command == "update" and len(args) == 2:
+            record_update(float(args[0]), args[1])
+            return 0
+        if command == "nodes" and len(args) == 1:
+            with open(args[0], "r", encoding="utf-8") as f:
+                record_nodes(json.load(f))
+            return 0
+        if command == "apply" and len(args) == 1:
+            record_apply(args[0])
+            return 0
+    except Exception as exc:
+        print(f"xray_metrics.py error: {exc}", file=sys.stderr)
+        return 1
+
+    print(usage, file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,8 +1,41 @@
 #!/bin/sh
 set -eu
 
-CONFIG="/etc/xray/config.json"
-LOG="/var/log/xray/xray-watch.log"
+CONFIG="${XRAY_CONFIG:-/etc/xray/config.json}"
+MANIFEST="$(dirname "$CONFIG")/.$(basename "$CONFIG").manifest"
+# Fragment mode (XRAY_CONFIG_FRAGMENTS=1): watch the -confdir symlink instead.
+CONFDIR=""
+if [ "${XRAY_CONFIG_FRAGMENTS:-0}" = "1" ]; then
+    CONFDIR="${XRAY_CONFDIR:-/etc/xray/conf.d}"
+    CONFDIR_MANIFEST="$(dirname "$CONFDIR")/.$(basename "$CONFDIR").manifest"
+fi
+LOG="${XRAY_WATCH_LOG:-/var/log/xray/xray-watch.log}"
+WATCH_INTERVAL="${XRAY_WATCH_INTERVAL_SEC:-3}"
+# Handover mode (XRAY_HANDOVER=1, inbounds composed with SO_REUSEPORT and tags): the
+# new xray binds the same ports, then the old one's inbounds are removed through its
+# HandlerService API so only the new process accepts while the old one drains.
+HANDOVER="${XRAY_HANDOVER:-0}"
+HANDOVER_GRACE="${XRAY_HANDOVER_GRACE_SEC:-10}"
+HANDOVER_READY_TIMEOUT="${XRAY_HANDOVER_READY_TIMEOUT_SEC:-10}"
+HANDOVER_PORTS="${XRAY_HANDOVER_PORTS:-${HTTP_PROXY_PORT:-3128} ${SOCKS_PROXY_PORT:-1080}}"
+HANDOVER_TAGS="${XRAY_HANDOVER_TAGS:-http-in socks-in}"
+if [ "${GATEWAY_MODE:-0}" = "1" ]; then
+    [ -n "${XRAY_HANDOVER_PORTS:-}" ] || HANDOVER_PORTS="$HANDOVER_PORTS ${GATEWAY_TPROXY_PORT:-12345}"
+    [ -n "${XRAY_HANDOVER_TAGS:-}" ] || HANDOVER_TAGS="$HANDOVER_TAGS tproxy-in"
+fi
+if [ -n "${XRAY_STATS_LISTEN:-}" ]; then
+    [ -n "${XRAY_HANDOVER_PORTS:-}" ] || HANDOVER_PORTS="$HANDOVER_PORTS ${XRAY_STATS_LISTEN##*:}"
+    [ -n "${XRAY_HANDOVER_TAGS:-}" ] || HANDOVER_TAGS="$HANDOVER_TAGS metrics-in"
+fi
+# Consecutive processes alternate between this port and the next one.
+HANDOVER_API_PORT="${XRAY_HANDOVER_API_PORT:-10085}"
+HANDOVER_API_DIR="${TMPDIR:-/tmp}"
+XRAY_API_PORT=""
+OLD_XRAY_PID=""
+METRICS_DIR="${XRAY_METRICS_DIR:-}"
+SUPERVISOR_STARTED_AT="$(date +%s)"
+RESTARTS_CRASH=0
+RESTARTS_CONFIG=0
 
 log() {
     msg="$(date '+%Y-%m-%d %H:%M:%S') $1"
@@ -15,62 +48,249 @@ sha256_file() {
     [ -f "$1" ] && sha256sum "$1" | awk '{print $1}' || echo ""
 }
 
+stat_key() {
+    stat -c '%s %Y %i' "$1" 2>/dev/null || echo ""
+}
+
+manifest_field() {
+    sed -n "s/^ *\"$1\": *\"\{0,1\}\([^\",]*\)\"\{0,1\},\{0,1\} *\$/\1/p" "$MANIFEST" 2>/dev/null | head -n 1
+}
+
+# Digest of $CONFIG: taken from the apply pipeline manifest while size/mtime/inode
+# still match it; full sha256 only when the manifest is missing or stale.
+config_digest() {
+    key="$1"
+    if [ -n "$key" ] && [ -f "$MANIFEST" ]; then
+        m_key="$(manifest_field size) $(manifest_field mtime) $(manifest_field inode)"
+        m_sum="$(manifest_field sha256)"
+        if [ -n "$m_sum" ] && [ "$m_key" = "$key" ]; then
+            echo "$m_sum"
+            return 0
+        fi
+    fi
+    sha256_file "$CONFIG"
+}
+
+# Fragment mode: each apply commits a new generation directory, so the symlink
+# target identifies the config set; the manifest lists the fragments that changed.
+confdir_generation() {
+    readlink "$CONFDIR" 2>/dev/null || echo ""
+}
+
+confdir_changed_fragments() {
+    tr -d ' \n' < "$CONFDIR_MANIFEST" 2>/dev/null | sed -n 's/.*"changed":\[\([^]]*\)\].*/\1/p' | tr -d '"'
+}
+
+config_ready() {
+    if [ -n "$CONFDIR" ]; then
+        [ -d "$CONFDIR" ]
+    else
+        [ -s "$CONFIG" ]
+    fi
+}
+
+# Node-exporter textfile with supervisor metrics (best-effort, atomic rename).
+write_metrics() {
+    [ -n "$METRICS_DIR" ] || return 0
+    mkdir -p "$METRICS_DIR" 2>/dev/null || return 0
+    tmp="$METRICS_DIR/.xray_watch.prom.$$"
+    {
+        echo "# HELP xray_supervisor_start_time_seconds Unix time when xray_watch.sh started."
+        echo "# TYPE xray_supervisor_start_time_seconds gauge"
+        echo "xray_supervisor_start_time_seconds $SUPERVISOR_STARTED_AT"
+        echo "# HELP xray_supervisor_restarts_total Xray process restarts by reason."
+        echo "# TYPE xray_supervisor_restarts_total counter"
+        echo "xray_supervisor_restarts_total{reason=\"crash\"} $RESTARTS_CRASH"
+        echo "xray_supervisor_restarts_total{reason=\"config_change\"} $RESTARTS_CONFIG"
+        echo "# HELP xray_supervisor_last_start_timestamp_seconds Unix time of the last xray process start."
+        echo "# TYPE xray_supervisor_last_start_timestamp_seconds gauge"
+        echo "xray_supervisor_last_start_timestamp_seconds ${XRAY_STARTED_AT:-0}"
+    } > "$tmp" 2>/dev/null && mv -f "$tmp" "$METRICS_DIR/xray_watch.prom" 2>/dev/null || rm -f "$tmp" 2>/dev/null || true
+}
+
 start_xray() {
     log "INFO starting xray"
-    xray run -c "$CONFIG" &
+    set --
+    if [ "$HANDOVER" = "1" ]; then
+        # Each process gets its own API port, so the old one stays reachable
+        # while the new one is running.
+        if [ "$XRAY_API_PORT" = "$HANDOVER_API_PORT" ]; then
+            XRAY_API_PORT=$((HANDOVER_API_PORT + 1))
+        else
+            XRAY_API_PORT="$HANDOVER_API_PORT"
+        fi
+        api_config="$HANDOVER_API_DIR/xray-handover-api-$XRAY_API_PORT.json"
+        printf '{"api":{"tag":"handover-api","listen":"127.0.0.1:%s","services":["HandlerService"]}}\n' \
+            "$XRAY_API_PORT" > "$api_config"
+        set -- -c "$api_config"
+    fi
+    if [ -n "$CONFDIR" ]; then
+        xray run -confdir "$CONFDIR" "$@" &
+    else
+        xray run -c "$CONFIG" "$@" &
+    fi
     XRAY_PID=$!
+    XRAY_STARTED_AT="$(date +%s)"
     log "INFO xray pid=$XRAY_PID"
+    write_metrics
 }
 
-stop_xray() {
-    if [ -n "${XRAY_PID:-}" ] && kill -0 "$XRAY_PID" 2>/dev/null; then
-        log "INFO stopping xray pid=$XRAY_PID"
-        kill -TERM "$XRAY_PID" 2>/dev/null || true
+# kill -0 also succeeds for an exited child the shell has not reaped yet.
+pid_alive() {
+    kill -0 "$1" 2>/dev/null || return 1
+    state="$(sed 's/.*) //' "/proc/$1/stat" 2>/dev/null | cut -d' ' -f1)"
+    [ "$state" != "Z" ]
+}
+
+stop_pid() {
+    pid="$1"
+    if [ -n "$pid" ] && pid_alive "$pid"; then
+        log "INFO stopping xray pid=$pid"
+        kill -TERM "$pid" 2>/dev/null || true
         # wait up to 15s
         for i in $(seq 1 15); do
-            if kill -0 "$XRAY_PID" 2>/dev/null; then
+            if pid_alive "$pid"; then
                 sleep 1
             else
                 break
             fi
         done
         # force if still alive
-        if kill -0 "$XRAY_PID" 2>/dev/null; then
+        if pid_alive "$pid"; then
             log "WARN xray did not stop gracefully; killing"
-            kill -KILL "$XRAY_PID" 2>/dev/null || true
+            kill -KILL "$pid" 2>/dev/null || true
         fi
     fi
+    [ -z "$pid" ] || wait "$pid" 2>/dev/null || true
+}
+
+stop_xray() {
+    stop_pid "${XRAY_PID:-}"
 }
 
-trap 'stop_xray; exit 0' INT TERM
+# True when process $1 owns a listening TCP socket on port $2 (/proc/net/tcp{,6}
+# inode matched against the process fds; other processes may share the port).
+pid_listens() {
+    hex="$(printf ':%04X' "$2")"
+    inodes="$(awk -v p="$hex" '$4 == "0A" && substr($2, length($2) - 4) == p { print $10 }' \
+        /proc/net/tcp /proc/net/tcp6 2>/dev/null || true)"
+    [ -n "$inodes" ] || return 1
+    fds="$(ls -l "/proc/$1/fd" 2>/dev/null || true)"
+    for inode in $inodes; do
+        case "$fds" in
+            *"socket:[$inode]"*) return 0 ;;
+        esac
+    done
+    return 1
+}
+
+wait_listening() {
+    pid="$1"
+    deadline=$(( $(date +%s) + HANDOVER_READY_TIMEOUT ))
+    while pid_alive "$pid"; do
+        ready=1
+        for port in $HANDOVER_PORTS; do
+            pid_listens "$pid" "$port" || { ready=0; break; }
+        done
+        [ "$ready" = "1" ] && return 0
+        [ "$(date +%s)" -lt "$deadline" ] || return 1
+        sleep 0.1
+    done
+    return 1
+}
+
+# Remove inbounds HANDOVER_TAGS from the xray serving the API on port $1: its
+# listeners close, connections it already accepted keep running.
+remove_inbounds() {
+    xray api rmi --server="127.0.0.1:$1" -tags $HANDOVER_TAGS >/dev/null 2>&1
+}
+
+# Start the new xray next to the old one; once it listens on every LAN port, take
+# the old one's inbounds away so the new process gets every new connection, then
+# give the old connections HANDOVER_GRACE seconds to finish.
+# Falls back to stop + start when the new process cannot bind (e.g. the old one
+# was started without SO_REUSEPORT).
+handover_xray() {
+    OLD_XRAY_PID="$XRAY_PID"
+    old_api_port="$XRAY_API_PORT"
+    start_xray
+    if wait_listening "$XRAY_PID"; then
+        if remove_inbounds "$old_api_port"; then
+            log "INFO xray pid=$XRAY_PID listening on $HANDOVER_PORTS; pid=$OLD_XRAY_PID stopped accepting, draining for ${HANDOVER_GRACE}s"
+        else
+            log "WARN could not remove inbounds ($HANDOVER_TAGS) of pid=$OLD_XRAY_PID via 127.0.0.1:$old_api_port; it keeps accepting while draining for ${HANDOVER_GRACE}s"
+        fi
+        sleep "$HANDOVER_GRACE"
+        stop_pid "$OLD_XRAY_PID"
+        OLD_XRAY_PID=""
+        log "INFO handover complete"
+        return 0
+    fi
+    log "WARN new xray pid=$XRAY_PID not listening on $HANDOVER_PORTS; falling back to restart"
+    stop_xray
+    stop_pid "$OLD_XRAY_PID"
+    OLD_XRAY_PID=""
+    start_xray
+}
+
+trap 'stop_pid "$OLD_XRAY_PID"; stop_xray; exit 0' INT TERM
 
 # Wait until config exists
-while [ ! -s "$CONFIG" ]; do
-    log "WARN $CONFIG not found or empty; waiting..."
+while ! config_ready; do
+    log "WARN ${CONFDIR:-$CONFIG} not found or empty; waiting..."
     sleep 2
 done
 
-last_sum="$(sha256_file "$CONFIG")"
-log "INFO initial config sha256=${last_sum:-<empty>}"
+if [ -n "$CONFDIR" ]; then
+    last_key=""
+    last_sum="$(confdir_generation)"
+    log "INFO initial config generation=${last_sum:-<empty>}"
+else
+    last_key="$(stat_key "$CONFIG")"
+    last_sum="$(config_digest "$last_key")"
+    log "INFO initial config sha256=${last_sum:-<empty>}"
+fi
 
 start_xray
 
 while true; do
-    sleep 3
-    cur_sum="$(sha256_file "$CONFIG")"
+    sleep "$WATCH_INTERVAL"
+    if [ -n "$CONFDIR" ]; then
+        cur_sum="$(confdir_generation)"
+    else
+        # Unchanged stat data -> unchanged file; skip reading the config entirely.
+        cur_key="$(stat_key "$CONFIG")"
+        if [ -n "$cur_key" ] && [ "$cur_key" = "$last_key" ]; then
+            cur_sum="$last_sum"
+        else
+            cur_sum="$(config_digest "$cur_key")"
+        fi
+        last_key="$cur_key"
+    fi
     
     # If xray died, restart
-    if ! kill -0 "$XRAY_PID" 2>/dev/null; then
+    if ! pid_alive "$XRAY_PID"; then
+        wait "$XRAY_PID" 2>/dev/null || true
         log "WARN xray process exited; restarting"
+        RESTARTS_CRASH=$((RESTARTS_CRASH + 1))
         start_xray
         last_sum="$cur_sum"
         continue
     fi
     
     if [ -n "$cur_sum" ] && [ "$cur_sum" != "$last_sum" ]; then
-        log "INFO config changed sha256=$last_sum -> $cur_sum; restarting xray"
-        stop_xray
+        if [ -n "$CONFDIR" ]; then
+            log "INFO config fragments changed (${last_sum} -> ${cur_sum}: $(confdir_changed_fragments)); restarting xray"
+        else
+            log "INFO config changed sha256=$last_sum -> $cur_sum; restarting xray"
+        fi
         last_sum="$cur_sum"
-        start_xray
+        RESTARTS_CONFIG=$((RESTARTS_CONFIG + 1))
+        if [ "$HANDOVER" = "1" ]; then
+            handover_xray
+        else
+            stop_xray
+            start_xray
+        fi
     fi
 done
\ No newline at end of file
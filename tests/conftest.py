@@ -0,0 +1,14 @@
+"""
+Shared pytest setup for XRAY-PROXY-Container.
+
+Scripts import their siblings (xray_json, ...) the same way they do at
+runtime under /scripts, so scripts/ has to be importable in tests too.
+"""
+
+import sys
+from pathlib import Path
+
+
+SCRIPTS_DIR = Path(__file__).resolve().parents[1] / "scripts"
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
@@ -3,8 +3,10 @@
 Tests for scripts/apply_xray_config.py
 """
 
+import hashlib
 import importlib.util
 import json
+import os
 from pathlib import Path
 
 import pytest
@@ -68,6 +70,24 @@ def test_validate_candidate_config_requires_block_outbound():
         mod.validate_candidate_config(cfg)
 
 
+def test_validate_candidate_config_checks_wireguard_peers():
+    mod = _load_module()
+    cfg = _valid_config()
+    cfg["outbounds"][0] = {
+        "tag": "node1",
+        "protocol": "wireguard",
+        "settings": {
+            "secretKey": "yAnz5TF+lXXJte14tji3zlMNq+hd2rYUIgJBgB3fBmk=",
+            "peers": [{"publicKey": "HIgo9xNzJMWLKASShiTqIybxZ0U3wGLiUeJ1PKf8ykw=", "endpoint": "[::1]:2408"}],
+        },
+    }
+    mod.validate_candidate_config(cfg)
+
+    cfg["outbounds"][0]["settings"]["peers"][0]["endpoint"] = "example.com"
+    with pytest.raises(ValueError, match="invalid endpoint"):
+        mod.validate_candidate_config(cfg)
+
+
 def test_validate_candidate_config_requires_proxy_outbound():
     mod = _load_module()
     cfg = _valid_config()
@@ -94,6 +114,23 @@ def test_validate_candidate_config_rejects_unknown_outbound_reference():
         mod.validate_candidate_config(cfg)
 
 
+def test_validate_candidate_config_accepts_metrics_and_api_tags():
+    mod = _load_module()
+    cfg = _valid_config()
+    cfg["metrics"] = {"tag": "metrics"}
+    cfg["api"] = {"tag": "api", "services": ["HandlerService"]}
+    cfg["routing"]["rules"][:0] = [
+        {"type": "field", "inboundTag": ["metrics-in"], "outboundTag": "metrics"},
+        {"type": "field", "inboundTag": ["api-in"], "outboundTag": "api"},
+    ]
+
+    mod.validate_candidate_config(cfg)
+
+    del cfg["api"]
+    with pytest.raises(ValueError, match="unknown outboundTag: api"):
+        mod.validate_candidate_config(cfg)
+
+
 def test_validate_candidate_config_accepts_known_balancer_reference():
     mod = _load_module()
     cfg = _valid_config()
@@ -175,4 +212,205 @@ def test_apply_candidate_rejects_invalid_json(tmp_path):
     candidate_path.write_text("{bad json", encoding="utf-8")
 
     with pytest.raises(ValueError, match="valid JSON"):
-        mod.apply_candidate(candidate_path, target_path)
\ No newline at end of file
+        mod.apply_candidate(candidate_path, target_path)
+
+
+def test_collect_config_errors_reports_every_error_at_once():
+    mod = _load_module()
+    cfg = _valid_config()
+    cfg["outbounds"][0]["settings"]["vnext"][0]["port"] = 0
+    cfg["outbounds"].append(
+        {
+            "tag": "ss1",
+            "protocol": "shadowsocks",
+            "settings": {
+                "servers": [
+                    {"address": "1.2.3.4", "port": 8388, "method": "rc4-md5", "password": "x"}
+                ]
+            },
+        }
+    )
+    cfg["routing"]["rules"].append(
+        {"type": "field", "network": "tcp", "outboundTag": "missing-node"}
+    )
+
+    errors = mod.collect_config_errors(cfg)
+    assert len(errors) == 3
+    assert any("invalid port" in e for e in errors)
+    assert any("unsupported shadowsocks method" in e for e in errors)
+    assert any("unknown outboundTag" in e for e in errors)
+
+    with pytest.raises(ValueError, match="3 errors"):
+        mod.validate_candidate_config(cfg)
+
+
+def test_validate_candidate_config_checks_balancer_and_observatory_references():
+    mod = _load_module()
+    cfg = _valid_config()
+    cfg["routing"]["balancers"] = [
+        {"tag": "proxy-auto", "selector": ["node", "ghost"], "fallbackTag": "missing"}
+    ]
+    cfg["routing"]["rules"] = [
+        {"type": "field", "network": "tcp,udp", "balancerTag": "proxy-auto"}
+    ]
+    cfg["observatory"] = {"subjectSelector": ["node1", "phantom"]}
+
+    errors = mod.collect_config_errors(cfg)
+    assert "routing.balancers[0].selector matches no outbound tag: ghost" in errors
+    assert "routing.balancers[0] references unknown fallbackTag: missing" in errors
+    assert "observatory.subjectSelector matches no outbound tag: phantom" in errors
+    assert len(errors) == 3
+
+
+def test_validate_candidate_config_checks_user_ids():
+    mod = _load_module()
+    cfg = _valid_config()
+    users = cfg["outbounds"][0]["settings"]["vnext"][0]["users"]
+    users.append({"id": "11111111-1111-1111-1111-111111111111"})
+    users.append({"id": "short-custom-id"})
+    mod.validate_candidate_config(cfg)
+
+    users.append({"id": ""})
+    users.append({"id": "not-a-uuid-and-definitely-longer-than-thirty-bytes"})
+    errors = mod.collect_config_errors(cfg)
+    assert len(errors) == 2
+    assert all("invalid user id" in e for e in errors)
+
+
+def test_validate_candidate_config_handles_large_configs():
+    mod = _load_module()
+    cfg = _valid_config()
+    nodes = [
+        {
+            "tag": f"node{i}",
+            "protocol": "trojan",
+            "settings": {
+                "servers": [{"address": f"n{i}.example.com", "port": 443, "password": "p"}]
+            },
+        }
+        for i in range(2, 10002)
+    ]
+    cfg["outbounds"] = nodes + cfg["outbounds"]
+    cfg["routing"]["balancers"] = [
+        {"tag": "proxy-auto", "selector": [o["tag"] for o in nodes], "fallbackTag": "block"}
+    ]
+    cfg["routing"]["rules"].append(
+        {"type": "field", "network": "tcp,udp", "balancerTag": "proxy-auto"}
+    )
+    cfg["observatory"] = {"subjectSelector": ["node"]}
+
+    assert mod.collect_config_errors(cfg) == []
+
+
+def test_apply_candidate_writes_digest_manifest(tmp_path):
+    mod = _load_module()
+    candidate_path = tmp_path / "candidate.json"
+    target_path = tmp_path / "config.json"
+    payload = json.dumps(_valid_config(), ensure_ascii=False, indent=2).encode("utf-8")
+    candidate_path.write_bytes(payload)
+
+    assert mod.apply_candidate(candidate_path, target_path) is True
+
+    manifest = json.loads((tmp_path / ".config.json.manifest").read_text(encoding="utf-8"))
+    st = target_path.stat()
+    assert manifest["sha256"] == hashlib.sha256(payload).hexdigest()
+    assert manifest["size"] == st.st_size
+    assert manifest["mtime_ns"] == st.st_mtime_ns
+    assert manifest["inode"] == st.st_ino
+
+
+def test_apply_candidate_noop_check_uses_manifest_without_rehashing(tmp_path, monkeypatch):
+    mod = _load_module()
+    candidate_path = tmp_path / "candidate.json"
+    target_path = tmp_path / "config.json"
+    candidate_path.write_text(json.dumps(_valid_config()), encoding="utf-8")
+    assert mod.apply_candidate(candidate_path, target_path) is True
+
+    def _fail(_path):
+        raise AssertionError("live config must not be re-hashed")
+
+    monkeypatch.setattr(mod, "_sha256_file", _fail)
+    assert mod.apply_candidate(candidate_path, target_path) is False
+
+
+def test_apply_candidate_rehashes_when_manifest_is_stale(tmp_path):
+    mod = _load_module()
+    candidate_path = tmp_path / "candidate.json"
+    target_path = tmp_path / "config.json"
+    candidate_path.write_text(json.dumps(_valid_config()), encoding="utf-8")
+    assert mod.apply_candidate(candidate_path, target_path) is True
+
+    # Manual edit behind the pipeline's back: stat data no longer matches.
+    target_path.write_text(json.dumps(_valid_config(), indent=4), encoding="utf-8")
+    assert mod.apply_candidate(candidate_path, target_path) is True
+    assert target_path.read_bytes() == candidate_path.read_bytes()
+
+
+def test_apply_candidate_skips_parsing_streamed_candidate_when_unchanged(tmp_path, monkeypatch):
+    mod = _load_module()
+    candidate_path = tmp_path / "candidate.json"
+    target_path = tmp_path / "config.json"
+    mod.xray_json.write_config_stream(_valid_config(), str(candidate_path))
+    assert mod.apply_candidate(candidate_path, target_path) is True
+
+    def _fail(_path):
+        raise AssertionError("unchanged streamed candidate must not be parsed")
+
+    monkeypatch.setattr(mod, "_read_json_file", _fail)
+    assert mod.apply_candidate(candidate_path, target_path) is False
+
+
+def _write_fragments(directory, config):
+    directory.mkdir(exist_ok=True)
+    for stale in directory.glob("*.json"):
+        stale.unlink()
+    for idx, key in enumerate(("log", "inbounds", "outbounds", "routing")):
+        (directory / f"{idx:02d}_{key}.json").write_text(
+            json.dumps({key: config[key]}), encoding="utf-8"
+        )
+
+
+def test_apply_fragments_commits_generation_and_skips_unchanged(tmp_path):
+    mod = _load_module()
+    candidate_dir = tmp_path / "candidate.d"
+    target_dir = tmp_path / "etc" / "conf.d"
+    cfg = _valid_config()
+    _write_fragments(candidate_dir, cfg)
+
+    first = mod.apply_fragments(candidate_dir, target_dir)
+    assert first == ["00_log.json", "01_inbounds.json", "02_outbounds.json", "03_routing.json"]
+    assert target_dir.is_symlink()
+    inode_before = (target_dir / "02_outbounds.json").stat().st_ino
+
+    assert mod.apply_fragments(candidate_dir, target_dir) == []
+
+    cfg["routing"]["domainStrategy"] = "AsIs"
+    _write_fragments(candidate_dir, cfg)
+    assert mod.apply_fragments(candidate_dir, target_dir) == ["03_routing.json"]
+    # Unchanged fragments are hard-linked into the new generation, not rewritten.
+    assert (target_dir / "02_outbounds.json").stat().st_ino == inode_before
+    routing = json.loads((target_dir / "03_routing.json").read_text(encoding="utf-8"))
+    assert routing["routing"]["domainStrategy"] == "AsIs"
+
+    manifest = json.loads((tmp_path / "etc" / ".conf.d.manifest").read_text(encoding="utf-8"))
+    assert manifest["changed"] == ["03_routing.json"]
+    assert manifest["generation"] == os.readlink(target_dir)
+
+
+def test_apply_fragments_validates_whole_set_fail_closed(tmp_path):
+    mod = _load_module()
+    candidate_dir = tmp_path / "candidate.d"
+    target_dir = tmp_path / "etc" / "conf.d"
+    cfg = _valid_config()
+    _write_fragments(candidate_dir, cfg)
+    mod.apply_fragments(candidate_dir, target_dir)
+    generation = os.readlink(target_dir)
+
+    cfg["routing"]["rules"] = [{"type": "field", "outboundTag": "missing-node"}]
+    _write_fragments(candidate_dir, cfg)
+    with pytest.raises(ValueError, match="unknown outboundTag"):
+        mod.apply_fragments(candidate_dir, target_dir)
+
+    assert os.readlink(target_dir) == generation
+    generations = [p for p in (tmp_path / "etc").iterdir() if p.is_dir() and not p.is_symlink()]
+    assert len(generations) == 1
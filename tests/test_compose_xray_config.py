@@ -4,6 +4,7 @@ Tests for scripts/compose_xray_config.py
 """
 
 import importlib.util
+import json
 from pathlib import Path
 
 import pytest
@@ -192,3 +193,733 @@ def test_existing_direct_outbound_is_preserved():
     tags = [o.get("tag") for o in cfg["outbounds"]]
     assert tags.count("direct") == 1
     assert tags.count("block") == 1
+
+
+def test_write_config_fragments_splits_top_level_keys(tmp_path, monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("GATEWAY_MODE", raising=False)
+    cfg = mod.compose_config(_source_config_two_nodes())
+    out_dir = tmp_path / "final.d"
+    out_dir.mkdir()
+    (out_dir / "42_stale.json").write_text("{}", encoding="utf-8")
+
+    names = mod.write_config_fragments(cfg, out_dir)
+
+    assert names == [
+        "00_log.json",
+        "05_inbounds.json",
+        "06_outbounds.json",
+        "07_routing.json",
+        "08_observatory.json",
+    ]
+    assert sorted(p.name for p in out_dir.glob("*.json")) == names
+    merged = {}
+    for name in names:
+        merged.update(json.loads((out_dir / name).read_text(encoding="utf-8")))
+    assert merged == cfg
+
+
+def _health_outbound(tag, address):
+    return {
+        "tag": tag,
+        "protocol": "vless",
+        "settings": {
+            "vnext": [
+                {
+                    "address": address,
+                    "port": 443,
+                    "users": [{"id": "11111111-1111-1111-1111-111111111111"}],
+                }
+            ]
+        },
+    }
+
+
+def test_health_history_quarantines_and_ranks_nodes(tmp_path, monkeypatch):
+    import node_health
+
+    mod = _load_compose_module()
+    outbounds = [
+        _health_outbound("node1", "slow.example.com"),
+        _health_outbound("node2", "dead.example.com"),
+        _health_outbound("node3", "fast.example.com"),
+        _health_outbound("node4", "new.example.com"),
+    ]
+    history = node_health.HealthHistory()
+    for ts in range(10):
+        history.record(node_health.node_identity(outbounds[0]), ts, 400)
+        history.record(node_health.node_identity(outbounds[1]), ts, None)
+        history.record(node_health.node_identity(outbounds[2]), ts, 80)
+    db_path = tmp_path / "node-health.db"
+    node_health.save_history(db_path, history)
+    monkeypatch.setenv("XRAY_HEALTH_DB", str(db_path))
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+
+    tags = [o["tag"] for o in cfg["outbounds"]]
+    assert tags == ["node3", "node1", "node4", "quarantine-node2", "direct", "block"]
+    bal = cfg["routing"]["balancers"][0]
+    assert bal["selector"] == ["node3", "node1", "node4"]
+    assert "quarantine-node2" in cfg["observatory"]["subjectSelector"]
+
+
+def test_health_history_never_quarantines_every_node(tmp_path, monkeypatch):
+    import node_health
+
+    mod = _load_compose_module()
+    outbounds = [_health_outbound("node1", "a.example.com"), _health_outbound("node2", "b.example.com")]
+    history = node_health.HealthHistory()
+    for ts in range(10):
+        for outbound in outbounds:
+            history.record(node_health.node_identity(outbound), ts, None)
+    db_path = tmp_path / "node-health.db"
+    node_health.save_history(db_path, history)
+    monkeypatch.setenv("XRAY_HEALTH_DB", str(db_path))
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    assert cfg["routing"]["balancers"][0]["selector"] == ["node1", "node2"]
+
+
+def test_stats_listen_adds_metrics_block(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.setenv("XRAY_STATS_LISTEN", "127.0.0.1:11111")
+
+    cfg = mod.compose_config(_source_config_two_nodes())
+    assert cfg["metrics"] == {"tag": "metrics", "listen": "127.0.0.1:11111"}
+
+
+def test_least_load_autotune_from_history_and_name_hints(tmp_path, monkeypatch):
+    import node_health
+
+    mod = _load_compose_module()
+    outbounds = [
+        _health_outbound("node1", "a.example.com"),
+        _health_outbound("node2", "b.example.com"),
+        _health_outbound("node3", "c.example.com"),
+        _health_outbound("node10", "d.example.com"),
+    ]
+    history = node_health.HealthHistory()
+    for ts, (rtt1, rtt2, rtt3, rtt10) in enumerate([(100, 200, 300, 400)] * 8):
+        history.record(node_health.node_identity(outbounds[0]), ts, rtt1)
+        history.record(node_health.node_identity(outbounds[1]), ts, rtt2)
+        history.record(node_health.node_identity(outbounds[2]), ts, rtt3)
+        history.record(node_health.node_identity(outbounds[3]), ts, rtt10 if ts % 2 else None)
+    db_path = tmp_path / "node-health.db"
+    node_health.save_history(db_path, history)
+    monkeypatch.setenv("XRAY_HEALTH_DB", str(db_path))
+    monkeypatch.setenv("XRAY_BALANCER_STRATEGY", "leastLoad")
+    monkeypatch.setenv("XRAY_BALANCER_AUTOTUNE", "1")
+    monkeypatch.setenv("XRAY_BALANCER_MAX_RTT", "3s")
+
+    src = {"outbounds": outbounds, "remarks": {"node2": "🇩🇪 DE x1.5"}}
+    settings = mod.compose_config(src)["routing"]["balancers"][0]["strategy"]["settings"]
+
+    assert settings["baselines"] == ["200ms", "300ms", "400ms"]
+    assert settings["expected"] == 3
+    assert settings["maxRTT"] == "3s"
+    # Exact-match regexps: node1 would otherwise also hit node10.
+    assert {"regexp": True, "match": "^node2$", "value": 1.5} in settings["costs"]
+    assert {"regexp": True, "match": "^node10$", "value": 2.0} in settings["costs"]
+    assert all(c["match"] != "^node1$" for c in settings["costs"])
+
+
+def test_least_load_autotune_without_history_uses_name_hints_only(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_BALANCER_STRATEGY", "leastLoad")
+    monkeypatch.setenv("XRAY_BALANCER_AUTOTUNE", "1")
+
+    src = _source_config_two_nodes()
+    src["remarks"] = {"node1": "NL 2x"}
+    settings = mod.compose_config(src)["routing"]["balancers"][0]["strategy"]["settings"]
+
+    assert settings == {"costs": [{"regexp": True, "match": "^node1$", "value": 2.0}]}
+
+
+def test_least_load_autotune_sizes_expected_per_balancer(tmp_path, monkeypatch):
+    import node_health
+
+    mod = _load_compose_module()
+    outbounds = [_health_outbound(f"node{i}", f"{i}.example.com") for i in range(1, 6)]
+    history = node_health.HealthHistory()
+    for ts in range(8):
+        for idx, outbound in enumerate(outbounds, start=1):
+            history.record(node_health.node_identity(outbound), ts, idx * 100)
+    db_path = tmp_path / "node-health.db"
+    node_health.save_history(db_path, history)
+    monkeypatch.setenv("XRAY_HEALTH_DB", str(db_path))
+    monkeypatch.setenv("XRAY_BALANCER_STRATEGY", "leastLoad")
+    monkeypatch.setenv("XRAY_BALANCER_AUTOTUNE", "1")
+    monkeypatch.setenv("XRAY_REGION_MODE", "1")
+    monkeypatch.setenv("XRAY_REGION_GROUPS", "eu=DE,NL")
+    src = {
+        "outbounds": outbounds,
+        "remarks": {"node1": "DE 1", "node2": "NL 2", "node3": "US 3", "node4": "JP 4", "node5": "JP 5"},
+    }
+
+    balancers = {b["tag"]: b for b in mod.compose_config(src)["routing"]["balancers"]}
+
+    assert balancers["proxy-auto"]["strategy"]["settings"]["expected"] == 3
+    assert balancers["proxy-eu"]["strategy"]["settings"]["expected"] == 2
+    assert balancers["proxy-us"]["strategy"]["settings"]["expected"] == 1
+    assert all("_medians" not in b["strategy"]["settings"] for b in balancers.values())
+
+
+def test_region_mode_groups_nodes_and_routes_categories(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_REGION_MODE", "1")
+    monkeypatch.setenv("XRAY_REGION_GROUPS", "eu=DE,NL")
+    monkeypatch.setenv("XRAY_REGION_ROUTES", "eu=geosite:google,geoip:de,10.20.0.0/16;jp=geosite:line")
+    outbounds = [
+        _health_outbound("node1", "a.example.com"),
+        _health_outbound("node2", "b.example.com"),
+        _health_outbound("node3", "c.example.com"),
+        _health_outbound("node10", "d.example.com"),
+    ]
+    src = {
+        "outbounds": outbounds,
+        "remarks": {"node1": "🇩🇪 Frankfurt", "node2": "Amsterdam [NL]", "node3": "US West", "node10": "Fast"},
+    }
+
+    cfg = mod.compose_config(src)
+    tags = [o["tag"] for o in cfg["outbounds"]]
+    assert tags[:4] == ["eu.node1", "eu.node2", "us.node3", "node10"]
+
+    balancers = {b["tag"]: b for b in cfg["routing"]["balancers"]}
+    assert balancers["proxy-auto"]["selector"] == ["eu.node1", "eu.node2", "us.node3", "node10"]
+    assert balancers["proxy-eu"]["selector"] == ["eu."]
+    assert balancers["proxy-eu"]["fallbackTag"] == "to-proxy-auto"
+    assert balancers["proxy-us"]["fallbackTag"] == "to-proxy-auto"
+
+    # Region fallback re-enters routing through a loopback outbound to the global pool.
+    assert {
+        "tag": "to-proxy-auto",
+        "protocol": "loopback",
+        "settings": {"inboundTag": "via-proxy-auto"},
+    } in cfg["outbounds"]
+    rules = cfg["routing"]["rules"]
+    assert rules[0] == {"type": "field", "inboundTag": ["via-proxy-auto"], "balancerTag": "proxy-auto"}
+    assert rules[-1]["balancerTag"] == "proxy-auto"
+    assert {"type": "field", "domain": ["geosite:google"], "balancerTag": "proxy-eu"} in rules
+    assert {"type": "field", "ip": ["geoip:de", "10.20.0.0/16"], "balancerTag": "proxy-eu"} in rules
+    assert all(r.get("balancerTag") != "proxy-jp" for r in rules)
+    assert cfg["observatory"]["subjectSelector"] == ["eu.", "us.", "node10"]
+
+
+def test_region_mode_off_keeps_tags(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_REGION_MODE", raising=False)
+    src = _source_config_two_nodes()
+    src["remarks"] = {"node1": "🇩🇪 DE", "node2": "🇺🇸 US"}
+
+    cfg = mod.compose_config(src)
+    assert [b["tag"] for b in cfg["routing"]["balancers"]] == ["proxy-auto"]
+    assert cfg["routing"]["balancers"][0]["selector"] == ["node1", "node2"]
+
+
+def test_dest_groups_add_probe_inbounds_rules_and_balancers(tmp_path, monkeypatch):
+    import dest_latency
+    import node_health
+
+    mod = _load_compose_module()
+    outbounds = [
+        _health_outbound("node1", "a.example.com"),
+        _health_outbound("node2", "b.example.com"),
+        _health_outbound("node3", "c.example.com"),
+    ]
+    db_path = tmp_path / "dest-latency.json"
+    dest_latency.save_db(
+        db_path,
+        {
+            "version": dest_latency.DB_VERSION,
+            "groups": {
+                "saas": {"assigned": [node_health.node_identity(outbounds[2]).hex()], "scores": {}},
+                "video": {"assigned": ["ffffffffffffffff"], "scores": {}},
+            },
+        },
+    )
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_DEST_PROBE_PORT_BASE", "20800")
+    monkeypatch.setenv("XRAY_DEST_PROBE_MAX_NODES", "2")
+    monkeypatch.setenv("XRAY_DEST_LATENCY_DB", str(db_path))
+    monkeypatch.setenv("XRAY_DEST_GROUPS", "saas=api.example.com,9.9.9.9;video=www.youtube.com")
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    probes = [i for i in cfg["inbounds"] if i.get("tag", "").startswith("probe-")]
+    assert [(i["tag"], i["port"], i["listen"]) for i in probes] == [
+        ("probe-node1", 20800, "127.0.0.1"),
+        ("probe-node2", 20801, "127.0.0.1"),
+    ]
+
+    rules = cfg["routing"]["rules"]
+    assert rules[0] == {"type": "field", "inboundTag": ["probe-node1"], "outboundTag": "node1"}
+    assert {"type": "field", "domain": ["domain:api.example.com"], "balancerTag": "dest-saas"} in rules
+    assert {"type": "field", "ip": ["9.9.9.9"], "balancerTag": "dest-saas"} in rules
+    assert rules[-1]["balancerTag"] == "proxy-auto"
+
+    balancers = {b["tag"]: b for b in cfg["routing"]["balancers"]}
+    assert set(balancers) == {"proxy-auto", "dest-saas"}
+    assert balancers["dest-saas"]["selector"] == ["node3"]
+    assert balancers["dest-saas"]["fallbackTag"] == "to-proxy-auto"
+
+
+def test_burst_observatory_with_sampling_and_connectivity(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.setenv("XRAY_OBSERVATORY_MODE", "burst")
+    monkeypatch.setenv("XRAY_PROBE_SAMPLING", "2")
+    monkeypatch.setenv("XRAY_PROBE_TIMEOUT", "3s")
+    monkeypatch.setenv("XRAY_PROBE_CONNECTIVITY_URL", "http://connectivitycheck.gstatic.com/generate_204")
+
+    cfg = mod.compose_config(_source_config_two_nodes())
+    assert "observatory" not in cfg
+    assert cfg["burstObservatory"] == {
+        "subjectSelector": ["node1", "node2"],
+        "pingConfig": {
+            "destination": "https://www.google.com/generate_204",
+            "connectivity": "http://connectivitycheck.gstatic.com/generate_204",
+            "interval": "20s",
+            "sampling": 2,
+            "timeout": "3s",
+        },
+    }
+
+
+def test_active_pool_cap_puts_rest_on_standby_and_scales_probe_interval(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_BALANCER_ACTIVE_MAX", "2")
+    monkeypatch.setenv("XRAY_PROBE_BUDGET_PER_MIN", "12")
+    outbounds = [_health_outbound(f"node{i}", f"n{i}.example.com") for i in (1, 2, 3, 10)]
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    tags = [o["tag"] for o in cfg["outbounds"]]
+    assert tags[:4] == ["node1", "node2", "standby-node3", "standby-node10"]
+    assert cfg["routing"]["balancers"][0]["selector"] == ["node1", "node2"]
+    assert cfg["observatory"]["subjectSelector"] == ["node1", "node2"]
+    assert cfg["observatory"]["probeInterval"] == "10s"
+
+
+def test_invalid_observatory_mode_raises(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.setenv("XRAY_OBSERVATORY_MODE", "fast")
+    with pytest.raises(ValueError, match="XRAY_OBSERVATORY_MODE"):
+        mod.compose_config(_source_config_two_nodes())
+
+
+def _tier_outbound(tag, security, network="tcp", flow=""):
+    outbound = _health_outbound(tag, f"{tag}.example.com")
+    outbound["settings"]["vnext"][0]["users"] = [{"id": "11111111-1111-1111-1111-111111111111", "flow": flow}]
+    outbound["streamSettings"] = {"network": network, "security": security}
+    return outbound
+
+
+def test_balancer_tiers_chain_through_loopback_to_block(tmp_path, monkeypatch):
+    import node_health
+
+    mod = _load_compose_module()
+    outbounds = [
+        _tier_outbound("node1", "reality", flow="xtls-rprx-vision"),
+        _tier_outbound("node2", "tls", network="ws"),
+        _tier_outbound("node3", "none"),
+        _tier_outbound("node10", "reality"),
+    ]
+    history = node_health.HealthHistory()
+    for ts in range(10):
+        history.record(node_health.node_identity(outbounds[0]), ts, 100)
+        history.record(node_health.node_identity(outbounds[3]), ts, 100 if ts % 2 else None)
+    db_path = tmp_path / "node-health.db"
+    node_health.save_history(db_path, history)
+    monkeypatch.setenv("XRAY_HEALTH_DB", str(db_path))
+    monkeypatch.setenv("XRAY_BALANCER_TIERS", "reality;tls,cdn")
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    tags = [o["tag"] for o in cfg["outbounds"]]
+    # node10 is REALITY but fails half its probes, so it is demoted to the second tier;
+    # plain node3 is not listed and lands in the last tier.
+    assert set(tags[:4]) == {"t1.node1", "t2.node2", "t2.node3", "t2.node10"}
+
+    balancers = {b["tag"]: b for b in cfg["routing"]["balancers"]}
+    assert balancers["proxy-auto"]["selector"] == ["t1."]
+    assert balancers["proxy-auto"]["fallbackTag"] == "to-proxy-tier2"
+    assert balancers["proxy-tier2"]["selector"] == ["t2."]
+    assert balancers["proxy-tier2"]["fallbackTag"] == "block"
+
+    assert {
+        "tag": "to-proxy-tier2",
+        "protocol": "loopback",
+        "settings": {"inboundTag": "via-proxy-tier2"},
+    } in cfg["outbounds"]
+    assert cfg["outbounds"][-2:] == [
+        {"tag": "direct", "protocol": "freedom", "settings": {}},
+        {"tag": "block", "protocol": "blackhole", "settings": {}},
+    ]
+    rules = cfg["routing"]["rules"]
+    assert rules[0] == {"type": "field", "inboundTag": ["via-proxy-tier2"], "balancerTag": "proxy-tier2"}
+    assert rules[-1]["balancerTag"] == "proxy-auto"
+    assert cfg["observatory"]["subjectSelector"] == ["t1.", "t2."]
+
+
+def test_invalid_balancer_tier_class_raises(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.setenv("XRAY_BALANCER_TIERS", "reality;quic")
+    with pytest.raises(ValueError, match="XRAY_BALANCER_TIERS"):
+        mod.compose_config(_source_config_two_nodes())
+
+
+def test_colliding_numbered_tags_are_zero_padded():
+    mod = _load_compose_module()
+    outbounds = [_health_outbound(f"node{i}", f"n{i}.example.com") for i in range(1, 12)]
+    src = {"outbounds": outbounds, "remarks": {"node1": "first", "node11": "last"}}
+
+    padded, remarks = mod.make_tags_prefix_free(mod.reorder_outbounds(mod.ensure_direct_block(outbounds)), src["remarks"])
+    assert [o["tag"] for o in padded[:11]] == [f"node{i:02d}" for i in range(1, 12)]
+    assert remarks == {"node01": "first", "node11": "last"}
+
+    untouched = _source_config_two_nodes()["outbounds"]
+    assert mod.make_tags_prefix_free(untouched, {}) == (untouched, {})
+
+
+def test_numbered_tags_are_kept_unless_a_subset_selector_needs_padding(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.delenv("XRAY_DEST_LATENCY_DB", raising=False)
+    monkeypatch.delenv("XRAY_UDP_ROUTING", raising=False)
+    outbounds = [_health_outbound(f"node{i}", f"n{i}.example.com") for i in range(1, 13)]
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    assert [o["tag"] for o in cfg["outbounds"][:12]] == [f"node{i}" for i in range(1, 13)]
+    assert cfg["routing"]["balancers"][0]["selector"] == [f"node{i}" for i in range(1, 13)]
+
+    # The UDP balancer lists single nodes, so node1 must not also select node10..node12.
+    monkeypatch.setenv("XRAY_UDP_ROUTING", "1")
+    cfg = mod.compose_config({"outbounds": outbounds})
+    assert [o["tag"] for o in cfg["outbounds"][:12]] == [f"node{i:02d}" for i in range(1, 13)]
+
+
+def test_udp_routing_prefers_native_udp_nodes(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_UDP_ROUTING", "1")
+    monkeypatch.setenv("XRAY_SS_UOT", "1")
+    outbounds = [
+        _tier_outbound("node1", "reality", flow="xtls-rprx-vision"),
+        _tier_outbound("node2", "tls", network="ws"),
+        {
+            "tag": "node3",
+            "protocol": "shadowsocks",
+            "settings": {"servers": [{"address": "ss.example.com", "port": 8388, "method": "aes-128-gcm", "password": "x"}]},
+        },
+    ]
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    by_tag = {o["tag"]: o for o in cfg["outbounds"]}
+    rules = cfg["routing"]["rules"]
+    balancers = {b["tag"]: b for b in cfg["routing"]["balancers"]}
+
+    assert balancers["proxy-udp"]["selector"] == ["node3"]
+    assert balancers["proxy-udp"]["fallbackTag"] == "to-proxy-auto"
+    assert {"type": "field", "network": "udp", "balancerTag": "proxy-udp"} in rules
+    assert all(r.get("port") != "443" for r in rules)
+    assert by_tag["node3"]["settings"]["servers"][0]["uot"] is True
+    assert "mux" not in by_tag["node1"]
+    assert "uot" not in outbounds[2]["settings"]["servers"][0]
+
+
+def test_udp_routing_blocks_quic_without_native_udp_nodes(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_UDP_ROUTING", "1")
+    outbounds = [
+        _tier_outbound("node1", "reality", flow="xtls-rprx-vision"),
+        _tier_outbound("node2", "tls", network="ws"),
+    ]
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    rules = cfg["routing"]["rules"]
+    quic = {"type": "field", "network": "udp", "port": "443", "outboundTag": "block"}
+    udp = {"type": "field", "network": "udp", "balancerTag": "proxy-udp"}
+    assert rules.index(quic) < rules.index(udp) < len(rules) - 1
+
+    balancers = {b["tag"]: b for b in cfg["routing"]["balancers"]}
+    assert balancers["proxy-udp"]["selector"] == ["node1"]
+    node1 = next(o for o in cfg["outbounds"] if o["tag"] == "node1")
+    assert node1["mux"] == {
+        "enabled": True,
+        "concurrency": -1,
+        "xudpConcurrency": 16,
+        "xudpProxyUDP443": "reject",
+    }
+
+
+def test_invalid_quic_policy_raises(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.setenv("XRAY_UDP_ROUTING", "1")
+    monkeypatch.setenv("XRAY_QUIC_POLICY", "drop")
+    with pytest.raises(ValueError, match="XRAY_QUIC_POLICY"):
+        mod.compose_config(_source_config_two_nodes())
+
+
+def test_mux_only_for_eligible_outbounds(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_MUX", "1")
+    monkeypatch.setenv("XRAY_MUX_CONCURRENCY", "4")
+    outbounds = [
+        _tier_outbound("node1", "reality", flow="xtls-rprx-vision"),
+        _tier_outbound("node2", "tls", network="ws"),
+        _tier_outbound("node3", "tls", network="grpc"),
+        _tier_outbound("node4", "reality"),
+    ]
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    by_tag = {o["tag"]: o for o in cfg["outbounds"]}
+    assert "mux" not in by_tag["node1"]
+    assert "mux" not in by_tag["node3"]
+    assert by_tag["node2"]["mux"] == {
+        "enabled": True,
+        "concurrency": 4,
+        "xudpConcurrency": 16,
+        "xudpProxyUDP443": "reject",
+    }
+    assert by_tag["node4"]["mux"]["concurrency"] == 4
+
+
+def test_mux_keeps_tcp_concurrency_with_udp_routing(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_MUX", "1")
+    monkeypatch.setenv("XRAY_UDP_ROUTING", "1")
+    monkeypatch.setenv("XRAY_QUIC_POLICY", "allow")
+    outbounds = [
+        _tier_outbound("node1", "reality", flow="xtls-rprx-vision"),
+        _tier_outbound("node2", "reality"),
+    ]
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    by_tag = {o["tag"]: o for o in cfg["outbounds"]}
+    assert by_tag["node1"]["mux"]["concurrency"] == -1
+    assert by_tag["node2"]["mux"]["concurrency"] == 8
+    assert by_tag["node2"]["mux"]["xudpProxyUDP443"] == "allow"
+
+
+def test_sockopt_profile_applies_to_outbounds_and_lan_inbounds(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("GATEWAY_MODE", "1")
+    monkeypatch.setenv("XRAY_SOCKOPT_PROFILE", "latency")
+    monkeypatch.setenv("XRAY_SOCKOPT_NODE_OVERRIDES", "mobile hk=mobile;node2=tcpCongestion:cubic,tcpMptcp:false")
+    src = _source_config_two_nodes()
+    src["outbounds"][0]["streamSettings"] = {"network": "tcp", "sockopt": {"mark": 255}}
+    src["remarks"] = {"node1": "Mobile HK 1"}
+
+    cfg = mod.compose_config(src)
+    by_tag = {o["tag"]: o for o in cfg["outbounds"]}
+    node1 = by_tag["node1"]["streamSettings"]["sockopt"]
+    assert node1["mark"] == 255
+    assert node1["tcpMptcp"] is True
+    assert node1["tcpKeepAliveIdle"] == 15
+    node2 = by_tag["node2"]["streamSettings"]["sockopt"]
+    assert node2["tcpCongestion"] == "cubic"
+    assert node2["tcpMptcp"] is False
+    assert node2["tcpUserTimeout"] == 10000
+    assert "streamSettings" not in by_tag["direct"]
+
+    for inbound in cfg["inbounds"]:
+        sockopt = inbound["streamSettings"]["sockopt"]
+        assert sockopt["tcpFastOpen"] is True
+        assert "tcpUserTimeout" not in sockopt
+    tproxy = next(i for i in cfg["inbounds"] if i.get("tag") == "tproxy-in")
+    assert tproxy["streamSettings"]["sockopt"]["tproxy"] == "tproxy"
+
+
+def test_unknown_sockopt_profile_raises(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.setenv("XRAY_SOCKOPT_PROFILE", "turbo")
+    with pytest.raises(ValueError, match="sockopt profile"):
+        mod.compose_config(_source_config_two_nodes())
+
+
+def test_traffic_profile_sets_sniffing_log_and_policy(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("GATEWAY_MODE", "1")
+    monkeypatch.setenv("XRAY_TRAFFIC_PROFILE", "max-throughput")
+    monkeypatch.setenv("XRAY_POLICY_CONN_IDLE", "60")
+
+    cfg = mod.compose_config(_source_config())
+
+    assert cfg["log"] == {"loglevel": "warning", "access": "none"}
+    assert cfg["policy"] == {
+        "levels": {"0": {"handshake": 4, "connIdle": 60, "uplinkOnly": 1, "downlinkOnly": 1}}
+    }
+    by_protocol = {i["protocol"]: i["sniffing"] for i in cfg["inbounds"]}
+    assert by_protocol["http"]["metadataOnly"] is True
+    assert by_protocol["socks"]["destOverride"] == ["http", "tls"]
+    # The gateway inbound only sees IPs and keeps content sniffing for domain routing.
+    assert "metadataOnly" not in by_protocol["dokodemo-door"]
+
+
+def test_traffic_overrides_without_profile(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_TRAFFIC_PROFILE", raising=False)
+    monkeypatch.setenv("XRAY_SNIFFING", "none")
+    monkeypatch.setenv("XRAY_LOG_LEVEL", "error")
+
+    cfg = mod.compose_config(_source_config())
+
+    assert cfg["log"] == {"loglevel": "error"}
+    assert "policy" not in cfg
+    assert all(i["sniffing"] == {"enabled": False} for i in cfg["inbounds"])
+
+    monkeypatch.setenv("XRAY_TRAFFIC_PROFILE", "turbo")
+    with pytest.raises(ValueError, match="traffic profile"):
+        mod.compose_config(_source_config())
+
+
+def test_memory_sizing_from_cgroup_limit(tmp_path, monkeypatch, capsys):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.delenv("XRAY_TRAFFIC_PROFILE", raising=False)
+    monkeypatch.delenv("XRAY_MEMORY_LIMIT_MB", raising=False)
+    (tmp_path / "memory.max").write_text(f"{256 * 1024 * 1024}\n", encoding="utf-8")
+    monkeypatch.setenv("XRAY_CGROUP_ROOT", str(tmp_path))
+    monkeypatch.setenv("XRAY_EXPECTED_CONNECTIONS", "1000")
+    monkeypatch.setenv("XRAY_POLICY_UPLINK_ONLY", "3")
+
+    cfg = mod.compose_config(_source_config())
+
+    # 50% of 256 MiB over 2 x 1000 buffers -> 64 kB; idle timeouts shrink with it.
+    assert cfg["policy"]["levels"]["0"] == {
+        "bufferSize": 64,
+        "connIdle": 60,
+        "uplinkOnly": 3,
+        "downlinkOnly": 2,
+    }
+    err = capsys.readouterr().err
+    assert "limit=256MiB (cgroup v2) connections=1000 bufferSize=64kB" in err
+
+
+def test_memory_sizing_keeps_defaults_when_budget_allows(tmp_path, monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.delenv("XRAY_TRAFFIC_PROFILE", raising=False)
+    monkeypatch.delenv("XRAY_MEMORY_LIMIT_MB", raising=False)
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "memory" / "memory.limit_in_bytes").write_text("9223372036854771712\n", encoding="utf-8")
+    monkeypatch.setenv("XRAY_CGROUP_ROOT", str(tmp_path))
+    monkeypatch.setenv("XRAY_EXPECTED_CONNECTIONS", "100")
+
+    assert "policy" not in mod.compose_config(_source_config())
+
+    monkeypatch.setenv("XRAY_MEMORY_LIMIT_MB", "4096")
+    cfg = mod.compose_config(_source_config())
+    assert cfg["policy"]["levels"]["0"] == {"bufferSize": 512}
+
+
+def test_memory_sizing_needs_xray_limit_and_floors_buffer(monkeypatch, capsys):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.delenv("XRAY_TRAFFIC_PROFILE", raising=False)
+    monkeypatch.delenv("XRAY_MEMORY_LIMIT_MB", raising=False)
+    monkeypatch.delenv("XRAY_CGROUP_ROOT", raising=False)
+    monkeypatch.setenv("XRAY_EXPECTED_CONNECTIONS", "100000")
+
+    # The updater's own cgroup is never consulted.
+    assert "policy" not in mod.compose_config(_source_config())
+    assert "set XRAY_MEMORY_LIMIT_MB" in capsys.readouterr().err
+
+    monkeypatch.setenv("XRAY_MEMORY_LIMIT_MB", "64")
+    cfg = mod.compose_config(_source_config())
+    assert cfg["policy"]["levels"]["0"]["bufferSize"] == mod.XRAY_MIN_BUFFER_KB
+    assert "bufferSize clamped to 4kB" in capsys.readouterr().err
+
+
+def test_handover_adds_reuseport_to_every_inbound(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("GATEWAY_MODE", "1")
+    monkeypatch.setenv("XRAY_HANDOVER", "1")
+
+    cfg = mod.compose_config(_source_config())
+
+    for inbound in cfg["inbounds"]:
+        assert inbound["streamSettings"]["sockopt"]["customSockopt"] == [mod.REUSEPORT_SOCKOPT]
+    tproxy = next(i for i in cfg["inbounds"] if i.get("tag") == "tproxy-in")
+    assert tproxy["streamSettings"]["sockopt"]["tproxy"] == "tproxy"
+    # xray_watch.sh removes the old process's inbounds by tag.
+    assert [i["tag"] for i in cfg["inbounds"]] == ["http-in", "socks-in", "tproxy-in"]
+
+
+def test_handover_serves_metrics_through_reuseport_inbound(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_STATS_LISTEN", "127.0.0.1:11111")
+    monkeypatch.setenv("XRAY_HANDOVER", "1")
+
+    cfg = mod.compose_config(_source_config_two_nodes())
+
+    # metrics.listen would be a second, non-reuseport listener on the same port.
+    assert cfg["metrics"] == {"tag": "metrics"}
+    metrics_in = next(i for i in cfg["inbounds"] if i["tag"] == mod.METRICS_INBOUND_TAG)
+    assert (metrics_in["listen"], metrics_in["port"], metrics_in["protocol"]) == (
+        "127.0.0.1",
+        11111,
+        "dokodemo-door",
+    )
+    assert metrics_in["streamSettings"]["sockopt"]["customSockopt"] == [mod.REUSEPORT_SOCKOPT]
+    assert {"type": "field", "inboundTag": ["metrics-in"], "outboundTag": "metrics"} in cfg["routing"]["rules"]
+
+
+def test_handover_metrics_config_passes_apply_validation(monkeypatch):
+    import apply_xray_config
+
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_STATS_LISTEN", "127.0.0.1:11111")
+    monkeypatch.setenv("XRAY_HANDOVER", "1")
+
+    cfg = mod.compose_config(_source_config_two_nodes())
+
+    # The metrics-in rule targets the tag Xray registers for the metrics block.
+    apply_xray_config.validate_candidate_config(cfg)
+
+
+def test_mux_follows_quic_policy_outside_udp_pool(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_MUX", "1")
+    monkeypatch.setenv("XRAY_UDP_ROUTING", "1")
+    monkeypatch.setenv("XRAY_QUIC_POLICY", "allow")
+    outbounds = [
+        _tier_outbound("node1", "reality", flow="xtls-rprx-vision"),
+        # ws is never in the UDP pool, so only apply_mux sets its XUDP options.
+        _tier_outbound("node2", "tls", network="ws"),
+    ]
+
+    cfg = mod.compose_config({"outbounds": outbounds})
+    by_tag = {o["tag"]: o for o in cfg["outbounds"]}
+    assert by_tag["node2"]["mux"]["xudpProxyUDP443"] == "allow"
+    assert all(r.get("port") != "443" for r in cfg["routing"]["rules"])
+
+    monkeypatch.delenv("XRAY_UDP_ROUTING")
+    monkeypatch.setenv("XRAY_QUIC_POLICY", "block")
+    cfg = mod.compose_config({"outbounds": outbounds})
+    by_tag = {o["tag"]: o for o in cfg["outbounds"]}
+    assert by_tag["node2"]["mux"]["xudpProxyUDP443"] == "reject"
+
+
+def test_sockopt_overrides_match_whole_words_or_globs(monkeypatch):
+    mod = _load_compose_module()
+    monkeypatch.delenv("XRAY_HEALTH_DB", raising=False)
+    monkeypatch.setenv("XRAY_SOCKOPT_NODE_OVERRIDES", "de=mobile;us*=tcpCongestion:cubic")
+    src = _source_config_two_nodes()
+    src["outbounds"].append(_health_outbound("node3", "c.example.com"))
+    src["remarks"] = {"node1": "Moscow nodes", "node2": "🇩🇪 DE-2 Frankfurt", "node3": "USA East"}
+
+    by_tag = {o["tag"]: o for o in mod.compose_config(src)["outbounds"]}
+
+    # "de" is a word in "DE-2" only, not a substring of "Moscow nodes".
+    assert "streamSettings" not in by_tag["node1"]
+    assert by_tag["node2"]["streamSettings"]["sockopt"]["tcpMptcp"] is True
+    assert by_tag["node3"]["streamSettings"]["sockopt"] == {"tcpCongestion": "cubic"}
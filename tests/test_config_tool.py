@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/config_tool.py
+"""
+
+import importlib.util
+import json
+from pathlib import Path
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "config_tool.py"
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("config_tool", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_is_xray_config_rejects_singbox_and_links():
+    mod = _load_module()
+    assert mod.is_xray_config({"inbounds": [], "outbounds": [{"protocol": "vless"}]})
+    assert not mod.is_xray_config({"inbounds": [], "outbounds": [{"type": "vless"}]})
+    assert not mod.is_xray_config({"outbounds": [{"protocol": "vless"}]})
+
+
+def test_require_merges_fragment_directory(tmp_path, monkeypatch):
+    mod = _load_module()
+    (tmp_path / "00_inbounds.json").write_text(json.dumps({"inbounds": []}))
+    (tmp_path / "10_outbounds.json").write_text(json.dumps({"outbounds": [{"protocol": "vless"}]}))
+    assert set(mod.merged(tmp_path)) == {"inbounds", "outbounds"}
+
+    monkeypatch.setenv("HTTP_PROXY_PORT", "8080")
+    data = mod.normalize_ports({"inbounds": [{"protocol": "http", "port": 1}, {"protocol": "vless", "port": 2}]})
+    assert [i["port"] for i in data["inbounds"]] == [8080, 2]
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/dest_latency.py
+"""
+
+import importlib.util
+from pathlib import Path
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "dest_latency.py"
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("dest_latency", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_parse_dest_groups_and_route_items():
+    mod = _load_module()
+    groups = mod.parse_dest_groups("SaaS=api.example.com,https://x.example.com/health; video=1.2.3.4;bad")
+    assert groups == {
+        "saas": ["api.example.com", "https://x.example.com/health"],
+        "video": ["1.2.3.4"],
+    }
+    assert mod.probe_url("api.example.com") == "https://api.example.com/"
+    assert mod.route_items("https://x.example.com/health") == ("domain", "domain:x.example.com")
+    assert mod.route_items("1.2.3.4") == ("ip", "1.2.3.4")
+
+
+def test_update_group_applies_hysteresis():
+    mod = _load_module()
+    state = mod.update_group({}, {"a": 100.0, "b": 200.0, "c": 300.0}, 1, 0.2, 1)
+    assert state["assigned"] == ["a"]
+
+    # b is now a bit faster than a (after smoothing), but not by the hysteresis margin.
+    state = mod.update_group(state, {"a": 120.0, "b": 50.0, "c": 300.0}, 1, 0.2, 2)
+    assert state["scores"] == {"a": 106.0, "b": 155.0, "c": 300.0}
+    assert state["assigned"] == ["a"]
+
+    for ts in range(3, 8):
+        state = mod.update_group(state, {"a": 120.0, "b": 50.0, "c": 300.0}, 1, 0.2, ts)
+    assert state["assigned"] == ["b"]
+
+    # A failed assigned node is replaced immediately.
+    state = mod.update_group(state, {"a": 120.0, "b": None, "c": 300.0}, 1, 0.2, 9)
+    assert state["assigned"] == ["a"]
+
+
+def test_measure_round_records_failures_per_identity():
+    mod = _load_module()
+    db = {"version": mod.DB_VERSION, "groups": {}}
+    timings = {20800: 80.0, 20801: None}
+
+    def fake_measure(port, url, timeout):
+        if timings[port] is None:
+            raise OSError("timed out")
+        return timings[port]
+
+    probes = mod.measure_round(
+        db,
+        {"saas": ["api.example.com"]},
+        {"node1": 20800, "node2": 20801},
+        {"node1": b"\x01" * 8, "node2": b"\x02" * 8},
+        measure=fake_measure,
+        now=10,
+    )
+    assert probes == 2
+    assert db["groups"]["saas"] == {
+        "assigned": ["01" * 8],
+        "scores": {"01" * 8: 80.0, "02" * 8: None},
+        "updated": 10,
+    }
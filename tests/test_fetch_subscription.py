@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/fetch_subscription.py
+"""
+
+import gzip
+import http.server
+import importlib.util
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "fetch_subscription.py"
+PAYLOAD = b"vless://11111111-1111-1111-1111-111111111111@example.com:443#node\n" * 2000
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("fetch_subscription", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    # dataclasses resolve string annotations through sys.modules.
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.accept_encodings.append(self.headers.get("Accept-Encoding"))
+        if self.path == "/old":
+            self._send(302, headers={"Location": "/sub"})
+        elif self.path == "/big-redirect":
+            self._send(302, b"\0" * (8 * 1024 * 1024), {"Location": "/sub"})
+        elif self.path == "/sub":
+            self._send(
+                200,
+                gzip.compress(PAYLOAD),
+                {"Content-Encoding": "gzip", "profile-update-interval": "12"},
+            )
+        elif self.path == "/slow":
+            time.sleep(1.0)
+            self._send(200, b"slow mirror")
+        elif self.path == "/fast":
+            self._send(200, b"fast mirror", {"profile-update-interval": "6"})
+        elif self.path == "/empty":
+            self._send(200, b"", {"Retry-After": "3600"})
+        elif self.path == "/bomb":
+            self._send(200, gzip.compress(b"\0" * (8 * 1024 * 1024)), {"Content-Encoding": "gzip"})
+        else:
+            self._send(404, b"not found")
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.accept_encodings = []
+        self.connections = 0
+
+    def handle_error(self, request, client_address):
+        # Cancelled and over-budget downloads drop the connection on purpose.
+        pass
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+@pytest.fixture()
+def server():
+    srv = _Server()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_fetch_decodes_follows_redirects_and_reuses_connection(server, tmp_path):
+    mod = _load_module()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    fetcher = mod.Fetcher(timeout=10)
+    out = tmp_path / "subscription.body"
+    headers = tmp_path / "subscription.headers"
+
+    result = fetcher.fetch(f"{base}/old", out, headers)
+    fetcher.fetch(f"{base}/sub", tmp_path / "second.body")
+    fetcher.close()
+
+    assert out.read_bytes() == PAYLOAD
+    assert result.size == len(PAYLOAD) and result.encoding == "gzip" and result.status == 200
+    dump = headers.read_bytes().decode()
+    assert dump.startswith("HTTP/1.1 302 ") and "\r\nHTTP/1.1 200 " in dump
+    assert "profile-update-interval: 12" in dump
+    assert server.accept_encodings[0].startswith("gzip, deflate")
+    # Redirect + two requests over one keep-alive connection.
+    assert fetcher.connections_opened == 1
+    assert server.connections == 1
+
+
+def test_fetch_enforces_size_budget_and_http_errors(server, tmp_path):
+    mod = _load_module()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    fetcher = mod.Fetcher(timeout=10, max_bytes=1024 * 1024)
+    out = tmp_path / "subscription.body"
+
+    with pytest.raises(mod.FetchError, match="XRAY_FETCH_MAX_BYTES"):
+        fetcher.fetch(f"{base}/bomb", out)
+    with pytest.raises(mod.FetchError, match="HTTP 404"):
+        fetcher.fetch(f"{base}/missing", out)
+    fetcher.close()
+
+    assert not out.exists()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_oversized_redirect_body_is_not_drained(server, tmp_path):
+    mod = _load_module()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    fetcher = mod.Fetcher(timeout=10, max_bytes=1024 * 1024)
+    out = tmp_path / "subscription.body"
+
+    result = fetcher.fetch(f"{base}/big-redirect", out)
+    fetcher.close()
+
+    assert out.read_bytes() == PAYLOAD and result.url == f"{base}/sub"
+    # The 8 MiB redirect body is abandoned with its connection, not read past the budget.
+    assert fetcher.connections_opened == 2
+
+
+def test_mirrors_hedge_to_faster_mirror_and_learn_latency(server, tmp_path, monkeypatch):
+    mod = _load_module()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setenv("XRAY_FETCH_HEDGE_DELAY_SEC", "0.1")
+    stats_path = tmp_path / "stats" / "mirror-stats.json"
+    mirrors = [f"{base}/empty", f"{base}/slow", f"{base}/fast"]
+    fetcher = mod.Fetcher(timeout=10)
+    out = tmp_path / "subscription.body"
+    headers = tmp_path / "subscription.headers"
+
+    stats = mod.MirrorStats(stats_path)
+    started = time.monotonic()
+    result = mod.fetch_mirrors(fetcher, mirrors, out, headers, stats)
+    stats.save()
+
+    # The empty mirror fails over at once, the slow one is hedged after 0.1s.
+    assert time.monotonic() - started < 0.9
+    assert result.url == f"{base}/fast"
+    assert out.read_bytes() == b"fast mirror"
+    dump = headers.read_bytes().decode()
+    assert "profile-update-interval: 6" in dump
+    # The failed mirror's hints never reach the header dump.
+    assert "Retry-After" not in dump
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["stats", "subscription.body", "subscription.headers"]
+
+    stats = mod.MirrorStats(stats_path)
+    assert stats.order(mirrors) == [f"{base}/fast", f"{base}/slow", f"{base}/empty"]
+    assert stats.mirrors[mod.mirror_key(f"{base}/empty")]["failures"] == 1
+    assert f"{base}" not in stats_path.read_text()
+
+    # No body kept, no header dump: a failed mirror's Retry-After must not drive the updater.
+    with pytest.raises(mod.FetchError, match="all mirrors failed"):
+        mod.fetch_mirrors(fetcher, [f"{base}/missing", f"{base}/empty"], out, headers, stats)
+    assert "Retry-After" not in headers.read_bytes().decode()
+    fetcher.close()
+
+
+class _FakeBrotli:
+    """brotli >= 1.2 stand-in: every input byte expands to 64 KiB of zeros."""
+
+    class Decompressor:
+        def __init__(self):
+            self.pending = b""
+
+        def process(self, data, output_buffer_limit):
+            self.pending += b"\0" * (len(data) * 65536)
+            out, self.pending = self.pending[:output_buffer_limit], self.pending[output_buffer_limit:]
+            return out
+
+        def can_accept_more_data(self):
+            return not self.pending
+
+
+class _FakeZstandard:
+    """zstandard stand-in whose stream_writer expands each input byte to 64 KiB."""
+
+    class ZstdDecompressor:
+        def stream_writer(self, writer, write_size, closefd):
+            class _Writer:
+                def write(self, data):
+                    for _ in range(len(data) * 65536 // write_size):
+                        writer.write(b"\0" * write_size)
+                    return len(data)
+
+            return _Writer()
+
+
+def test_br_and_zstd_decoders_bound_output_per_step(monkeypatch):
+    mod = _load_module()
+    monkeypatch.setattr(mod, "brotli", _FakeBrotli)
+    monkeypatch.setattr(mod, "zstd", None)
+    monkeypatch.setattr(mod, "zstandard", _FakeZstandard)
+    assert mod.supported_encodings() == ["gzip", "deflate", "br", "zstd"]
+
+    for encoding in ("br", "zstd"):
+        decoder = mod._Decoder(encoding)
+        assert [len(piece) for piece in decoder.decode(b"x" * 100, 1000)] == [1001]
+        # Under the limit the whole expansion comes out.
+        decoder = mod._Decoder(encoding)
+        pieces = list(decoder.decode(b"x", 10 * 65536))
+        assert sum(map(len, pieces)) == 65536
+
+    class _OldBrotli:
+        class Decompressor:
+            pass
+
+    monkeypatch.setattr(mod, "brotli", _OldBrotli)
+    assert "br" not in mod.supported_encodings()
+    with pytest.raises(mod.FetchError, match="unsupported"):
+        mod._Decoder("br")
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/node_health.py
+"""
+
+import importlib.util
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "node_health.py"
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("node_health", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    spec.loader.exec_module(module)
+    return module
+
+
+def _outbound(tag, address):
+    return {
+        "tag": tag,
+        "protocol": "vless",
+        "settings": {
+            "vnext": [
+                {
+                    "address": address,
+                    "port": 443,
+                    "users": [{"id": "11111111-1111-1111-1111-111111111111"}],
+                }
+            ]
+        },
+        "streamSettings": {"network": "tcp", "security": "reality"},
+    }
+
+
+def test_ring_buffer_wraps_and_round_trips(tmp_path):
+    mod = _load_module()
+    history = mod.HealthHistory(slots=4)
+    ident = b"\x01" * 8
+    for ts in range(1, 7):
+        history.record(ident, ts, None if ts == 5 else ts * 10)
+
+    assert history.samples(ident) == [(3, 30), (4, 40), (5, None), (6, 60)]
+
+    path = tmp_path / "health.db"
+    mod.save_history(path, history)
+    assert path.stat().st_size == 4 + 2 + 4 + 8 + 2 + 2 + 4 * 6
+    loaded = mod.load_history(path)
+    assert loaded.samples(ident) == history.samples(ident)
+
+
+def test_node_identity_ignores_tag():
+    mod = _load_module()
+    assert mod.node_identity(_outbound("node1", "a.example.com")) == mod.node_identity(
+        _outbound("node7", "a.example.com")
+    )
+    assert mod.node_identity(_outbound("node1", "a.example.com")) != mod.node_identity(
+        _outbound("node1", "b.example.com")
+    )
+
+
+def test_summarize_reports_failures_and_rtt():
+    mod = _load_module()
+    stats = mod.summarize([(1, 100), (2, None), (3, 300), (4, None), (5, None)])
+    assert stats["samples"] == 5
+    assert stats["fail_ratio"] == 0.6
+    assert stats["recent_failures"] == 2
+    assert stats["median_rtt"] == 200
+
+
+def test_collect_from_stub_api(tmp_path):
+    mod = _load_module()
+    observatory = {
+        "node1": {"alive": True, "delay": 120, "outbound_tag": "node1"},
+        "node2": {"alive": False, "delay": 99999999, "outbound_tag": "node2"},
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps({"observatory": observatory}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            return
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/debug/vars"
+        status = mod.fetch_observatory(url)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    config = {
+        "outbounds": [
+            _outbound("node1", "a.example.com"),
+            _outbound("node2", "b.example.com"),
+            {"tag": "block", "protocol": "blackhole"},
+        ]
+    }
+    identities = mod.proxy_identities(config)
+    history = mod.HealthHistory()
+    assert mod.collect_once(history, identities, status, now=1000) == 2
+
+    assert history.samples(identities["node1"]) == [(1000, 120)]
+    assert history.samples(identities["node2"]) == [(1000, None)]
+
+
+def test_collect_skips_results_the_observatory_has_not_refreshed():
+    mod = _load_module()
+    identities = mod.proxy_identities({"outbounds": [_outbound("node1", "a.example.com")]})
+    history = mod.HealthHistory()
+    status = {"node1": {"alive": False, "delay": 99999999, "last_try_time": 900}}
+
+    assert mod.collect_once(history, identities, status, now=1000) == 1
+    # Polled again before the next probe: same last_try_time, no new sample.
+    assert mod.collect_once(history, identities, status, now=1010) == 0
+    status["node1"] = {"alive": True, "delay": 80, "last_try_time": 1020}
+    assert mod.collect_once(history, identities, status, now=1030) == 1
+
+    assert history.samples(identities["node1"]) == [(900, None), (1020, 80)]
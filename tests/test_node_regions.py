@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/node_regions.py
+"""
+
+import importlib.util
+from pathlib import Path
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "node_regions.py"
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("node_regions", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_country_from_flag_and_code_tokens():
+    mod = _load_module()
+    assert mod.country_from_name("🇯🇵 Tokyo 01") == "JP"
+    assert mod.country_from_name("🇬🇧 London") == "GB"
+    assert mod.country_from_name("[UK] London") == "GB"
+    assert mod.country_from_name("VLESS REALITY DE-2") == "DE"
+    assert mod.country_from_name("VIP Fast") is None
+
+
+def test_detect_regions_uses_groups_and_rtt_clusters(monkeypatch):
+    mod = _load_module()
+    monkeypatch.setenv("XRAY_REGION_GROUPS", "eu=DE,FR")
+    monkeypatch.setenv("XRAY_REGION_RTT_CLUSTERS", "1")
+    monkeypatch.setenv("XRAY_REGION_RTT_BOUNDS", "80,200")
+    monkeypatch.delenv("XRAY_REGION_GEOIP_DB", raising=False)
+
+    regions = mod.detect_regions(
+        ["node1", "node2", "node3", "node4", "node5"],
+        {},
+        {"node1": "🇫🇷 Paris", "node2": "SG 1", "node3": "a", "node4": "b"},
+        {"node3": 40, "node4": 500, "node5": None},
+    )
+    assert regions == {"node1": "eu", "node2": "sg", "node3": "near", "node4": "far"}
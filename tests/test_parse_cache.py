@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/parse_cache.py
+"""
+
+import importlib.util
+import json
+from pathlib import Path
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "parse_cache.py"
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("parse_cache", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_lru_eviction_and_version_invalidation(tmp_path):
+    mod = _load_module()
+    path = tmp_path / "cache.json"
+
+    cache = mod.ParseCache(path, "v1", max_entries=2)
+    for key in ("a", "b"):
+        assert cache.get(key) is None
+        cache.put(key, {"outbound": {"protocol": key}, "name": key})
+    cache.save()
+
+    cache = mod.ParseCache(path, "v1", max_entries=2)
+    assert cache.get("a") == {"outbound": {"protocol": "a"}, "name": "a"}
+    assert cache.get("c") is None
+    cache.put("c", {"error": "bad link"})
+    cache.save()
+    # "b" was least recently used.
+    assert list(json.loads(path.read_text())["entries"]) == ["a", "c"]
+
+    # Nothing new: the file is not rewritten.
+    mtime = path.stat().st_mtime_ns
+    cache = mod.ParseCache(path, "v1", max_entries=2)
+    cache.get("a")
+    cache.save()
+    assert path.stat().st_mtime_ns == mtime
+
+    assert mod.ParseCache(path, "v2").entries == {}
+
+
+def test_entry_key_normalizes_links_and_provider_entries():
+    mod = _load_module()
+    assert mod.entry_key(" vless://a@b:1 \n") == mod.entry_key("vless://a@b:1")
+    assert mod.entry_key(("singbox", {"b": 1, "a": 2})) == mod.entry_key(("singbox", {"a": 2, "b": 1}))
+    assert mod.entry_key(("clash", "- {name: a}")) != mod.entry_key(("singbox", "- {name: a}"))
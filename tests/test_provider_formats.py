@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/provider_formats.py
+"""
+
+import importlib.util
+import json
+from pathlib import Path
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "provider_formats.py"
+
+CLASH_PROFILE = """\
+# Mihomo profile
+mixed-port: 7890
+proxies:
+  - name: "🇩🇪 DE reality"
+    type: vless
+    server: de.example.com
+    port: 443
+    uuid: 11111111-1111-1111-1111-111111111111
+    network: tcp
+    tls: true
+    flow: xtls-rprx-vision
+    servername: www.microsoft.com   # camouflage SNI
+    client-fingerprint: chrome
+    reality-opts:
+      public-key: pbk-value
+      short-id: ab12
+  - {name: 'US ws', type: vmess, server: us.example.com, port: 8443, uuid: 22222222-2222-2222-2222-222222222222, alterId: 0, cipher: auto, tls: true, network: ws, ws-opts: {path: /ws, headers: {Host: cdn.example.com}}}
+  - name: trojan grpc
+    type: trojan
+    server: 2001:db8::1
+    port: 443
+    password: "p#ss: word"
+    network: grpc
+    alpn:
+      - h2
+    grpc-opts:
+      grpc-service-name: svc
+proxy-groups:
+  - name: auto
+    type: url-test
+"""
+
+
+def _load_module(without_yaml=False):
+    spec = importlib.util.spec_from_file_location("provider_formats", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    spec.loader.exec_module(module)
+    if without_yaml:
+        module.yaml = None
+    return module
+
+
+def test_builtin_yaml_parser_matches_clash_items(tmp_path):
+    mod = _load_module(without_yaml=True)
+    path = tmp_path / "clash.yaml"
+    path.write_text(CLASH_PROFILE, encoding="utf-8")
+
+    entries = list(mod.iter_provider_entries(str(path)))
+    assert [source for source, _ in entries] == ["clash", "clash", "clash"]
+    proxies = [mod.parse_yaml_item(text) for _, text in entries]
+
+    assert proxies[0]["reality-opts"] == {"public-key": "pbk-value", "short-id": "ab12"}
+    assert proxies[0]["servername"] == "www.microsoft.com"
+    assert proxies[0]["port"] == 443 and proxies[0]["tls"] is True
+    assert proxies[1]["ws-opts"] == {"path": "/ws", "headers": {"Host": "cdn.example.com"}}
+    assert proxies[2]["server"] == "2001:db8::1"
+    assert proxies[2]["password"] == "p#ss: word"
+    assert proxies[2]["alpn"] == ["h2"]
+
+    kind, node = mod.node_from_entry(*entries[0])
+    assert kind == "vless"
+    assert node["q"] == {
+        "type": "tcp",
+        "security": "reality",
+        "pbk": "pbk-value",
+        "sid": "ab12",
+        "sni": "www.microsoft.com",
+        "fp": "chrome",
+        "flow": "xtls-rprx-vision",
+    }
+    kind, node = mod.node_from_entry(*entries[1])
+    assert kind == "vmess"
+    assert (node["net"], node["host"], node["path"], node["tls"]) == ("ws", "cdn.example.com", "/ws", "tls")
+
+
+def test_singbox_outbounds_are_streamed_past_small_chunks(tmp_path, monkeypatch):
+    mod = _load_module()
+    monkeypatch.setattr(mod, "CHUNK_SIZE", 16)
+    config = {
+        "log": {"level": "info"},
+        "inbounds": [{"type": "mixed", "listen_port": 2080}],
+        "outbounds": [
+            {"type": "selector", "tag": "select", "outbounds": ["a", "b"]},
+            {
+                "type": "vless",
+                "tag": "a",
+                "server": "a.example.com",
+                "server_port": 443,
+                "uuid": "11111111-1111-1111-1111-111111111111",
+                "tls": {
+                    "enabled": True,
+                    "server_name": "a.example.com",
+                    "utls": {"enabled": True, "fingerprint": "firefox"},
+                },
+                "transport": {"type": "grpc", "service_name": "svc"},
+            },
+            {"type": "shadowsocks", "tag": "b", "server": "b.example.com", "server_port": 8388,
+             "method": "2022-blake3-aes-128-gcm", "password": "secret"},
+            {"type": "direct", "tag": "direct"},
+        ],
+    }
+    path = tmp_path / "singbox.json"
+    path.write_text(json.dumps(config, indent=2), encoding="utf-8")
+
+    entries = list(mod.iter_provider_entries(str(path)))
+    assert [(source, entry["tag"]) for source, entry in entries] == [("singbox", "a"), ("singbox", "b")]
+    assert mod.node_from_entry(*entries[0]) == (
+        "vless",
+        {
+            "id": "11111111-1111-1111-1111-111111111111",
+            "host": "a.example.com",
+            "port": 443,
+            "q": {"type": "grpc", "security": "tls", "sni": "a.example.com", "fp": "firefox",
+                  "serviceName": "svc"},
+            "name": "a",
+        },
+    )
+    assert mod.node_from_entry(*entries[1])[0] == "ss"
+
+
+def test_share_link_subscriptions_yield_no_entries(tmp_path):
+    mod = _load_module()
+    path = tmp_path / "links.txt"
+    path.write_text("vless://id@example.com:443#a\n", encoding="utf-8")
+    assert list(mod.iter_provider_entries(str(path))) == []
@@ -7,6 +7,7 @@ import base64
 import json
 import subprocess
 import sys
+import urllib.parse
 from pathlib import Path
 
 
@@ -91,3 +92,253 @@ def test_parses_base64_blob_subscription(tmp_path):
     proxy_outbounds = [o for o in cfg["outbounds"] if o.get("tag", "").startswith("node")]
     assert len(proxy_outbounds) == 2
 
+
+def test_generated_config_is_compact(tmp_path):
+    _run_html2xray(_vless_link(), tmp_path)
+
+    raw = (tmp_path / "generated.json").read_text(encoding="utf-8")
+    assert "\n" not in raw.rstrip("\n")
+    assert ": " not in raw
+
+
+def _stream_by_tag(cfg: dict) -> dict:
+    return {o["tag"]: o.get("streamSettings") for o in cfg["outbounds"]}
+
+
+def test_parses_modern_transports(tmp_path):
+    uid = "11111111-1111-1111-1111-111111111111"
+    extra = '{"xPaddingBytes":"100-1000","noGRPCHeader":false}'
+    links = [
+        f"vless://{uid}@a.example.com:443?security=reality&type=xhttp&path=%2Fx&host=cdn.example.com"
+        f"&mode=stream-up&extra={urllib.parse.quote(extra)}&sni=a.example.com&pbk=k&sid=01#xhttp",
+        f"vless://{uid}@b.example.com:443?security=tls&type=splithttp&path=%2Fsplit#split",
+        f"vless://{uid}@c.example.com:443?security=tls&type=httpupgrade&path=%2Fup&host=up.example.com#hu",
+        f"vless://{uid}@d.example.com:443?security=tls&type=grpc&serviceName=svc&mode=multi&authority=d.example.com#grpc",
+        f"vless://{uid}@e.example.com:1234?type=kcp&headerType=wechat-video&seed=s3cr3t&mtu=1350&tti=20#kcp",
+        f"trojan://pw@f.example.com:443?security=tls&type=tcp&headerType=http&path=%2Fa,%2Fb&host=f.example.com#tcphttp",
+    ]
+
+    streams = _stream_by_tag(_run_html2xray("\n".join(links), tmp_path))
+
+    assert streams["node1"]["network"] == "xhttp"
+    assert streams["node1"]["xhttpSettings"] == {
+        "path": "/x",
+        "host": "cdn.example.com",
+        "mode": "stream-up",
+        "extra": {"xPaddingBytes": "100-1000", "noGRPCHeader": False},
+    }
+    assert streams["node2"]["network"] == "xhttp"
+    assert streams["node2"]["xhttpSettings"] == {"path": "/split"}
+    assert streams["node3"]["httpupgradeSettings"] == {"path": "/up", "host": "up.example.com"}
+    assert streams["node4"]["grpcSettings"] == {
+        "serviceName": "svc",
+        "multiMode": True,
+        "authority": "d.example.com",
+    }
+    assert streams["node5"]["kcpSettings"] == {
+        "mtu": 1350,
+        "tti": 20,
+        "header": {"type": "wechat-video"},
+        "seed": "s3cr3t",
+    }
+    assert streams["node6"]["tcpSettings"]["header"] == {
+        "type": "http",
+        "request": {"path": ["/a", "/b"], "headers": {"Host": ["f.example.com"]}},
+    }
+
+
+def test_vmess_grpc_multi_mode_and_removed_h2_transport(tmp_path):
+    vmess_grpc = {
+        "v": "2",
+        "ps": "grpc",
+        "add": "example.com",
+        "port": "443",
+        "id": "11111111-1111-1111-1111-111111111111",
+        "aid": "0",
+        "net": "grpc",
+        "type": "multi",
+        "path": "svc",
+        "tls": "tls",
+    }
+    vmess_h2 = dict(vmess_grpc, net="h2", type="none", path="/h2")
+    links = [
+        "vmess://" + base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip("=")
+        for obj in (vmess_grpc, vmess_h2)
+    ]
+
+    cfg = _run_html2xray("\n".join(links), tmp_path)
+
+    proxies = [o for o in cfg["outbounds"] if o["tag"].startswith("node")]
+    # The h2 node is skipped: Xray-core removed that transport.
+    assert [o["tag"] for o in proxies] == ["node1"]
+    assert proxies[0]["streamSettings"]["grpcSettings"] == {"serviceName": "svc", "multiMode": True}
+
+
+def test_parses_wireguard_links_and_reports_hysteria(tmp_path):
+    private_key = "yAnz5TF+lXXJte14tji3zlMNq+hd2rYUIgJBgB3fBmk="
+    public_key = "HIgo9xNzJMWLKASShiTqIybxZ0U3wGLiUeJ1PKf8ykw="
+    preshared = base64.b64encode(bytes(range(32))).decode()
+    links = [
+        # v2rayN / Hiddify style: private key in userinfo, unescaped "+" in the query.
+        f"wireguard://{urllib.parse.quote(private_key, safe='')}@162.159.192.1:2408"
+        f"?publickey={public_key}&reserved=1,2,3&address=172.16.0.2/32,2606:4700::2"
+        f"&mtu=1280#warp",
+        # Short scheme, base64 reserved, preshared key and custom allowed IPs.
+        f"wg://{private_key}@[2606:4700:d0::a29f:c001]:51820/"
+        f"?publicKey={urllib.parse.quote(public_key, safe='')}&reserved=AQID"
+        f"&presharedkey={urllib.parse.quote(preshared, safe='')}&allowedips=10.0.0.0/8"
+        f"&keepalive=25&ip=10.8.0.2#home",
+        "hysteria2://secret@example.com:443?sni=example.com#hy2",
+    ]
+
+    cfg = _run_html2xray("\n".join(links), tmp_path)
+
+    proxies = [o for o in cfg["outbounds"] if o["tag"].startswith("node")]
+    # The hysteria2 link is skipped: Xray-core has no outbound for it.
+    assert [o["protocol"] for o in proxies] == ["wireguard", "wireguard"]
+    assert proxies[0]["settings"] == {
+        "secretKey": private_key,
+        "address": ["172.16.0.2/32", "2606:4700::2"],
+        "peers": [
+            {
+                "publicKey": public_key,
+                "endpoint": "162.159.192.1:2408",
+                "allowedIPs": ["0.0.0.0/0", "::/0"],
+            }
+        ],
+        "mtu": 1280,
+        "reserved": [1, 2, 3],
+    }
+    assert proxies[1]["settings"] == {
+        "secretKey": private_key,
+        "address": ["10.8.0.2"],
+        "peers": [
+            {
+                "publicKey": public_key,
+                "endpoint": "[2606:4700:d0::a29f:c001]:51820",
+                "allowedIPs": ["10.0.0.0/8"],
+                "preSharedKey": preshared,
+                "keepAlive": 25,
+            }
+        ],
+        "reserved": [1, 2, 3],
+    }
+
+
+def test_parses_clash_and_singbox_profiles(tmp_path):
+    clash = """\
+proxies:
+- name: DE vless
+  type: vless
+  server: de.example.com
+  port: 443
+  uuid: 11111111-1111-1111-1111-111111111111
+  network: ws
+  tls: true
+  ws-opts:
+    path: /ws
+    headers:
+      Host: cdn.example.com
+- {name: SS obfs, type: ss, server: ss.example.com, port: 8388, cipher: aes-128-gcm, password: x, plugin: obfs}
+- {name: HY2, type: hysteria2, server: hy.example.com, port: 443, password: x}
+- {name: SS, type: ss, server: ss.example.com, port: 8388, cipher: aes-128-gcm, password: x}
+rules:
+- MATCH,auto
+"""
+    cfg = _run_html2xray(clash, tmp_path)
+    proxies = [o for o in cfg["outbounds"] if o["tag"].startswith("node")]
+    # Plugin-based and non-Xray protocols are skipped, the rest keep their order.
+    assert [(o["tag"], o["protocol"]) for o in proxies] == [("node1", "vless"), ("node4", "shadowsocks")]
+    assert proxies[0]["streamSettings"]["wsSettings"] == {"path": "/ws", "headers": {"Host": "cdn.example.com"}}
+    assert proxies[0]["streamSettings"]["security"] == "tls"
+    assert cfg["remarks"] == {"node1": "DE vless", "node4": "SS"}
+
+    singbox = {
+        "outbounds": [
+            {"type": "urltest", "tag": "auto", "outbounds": ["trojan-1"]},
+            {
+                "type": "trojan",
+                "tag": "trojan-1",
+                "server": "t.example.com",
+                "server_port": 443,
+                "password": "pw",
+                "tls": {"enabled": True, "server_name": "t.example.com", "alpn": ["h2", "http/1.1"]},
+            },
+        ]
+    }
+    cfg = _run_html2xray(json.dumps(singbox), tmp_path)
+    proxies = [o for o in cfg["outbounds"] if o["tag"].startswith("node")]
+    assert len(proxies) == 1
+    assert proxies[0]["settings"]["servers"][0] == {"address": "t.example.com", "port": 443, "password": "pw"}
+    assert proxies[0]["streamSettings"]["tlsSettings"] == {
+        "serverName": "t.example.com",
+        "alpn": ["h2", "http/1.1"],
+    }
+
+
+def test_parse_cache_reuses_built_outbounds(tmp_path, monkeypatch):
+    cache_path = tmp_path / "parse-cache.json"
+    monkeypatch.setenv("XRAY_PARSE_CACHE", str(cache_path))
+    links = "\n".join([_vless_link(), _vmess_link(), "hysteria2://pw@example.com:443"])
+
+    first = _run_html2xray(links, tmp_path)
+    cache = json.loads(cache_path.read_text(encoding="utf-8"))
+    assert len(cache["entries"]) == 3
+    assert sum("error" in entry for entry in cache["entries"].values()) == 1
+
+    # Cached builds are used as-is on the next run (no re-parse) and get fresh tags.
+    for entry in cache["entries"].values():
+        if entry.get("outbound", {}).get("protocol") == "vmess":
+            entry["outbound"]["settings"]["vnext"][0]["address"] = "cached.example.com"
+    cache_path.write_text(json.dumps(cache), encoding="utf-8")
+    second = _run_html2xray(links, tmp_path)
+    assert second["remarks"] == first["remarks"]
+    assert second["outbounds"][0] == first["outbounds"][0]
+    assert second["outbounds"][1]["tag"] == "node2"
+    assert second["outbounds"][1]["settings"]["vnext"][0]["address"] == "cached.example.com"
+
+    # A different parser version invalidates the cache.
+    cache["version"] = "1:other"
+    cache_path.write_text(json.dumps(cache), encoding="utf-8")
+    third = _run_html2xray(links, tmp_path)
+    assert third == first
+
+
+def test_parse_failure_metric_counts_only_real_errors(tmp_path):
+    src = tmp_path / "subscription.txt"
+    out = tmp_path / "generated.json"
+    metrics_dir = tmp_path / "metrics"
+    src.write_text(
+        "\n".join(
+            [
+                _vless_link(),
+                # Skipped on purpose: no Xray-core outbound / removed transport.
+                "hysteria2://secret@example.com:443?sni=example.com#hy2",
+                _vless_link().replace("type=ws", "type=h2"),
+                # A real parse error: the vmess payload is not base64 JSON.
+                "vmess://notbase64json",
+            ]
+        ),
+        encoding="utf-8",
+    )
+    env = {
+        "PATH": "/usr/bin:/bin",
+        "XRAY_METRICS_DIR": str(metrics_dir),
+        "XRAY_PARSE_CACHE": str(tmp_path / "parse-cache.json"),
+    }
+
+    # The second run is served from the parse cache, which keeps the distinction.
+    for _ in range(2):
+        result = subprocess.run(
+            [sys.executable, str(SCRIPT_PATH), str(src), str(out)],
+            capture_output=True,
+            text=True,
+            check=False,
+            env=env,
+        )
+        assert result.returncode == 0, result.stderr
+
+    text = (metrics_dir / "updater.prom").read_text(encoding="utf-8")
+    assert "xray_updater_links_found 4" in text
+    # One real error per run; the skipped hysteria2/h2 nodes are not failures.
+    assert "xray_updater_parse_failures_total 2" in text
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/updater_daemon.py
+"""
+
+import asyncio
+import importlib.util
+import random
+import sys
+from pathlib import Path
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "updater_daemon.py"
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("updater_daemon", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    # dataclasses resolve string annotations through sys.modules.
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_schedule_from_env(monkeypatch):
+    mod = _load_module()
+    monkeypatch.setenv("SUB_UPDATE_INTERVAL_MIN", "30")
+    monkeypatch.setenv("SUB_UPDATE_JITTER_PCT", "20")
+    monkeypatch.delenv("SUB_UPDATE_RETRY_MAX_SEC", raising=False)
+
+    schedule = mod.Schedule.from_env()
+    assert schedule.interval_sec == 1800
+    assert schedule.jitter_ratio == 0.2
+    assert schedule.retry_max_sec == 1800
+
+
+def test_success_delay_is_jittered_within_bounds():
+    mod = _load_module()
+    schedule = mod.Schedule(interval_sec=3600, jitter_ratio=0.1)
+    rng = random.Random(1)
+
+    delays = [mod.next_delay(True, 0, {}, schedule, rng) for _ in range(200)]
+    assert all(3240 <= d <= 3960 for d in delays)
+    assert len({round(d) for d in delays}) > 50
+
+
+def test_failure_backoff_grows_and_respects_retry_after():
+    mod = _load_module()
+    schedule = mod.Schedule(interval_sec=3600, retry_min_sec=30, retry_max_sec=600)
+    rng = random.Random(2)
+
+    assert 30 <= mod.next_delay(False, 1, {}, schedule, rng) <= 30
+    assert 30 <= mod.next_delay(False, 3, {}, schedule, rng) <= 120
+    assert mod.next_delay(False, 10, {}, schedule, rng) <= 600
+    assert mod.next_delay(False, 1, {"retry_after_sec": 900.0}, schedule, rng) == 900.0
+
+
+def test_parse_provider_hints_uses_last_response():
+    mod = _load_module()
+    headers = (
+        "HTTP/1.1 302 Found\r\nLocation: /sub\r\nprofile-update-interval: 1\r\n\r\n"
+        "HTTP/2 429\r\nprofile-update-interval: 12\r\n"
+        "Retry-After: Wed, 21 Oct 2015 07:28:30 GMT\r\n\r\n"
+    )
+
+    hints = mod.parse_provider_hints(headers, now=1445412480.0)
+    assert hints["interval_sec"] == 12 * 3600
+    assert hints["retry_after_sec"] == 30.0
+
+    schedule = mod.Schedule(interval_sec=3600, jitter_ratio=0.0)
+    assert mod.next_delay(True, 0, hints, schedule, random.Random(0)) == 12 * 3600
+
+
+def test_overlapping_triggers_merge_into_one_run():
+    mod = _load_module()
+    calls = []
+
+    async def runner():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return True, {}
+
+    async def scenario():
+        daemon = mod.UpdaterDaemon(mod.Schedule(), runner)
+        results = await asyncio.gather(*(daemon.run_now() for _ in range(5)))
+        return results
+
+    assert asyncio.run(scenario()) == [True] * 5
+    assert len(calls) == 1
+
+
+def test_socket_trigger_runs_immediately(tmp_path):
+    mod = _load_module()
+    calls = []
+
+    async def runner():
+        calls.append(1)
+        return len(calls) > 1, {}
+
+    async def scenario():
+        daemon = mod.UpdaterDaemon(mod.Schedule(interval_sec=3600, jitter_ratio=0.0), runner)
+        socket_path = str(tmp_path / "updater.sock")
+        server = await asyncio.start_unix_server(daemon.handle_client, path=socket_path)
+        loop_task = asyncio.create_task(daemon.serve_forever())
+        await asyncio.sleep(0.05)
+
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(b"update\n")
+        await writer.drain()
+        reply = await reader.readline()
+        writer.close()
+        await asyncio.sleep(0.05)
+
+        loop_task.cancel()
+        server.close()
+        return reply, daemon.last_delay
+
+    reply, last_delay = asyncio.run(scenario())
+    assert reply == b"ok\n"
+    assert len(calls) == 2
+    assert last_delay == 3600
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/xray_json.py
+"""
+
+import hashlib
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "xray_json.py"
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("xray_json", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    spec.loader.exec_module(module)
+    return module
+
+
+def _config():
+    return {
+        "outbounds": [{"tag": "node1", "protocol": "vless", "settings": {"name": "Узел 🇩🇪"}}],
+        "log": {"loglevel": "warning"},
+    }
+
+
+def test_compact_output_is_minimal_and_sorted(monkeypatch):
+    mod = _load_module()
+    monkeypatch.delenv("XRAY_CONFIG_PRETTY", raising=False)
+
+    payload = mod.dumps_config(_config(), backend="json")
+
+    assert payload == (
+        '{"log":{"loglevel":"warning"},"outbounds":[{"protocol":"vless",'
+        '"settings":{"name":"Узел 🇩🇪"},"tag":"node1"}]}\n'
+    ).encode("utf-8")
+
+
+def test_pretty_output_from_env(monkeypatch):
+    mod = _load_module()
+    monkeypatch.setenv("XRAY_CONFIG_PRETTY", "1")
+
+    payload = mod.dumps_config(_config(), backend="json").decode("utf-8")
+
+    assert '\n  "log": {\n' in payload
+    assert json.loads(payload) == _config()
+
+
+def test_backends_produce_identical_bytes():
+    mod = _load_module()
+    if mod.orjson is None:
+        pytest.skip("orjson is not installed")
+
+    for pretty in (False, True):
+        assert mod.dumps_config(_config(), pretty=pretty, backend="json") == mod.dumps_config(
+            _config(), pretty=pretty, backend="orjson"
+        )
+
+
+def test_invalid_backend_raises(monkeypatch):
+    mod = _load_module()
+    monkeypatch.setenv("XRAY_JSON_BACKEND", "simdjson")
+
+    with pytest.raises(ValueError):
+        mod.dumps_config(_config())
+
+
+def test_stream_writer_matches_compact_dump_and_records_digest(tmp_path, monkeypatch):
+    mod = _load_module()
+    monkeypatch.delenv("XRAY_CONFIG_PRETTY", raising=False)
+    monkeypatch.delenv("XRAY_JSON_BACKEND", raising=False)
+    remarks = {}
+
+    def outbounds():
+        for outbound in _config()["outbounds"]:
+            remarks[outbound["tag"]] = "filled while streaming"
+            yield outbound
+
+    path = tmp_path / "config.json"
+    size, sha256 = mod.write_config_stream(
+        {"log": _config()["log"], "outbounds": outbounds(), "remarks": remarks}, str(path)
+    )
+
+    expected = mod.dumps_config({**_config(), "remarks": {"node1": "filled while streaming"}})
+    assert path.read_bytes() == expected
+    assert (size, sha256) == (len(expected), hashlib.sha256(expected).hexdigest())
+    assert mod.read_digest(path) == sha256
+
+    path.write_bytes(expected + b" ")
+    assert mod.read_digest(path) is None
+
+
+def test_stream_chunks_identical_across_backends():
+    mod = _load_module()
+    if mod.orjson is None:
+        pytest.skip("orjson is not installed")
+
+    for backend in ("json", "orjson"):
+        chunks = list(mod.iter_config_chunks(_config(), backend=backend))
+        assert b"".join(chunks) == mod.dumps_config(_config(), pretty=False, backend=backend)
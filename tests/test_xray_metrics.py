@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/xray_metrics.py
+"""
+
+import importlib.util
+import json
+import threading
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "xray_metrics.py"
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("xray_metrics", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_record_calls_are_noop_without_metrics_dir(monkeypatch):
+    mod = _load_module()
+    monkeypatch.delenv("XRAY_METRICS_DIR", raising=False)
+
+    assert mod.record_apply("changed") is False
+    assert mod.record_update(0.0, "ok", now=1.0) is False
+
+
+def test_record_update_fills_histogram_and_last_success(tmp_path):
+    mod = _load_module()
+
+    mod.record_update(100.0, "ok", now=103.0, directory=tmp_path)
+    mod.record_update(200.0, "error", now=290.0, directory=tmp_path)
+
+    text = (tmp_path / "updater.prom").read_text(encoding="utf-8")
+    assert 'xray_updater_duration_seconds_bucket{le="5"} 1' in text
+    assert 'xray_updater_duration_seconds_bucket{le="120"} 2' in text
+    assert 'xray_updater_duration_seconds_bucket{le="+Inf"} 2' in text
+    assert "xray_updater_duration_seconds_sum 93" in text
+    assert 'xray_updater_runs_total{status="error"} 1' in text
+    assert "xray_updater_last_success_timestamp_seconds 103" in text
+    assert "xray_updater_last_run_timestamp_seconds 290" in text
+
+
+def test_record_nodes_parse_and_apply(tmp_path):
+    mod = _load_module()
+    config = {
+        "outbounds": [
+            {"tag": "node1", "protocol": "vless"},
+            {"tag": "node2", "protocol": "vless"},
+            {"tag": "node3", "protocol": "trojan"},
+            {"tag": "direct", "protocol": "freedom"},
+            {"tag": "block", "protocol": "blackhole"},
+        ]
+    }
+
+    mod.record_nodes(config, directory=tmp_path)
+    mod.record_parse(5, 2, directory=tmp_path)
+    mod.record_apply("changed", directory=tmp_path)
+    mod.record_apply("unchanged", directory=tmp_path)
+    mod.record_apply("unchanged", directory=tmp_path)
+
+    text = (tmp_path / "updater.prom").read_text(encoding="utf-8")
+    assert 'xray_updater_nodes{protocol="vless"} 2' in text
+    assert 'xray_updater_nodes{protocol="trojan"} 1' in text
+    assert "freedom" not in text
+    assert "xray_updater_links_found 5" in text
+    assert "xray_updater_parse_failures_total 2" in text
+    assert 'xray_updater_apply_total{result="changed"} 1' in text
+    assert 'xray_updater_apply_total{result="unchanged"} 2' in text
+
+    state = json.loads((tmp_path / "updater.state.json").read_text(encoding="utf-8"))
+    assert state["apply_total"]["unchanged"] == 2
+
+
+def test_invalid_apply_result_raises(tmp_path):
+    mod = _load_module()
+
+    with pytest.raises(ValueError):
+        mod.record_apply("maybe", directory=tmp_path)
+
+
+def test_http_endpoint_merges_textfiles_and_adds_uptime(tmp_path):
+    mod = _load_module()
+    mod.record_apply("changed", directory=tmp_path)
+    (tmp_path / "xray_watch.prom").write_text(
+        "xray_supervisor_start_time_seconds 1000\n"
+        'xray_supervisor_restarts_total{reason="crash"} 3\n',
+        encoding="utf-8",
+    )
+
+    server = mod.make_server(tmp_path, "127.0.0.1:0")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as resp:
+            body = resp.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert 'xray_updater_apply_total{result="changed"} 1' in body
+    assert 'xray_supervisor_restarts_total{reason="crash"} 3' in body
+    assert "xray_supervisor_uptime_seconds " in body
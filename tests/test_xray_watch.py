@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Tests for scripts/xray_watch.sh (listener gap on config change, measured locally
+with a stand-in xray binary).
+"""
+
+import importlib.util
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = PROJECT_ROOT / "scripts" / "xray_watch.sh"
+COMPOSE_PATH = PROJECT_ROOT / "scripts" / "compose_xray_config.py"
+STARTUP_DELAY_SEC = 0.5
+
+# Binds the inbound ports like xray does (SO_REUSEPORT only when the composed
+# customSockopt asks for it) after a startup delay and echoes on every accepted
+# connection; an extra -c file with "api" serves a line-based stand-in for the
+# HandlerService, which `xray api rmi` uses to close inbound listeners by tag.
+FAKE_XRAY = """
+import json, os, signal, socket, sys, threading, time
+
+args = sys.argv[1:]
+if args[:2] == ["api", "rmi"]:
+    host, port = args[2].split("=", 1)[1].rsplit(":", 1)
+    tags = args[args.index("-tags") + 1:]
+    with socket.create_connection((host, int(port)), timeout=2) as api:
+        api.sendall((" ".join(tags) + "\\n").encode())
+        sys.exit(0 if api.makefile().readline().strip() == "ok" else 1)
+
+configs = [json.load(open(args[i + 1])) for i, arg in enumerate(args) if arg == "-c"]
+signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+time.sleep(float(os.environ["FAKE_XRAY_STARTUP_SEC"]))
+
+def echo(conn):
+    with conn:
+        while True:
+            data = conn.recv(1024)
+            if not data:
+                return
+            conn.sendall(data)
+
+def serve(sock):
+    while True:
+        try:
+            conn, _ = sock.accept()
+        except OSError:
+            return
+        threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+listeners = {}
+for inbound in configs[0]["inbounds"]:
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    custom = ((inbound.get("streamSettings") or {}).get("sockopt") or {}).get("customSockopt") or []
+    if any(opt.get("opt") == "15" for opt in custom):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        sock.bind((inbound["listen"], inbound["port"]))
+    except OSError as exc:
+        print(f"failed to listen on {inbound['port']}: {exc}", file=sys.stderr)
+        sys.exit(1)
+    sock.listen(128)
+    listeners[inbound.get("tag")] = sock
+    threading.Thread(target=serve, args=(sock,), daemon=True).start()
+
+def handler_service(sock):
+    while True:
+        conn, _ = sock.accept()
+        with conn:
+            tags = conn.makefile().readline().split()
+            found = all(tag in listeners for tag in tags)
+            for tag in tags:
+                if tag in listeners:
+                    # shutdown() also wakes the accept() blocked in serve().
+                    listeners[tag].shutdown(socket.SHUT_RDWR)
+                    listeners.pop(tag).close()
+            conn.sendall(b"ok\\n" if found else b"not found\\n")
+
+for api in [c["api"] for c in configs if "api" in c]:
+    host, port = api["listen"].rsplit(":", 1)
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(8)
+    threading.Thread(target=handler_service, args=(sock,), daemon=True).start()
+while True:
+    time.sleep(1)
+"""
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux") or shutil.which("sh") is None,
+    reason="needs /proc/net/tcp and a POSIX shell",
+)
+
+
+def _load_compose_module():
+    spec = importlib.util.spec_from_file_location("compose_xray_config", COMPOSE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader
+    spec.loader.exec_module(module)
+    return module
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _free_port_pair():
+    """Port p with p + 1 also free, below the ephemeral range so client sockets never take them."""
+    low = int(Path("/proc/sys/net/ipv4/ip_local_port_range").read_text().split()[0])
+    for port in range(low - 2, 1024, -2):
+        try:
+            with socket.socket() as first, socket.socket() as second:
+                first.bind(("127.0.0.1", port))
+                second.bind(("127.0.0.1", port + 1))
+        except OSError:
+            continue
+        return port
+    raise RuntimeError("no free port pair")
+
+
+def _accepts(port):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+            return True
+    except OSError:
+        return False
+
+
+def _wait_for(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def _write_config(path, ports, loglevel, handover, monkeypatch):
+    compose = _load_compose_module()
+    monkeypatch.setenv("XRAY_HANDOVER", "1" if handover else "0")
+    inbounds = compose.apply_handover_sockopt(
+        [
+            {"tag": f"in-{idx}", "listen": "127.0.0.1", "port": port, "protocol": "socks"}
+            for idx, port in enumerate(ports)
+        ]
+    )
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps({"log": {"loglevel": loglevel}, "inbounds": inbounds}), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _start_watcher(tmp_path, monkeypatch, handover, tags="in-0 in-1"):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "xray"
+    fake.write_text(f"#!{sys.executable}{FAKE_XRAY}", encoding="utf-8")
+    fake.chmod(0o755)
+    ports = [_free_port(), _free_port()]
+    config = tmp_path / "config.json"
+    log = tmp_path / "xray-watch.log"
+    _write_config(config, ports, "info", handover, monkeypatch)
+
+    env = dict(os.environ)
+    env.pop("XRAY_METRICS_DIR", None)
+    env.update(
+        PATH=f"{bin_dir}{os.pathsep}{env.get('PATH', '')}",
+        TMPDIR=str(tmp_path),
+        XRAY_CONFIG=str(config),
+        XRAY_WATCH_LOG=str(log),
+        XRAY_WATCH_INTERVAL_SEC="0.2",
+        XRAY_HANDOVER="1" if handover else "0",
+        XRAY_HANDOVER_GRACE_SEC="1",
+        XRAY_HANDOVER_PORTS=" ".join(map(str, ports)),
+        XRAY_HANDOVER_TAGS=tags,
+        XRAY_HANDOVER_API_PORT=str(_free_port_pair()),
+        FAKE_XRAY_STARTUP_SEC=str(STARTUP_DELAY_SEC),
+    )
+    watcher = subprocess.Popen(
+        ["sh", str(SCRIPT_PATH)], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return watcher, ports, config, log
+
+
+def _stop_watcher(watcher):
+    watcher.send_signal(signal.SIGTERM)
+    try:
+        watcher.wait(timeout=20)
+    except subprocess.TimeoutExpired:
+        watcher.kill()
+
+
+def _listener_gap(tmp_path, monkeypatch, handover):
+    """Longest stretch (seconds) in which the proxy port refused connections during a config change."""
+    watcher, ports, config, log = _start_watcher(tmp_path, monkeypatch, handover)
+    samples = []
+    stop = threading.Event()
+
+    def probe():
+        while not stop.is_set():
+            samples.append((time.monotonic(), _accepts(ports[0])))
+            time.sleep(0.005)
+
+    prober = threading.Thread(target=probe)
+    try:
+        assert _wait_for(lambda: _accepts(ports[0]))
+        prober.start()
+        time.sleep(0.2)
+        _write_config(config, ports, "warning", handover, monkeypatch)
+        done = "INFO handover complete" if handover else "INFO xray pid="
+        expected = 1 if handover else 2
+        assert _wait_for(lambda: log.exists() and log.read_text().count(done) >= expected)
+        assert _wait_for(lambda: _accepts(ports[0]))
+        time.sleep(0.2)
+    finally:
+        stop.set()
+        if prober.is_alive():
+            prober.join()
+        _stop_watcher(watcher)
+
+    gap = 0.0
+    down_since = None
+    for ts, ok in samples:
+        if not ok and down_since is None:
+            down_since = ts
+        elif ok and down_since is not None:
+            gap = max(gap, ts - down_since)
+            down_since = None
+    assert down_since is None, "listener did not come back"
+    return gap
+
+
+def _grace_connections(tmp_path, monkeypatch, tags):
+    """Connections opened while the old process drains; (connections, count still echoing afterwards)."""
+    watcher, ports, config, log = _start_watcher(tmp_path, monkeypatch, True, tags)
+    conns = []
+    try:
+        assert _wait_for(lambda: _accepts(ports[0]))
+        _write_config(config, ports, "warning", True, monkeypatch)
+        assert _wait_for(lambda: log.exists() and "draining for" in log.read_text())
+        deadline = time.monotonic() + 20
+        while "INFO handover complete" not in log.read_text() and time.monotonic() < deadline:
+            conns.append(socket.create_connection(("127.0.0.1", ports[0]), timeout=2))
+            time.sleep(0.05)
+        alive = 0
+        for conn in conns:
+            try:
+                conn.sendall(b"ping")
+                alive += conn.recv(4) == b"ping"
+            except OSError:
+                pass
+        return len(conns), alive
+    finally:
+        for conn in conns:
+            conn.close()
+        _stop_watcher(watcher)
+
+
+def test_restart_leaves_listener_gap(tmp_path, monkeypatch):
+    assert _listener_gap(tmp_path, monkeypatch, handover=False) >= STARTUP_DELAY_SEC * 0.8
+
+
+def test_handover_keeps_listener_up(tmp_path, monkeypatch):
+    assert _listener_gap(tmp_path, monkeypatch, handover=True) == 0.0
+
+
+def test_handover_connections_accepted_during_grace_survive(tmp_path, monkeypatch):
+    opened, alive = _grace_connections(tmp_path, monkeypatch, "in-0 in-1")
+    assert opened >= 5
+    assert alive == opened
+
+
+def test_handover_without_inbound_removal_loses_grace_connections(tmp_path, monkeypatch):
+    # An unknown tag makes removal fail: the old process keeps taking about
+    # half of the new connections and they are cut when it is stopped.
+    opened, alive = _grace_connections(tmp_path, monkeypatch, "missing")
+    assert 0 < alive < opened